@@ -9,6 +9,7 @@ required = [
     'pyzmq>=17.0',
     'future',
     'psutil>5.0',
+    'numpy',
     'odin',
 ]
 
@@ -27,5 +28,10 @@ setup(name='qemii',
       package_dir={'': 'src'},
       install_requires=required,
       dependency_links=dependency_links,
+      entry_points={
+          'console_scripts': [
+              'qem_vector_convert = qemii.detector.VectorFileConverter:main',
+          ]
+      },
       zip_safe=False
       )
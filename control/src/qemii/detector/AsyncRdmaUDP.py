@@ -0,0 +1,93 @@
+""" AsyncRdmaUDP
+
+Asynchronous access to an RdmaUDP connection, for use from the Tornado IOLoop.
+
+Requests are queued on a worker thread and run on the blocking RdmaUDP connection one at a time,
+so the IOLoop is never held up waiting for a response. Each request returns a Future, which fails
+with RdmaUDPError if the request has not completed within its timeout.
+
+The FEM answers commands in the order they arrive, with nothing in a response to match it to its
+command, so only one request is outstanding at the FEM at a time. Up to max_in_flight more wait
+their turn on the worker thread.
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import threading
+from datetime import timedelta
+from concurrent import futures
+
+from tornado import gen
+
+from qemii.detector.RdmaUDP import RdmaUDPError
+
+
+class AsyncRdmaUDP(object):
+    """Runs the reads and writes of an RdmaUDP connection off the IOLoop."""
+
+    def __init__(self, rdma, max_in_flight=16, timeout=None):
+        """
+        @param rdma: the RdmaUDP connection to use. It is not closed along with this object
+        @param max_in_flight: the most requests that can be queued or running at once
+        @param timeout: default time in seconds a request may take, including waiting its turn,
+        or None for the connection's UDPTimeout
+        """
+        self.rdma = rdma
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout if timeout is not None else rdma.UDPTimeout
+        self.executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+    def read(self, address, comment='', timeout=None):
+        """Read 64 bits from the address.
+
+        @returns: a Future that resolves to the data read
+        """
+        return self.request(timeout, self.rdma.read, address, comment)
+
+    def read_many(self, addresses, comment='', timeout=None):
+        """Read from each of a list of addresses.
+
+        @returns: a Future that resolves to the list of the data read from each address
+        """
+        return self.request(timeout, self.rdma.read_many, addresses, comment)
+
+    def write_many(self, writes, comment='', timeout=None):
+        """Write a list of (address, data) tuples, in order.
+
+        @returns: a Future that resolves to the number of datagrams sent
+        """
+        return self.request(timeout, self.rdma.write_many, writes, comment)
+
+    @gen.coroutine
+    def request(self, timeout, method, *args):
+        """Queue a call of an RdmaUDP method on the worker thread and wait for its result.
+
+        @param timeout: time in seconds the request may take, or None for the default
+        @raises RdmaUDPError: if max_in_flight requests are already queued, or the request times
+        out. A timed out request that had not started is dropped, one that had is left to finish
+        """
+        with self.in_flight_lock:
+            if self.in_flight >= self.max_in_flight:
+                raise RdmaUDPError("{} RDMA requests already in flight".format(self.in_flight))
+            self.in_flight += 1
+        future = self.executor.submit(method, *args)
+        future.add_done_callback(self.request_done)
+
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            result = yield gen.with_timeout(timedelta(seconds=timeout), future)
+        except gen.TimeoutError:
+            future.cancel()
+            raise RdmaUDPError("RDMA request timed out after {}s".format(timeout))
+        raise gen.Return(result)
+
+    def request_done(self, future):
+        with self.in_flight_lock:
+            self.in_flight -= 1
+
+    def close(self):
+        """Drop any queued requests and stop the worker thread, leaving the connection open."""
+        self.executor.shutdown(wait=False)
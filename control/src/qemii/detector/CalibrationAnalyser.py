@@ -0,0 +1,255 @@
+"""Calibration Analyser for the QEM Detector System.
+
+Builds the ADC transfer curves of every column of the sensor from the frames of a calibration
+run, one frame per calibration step, in a single streaming pass. Frames can be added in any number
+of blocks, in any order, and only running sums are kept, so the whole dataset never has to be in
+memory at once. Datasets are read in slabs of whole HDF5 chunks sized to a fixed memory budget,
+so the memory used does not grow with the length of the sweep.
+
+From the curves it reports, for each column:
+- offset and gain, from a straight line fitted to the steps where the column is not saturated
+- missing codes, the codes within the range the column reached that never occurred
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import logging
+
+import numpy as np
+
+COARSE_BIT_MASK = 0x7C0
+FINE_BIT_MASK = 0x3F
+COARSE_BIT_SHIFT = 6
+
+# memory the frames being reduced, and their working copies, may use at once
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+# bytes of working copies per pixel of a frame, on top of the frame itself: the masked codes and
+# their histogram bins
+WORKING_BYTES_PER_PIXEL = 2 + np.dtype(np.intp).itemsize
+
+
+class CalibrationAnalyser():
+    """Accumulates the transfer curves of every column for one calibration run."""
+
+    def __init__(self, voltages, columns, bit_mask, bit_shift=0):
+        """
+        @param voltages: input voltage of each calibration step
+        @param columns: number of columns in a frame
+        @param bit_mask: mask of the ADC bits being calibrated
+        @param bit_shift: number of bits to shift the masked bits down by
+        """
+        self.voltages = np.asarray(voltages, dtype=np.float64)
+        self.columns = columns
+        self.bit_mask = bit_mask
+        self.bit_shift = bit_shift
+        self.codes = (bit_mask >> bit_shift) + 1
+
+        steps = len(self.voltages)
+        # sum over the rows of each frame, and the number of rows summed, for each step
+        self.sums = np.zeros((steps, columns), dtype=np.float64)
+        self.counts = np.zeros(steps, dtype=np.int64)
+        # number of times each column produced each code
+        self.code_counts = np.zeros((columns, self.codes), dtype=np.int64)
+
+    @classmethod
+    def for_type(cls, calibrate_type, voltages, columns):
+        """Create an analyser for a fine or coarse calibration."""
+        if calibrate_type.lower() == "fine":
+            return cls(voltages, columns, FINE_BIT_MASK)
+        return cls(voltages, columns, COARSE_BIT_MASK, COARSE_BIT_SHIFT)
+
+    @property
+    def frames_added(self):
+        return int(np.count_nonzero(self.counts))
+
+    def add_frames(self, frames, first_step=0, steps=None):
+        """Add a block of frames to the running sums.
+
+        @param frames: array of frames, indexed by frame, row, column
+        @param first_step: calibration step of the first frame, the rest following in order
+        @param steps: calibration step of each frame, for frames not taken in order
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        frames = frames[:, :, :self.columns]
+        bits = np.bitwise_and(frames, self.bit_mask, dtype=np.uint16, casting="unsafe")
+        if self.bit_shift:
+            np.right_shift(bits, self.bit_shift, out=bits)
+        if steps is None:
+            last_step = first_step + len(bits)
+            self.sums[first_step:last_step] += bits.sum(axis=1)
+            self.counts[first_step:last_step] += bits.shape[1]
+        else:
+            np.add.at(self.sums, steps, bits.sum(axis=1))
+            np.add.at(self.counts, steps, bits.shape[1])
+        # bin every column's codes at once, by giving each column its own range of bins
+        bins = bits.astype(np.intp).reshape(-1, self.columns)
+        bins += np.arange(self.columns) * self.codes
+        self.code_counts += np.bincount(
+            bins.ravel(), minlength=self.columns * self.codes).reshape(self.columns, self.codes)
+
+    def add_dataset(self, dataset, first_frame=0, memory_budget=DEFAULT_MEMORY_BUDGET, steps=None):
+        """Add the frames of a dataset, from first_frame onwards, one slab at a time.
+
+        Each slab is read into the same buffer, so at most memory_budget bytes are used for the
+        frames and their working copies however many frames there are.
+        @param dataset: h5py dataset (or array) of frames, indexed by frame, row, column
+        @param first_frame: index of the frame taken at the first calibration step
+        @param memory_budget: bytes available to reduce the frames in
+        @param steps: calibration step of each frame from first_frame, for frames not taken in
+        order
+        """
+        frames = len(steps) if steps is not None else len(self.voltages)
+        last_frame = min(len(dataset), first_frame + frames)
+        slab_frames = self.slab_frames(dataset, memory_budget)
+        buffer = np.empty((slab_frames,) + tuple(dataset.shape[1:]), dtype=dataset.dtype)
+        read_direct = getattr(dataset, "read_direct", None)
+        start = first_frame
+        while start < last_frame:
+            # slab boundaries fall on multiples of the slab size, so every slab is whole chunks
+            stop = min((start // slab_frames + 1) * slab_frames, last_frame)
+            slab = buffer[:stop - start]
+            if read_direct is not None:
+                read_direct(buffer, np.s_[start:stop], np.s_[0:stop - start])
+            else:
+                slab[...] = dataset[start:stop]
+            if steps is None:
+                self.add_frames(slab, start - first_frame)
+            else:
+                self.add_frames(slab, steps=steps[start - first_frame:stop - first_frame])
+            start = stop
+
+    @staticmethod
+    def slab_frames(dataset, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """Number of frames to read at a time to stay within a memory budget.
+
+        Rounded down to a whole number of HDF5 chunks where the budget allows, so no chunk is read
+        and decompressed more than once.
+        """
+        frame_pixels = int(np.prod(dataset.shape[1:]))
+        frame_bytes = frame_pixels * (np.dtype(dataset.dtype).itemsize + WORKING_BYTES_PER_PIXEL)
+        frames = max(1, int(memory_budget // frame_bytes))
+        dataset_chunks = getattr(dataset, "chunks", None)
+        if dataset_chunks and frames >= dataset_chunks[0]:
+            frames -= frames % dataset_chunks[0]
+        elif dataset_chunks:
+            logging.warning("Memory budget of %d bytes is less than one HDF5 chunk of %d frames",
+                            memory_budget, dataset_chunks[0])
+        return frames
+
+    def curves(self):
+        """Mean code of each column at each step, NaN for steps with no frame."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums / self.counts[:, np.newaxis]
+
+    def fit(self, curves=None):
+        """Fit a straight line to each column's curve, over the steps it is not saturated.
+
+        @returns: tuple of (offsets, gains) arrays, with gain in codes per volt and offset the
+        code at 0V. NaN for columns with fewer than two unsaturated steps.
+        """
+        if curves is None:
+            curves = self.curves()
+        x = self.voltages[:, np.newaxis]
+        used = np.isfinite(curves) & (curves > 0) & (curves < self.codes - 1)
+        y = np.where(used, curves, 0)
+        xu = np.where(used, x, 0)
+        n = used.sum(axis=0)
+        sum_x = xu.sum(axis=0)
+        sum_y = y.sum(axis=0)
+        sum_xx = (xu * xu).sum(axis=0)
+        sum_xy = (xu * y).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            denominator = n * sum_xx - sum_x * sum_x
+            gains = (n * sum_xy - sum_x * sum_y) / denominator
+            offsets = (sum_y - gains * sum_x) / n
+        unfit = (n < 2) | (denominator == 0)
+        gains[unfit] = np.nan
+        offsets[unfit] = np.nan
+        return offsets, gains
+
+    def missing_codes(self):
+        """Codes each column never produced, between the lowest and highest codes it did produce.
+
+        @returns: boolean array indexed by column, code
+        """
+        seen = self.code_counts > 0
+        codes = np.arange(self.codes)
+        lowest = np.where(seen.any(axis=1), seen.argmax(axis=1), self.codes)
+        highest = self.codes - 1 - seen[:, ::-1].argmax(axis=1)
+        in_range = (codes >= lowest[:, np.newaxis]) & (codes <= highest[:, np.newaxis])
+        return in_range & ~seen
+
+    def results(self):
+        """Analyse the curves of every column.
+
+        @returns: dict of the voltages, curves, offsets, gains, code_counts, missing_codes and
+        missing_code_count arrays
+        """
+        curves = self.curves()
+        offsets, gains = self.fit(curves)
+        missing = self.missing_codes()
+        return {
+            "voltages": self.voltages,
+            "curves": curves.astype(np.float32),
+            "offsets": offsets,
+            "gains": gains,
+            "code_counts": self.code_counts,
+            "missing_codes": missing,
+            "missing_code_count": missing.sum(axis=1)
+        }
+
+    def save(self, file_name, results=None):
+        """Save the results of every column in one compressed .npz file."""
+        if results is None:
+            results = self.results()
+        np.savez_compressed(file_name, **results)
+        logging.debug("Saved calibration results of %d columns to %s", self.columns, file_name)
+        return results
+
+
+def frame_dataset(hdf_file, dataset_name=None):
+    """Dataset of frames in an HDF5 file: the named one, or else the first in the file."""
+    if dataset_name is None:
+        dataset_name = list(hdf_file.keys())[0]
+    return hdf_file[dataset_name]
+
+
+def coarse_scan_values(minimum, maximum, stride):
+    """Register values for the first pass of an adaptive scan: every stride, and the last value."""
+    values = list(range(minimum, maximum, stride))
+    if values and values[-1] != maximum - 1:
+        values.append(maximum - 1)
+    return values
+
+
+def refine_scan_values(sampled, curves, stride, budget, threshold=0.5):
+    """Register values to sample next in an adaptive scan.
+
+    Each interval between neighbouring sampled values where any column's code changed is filled in
+    at the new stride, starting with the intervals where the most columns changed, until the point
+    budget is used up. Intervals with a step missing its frame count as changed in every column.
+
+    @param sampled: sorted register values sampled so far
+    @param curves: mean code of each column at each sampled value, indexed by value, column
+    @param stride: spacing of the new values
+    @param budget: most values to return
+    @param threshold: change in mean code that counts as a transition
+    @returns: sorted list of new register values
+    """
+    sampled = np.asarray(sampled)
+    if len(sampled) < 2 or budget <= 0:
+        return []
+    changes = np.abs(np.diff(curves, axis=0))
+    changed = (changes >= threshold) | np.isnan(changes)
+    priority = changed.sum(axis=1)
+    values = []
+    for interval in np.argsort(-priority, kind="mergesort"):
+        if priority[interval] == 0:
+            break
+        points = list(range(int(sampled[interval]) + stride, int(sampled[interval + 1]), stride))
+        if len(values) + len(points) > budget:
+            break
+        values.extend(points)
+    return sorted(values)
@@ -0,0 +1,157 @@
+"""Calibration Store for the QEM Detector System.
+
+Keeps the results of every calibration run: the reduced curves and per-column fits from a
+CalibrationAnalyser, one compressed .npz file per run, with a JSON index of the runs.
+
+Runs are keyed by the conditions they were taken under: calibration type, DAC range and step,
+coarse calibration value, vector file hash, bias set and scan mode. Each run also records the
+frames it was reduced from, so results can be reused rather than reduced again from the same
+raw frames. Runs from an aborted or failed sweep are kept, marked incomplete with the reason,
+but are not found by default.
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+INDEX_FILE = "calibration_index.json"
+
+
+def make_key(calibrate_type, minimum, maximum, step, coarse_value, vector_hash=None,
+             biases=None, adaptive=False):
+    """Make the key of the conditions a calibration run was taken under."""
+    return {
+        "type": calibrate_type,
+        "min": minimum,
+        "max": maximum,
+        "step": step,
+        "coarse_value": coarse_value,
+        "vector_hash": vector_hash,
+        "biases": dict(biases or {}),
+        "adaptive": bool(adaptive)
+    }
+
+
+def key_id(key):
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class CalibrationStore():
+    """Directory of calibration results, with an index of the runs in it."""
+
+    def __init__(self, directory, max_loaded=4):
+        """
+        @param directory: directory to keep the results in, created if it does not exist
+        @param max_loaded: number of runs to keep loaded in memory
+        """
+        self.directory = directory
+        self.max_loaded = max_loaded
+        self.loaded = OrderedDict()  # run id: results
+        self.lock = threading.Lock()
+        self.runs = []
+        index_path = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as index_file:
+                self.runs = json.load(index_file)
+
+    def put(self, key, results, source=None, summary=None, failure_reason=None):
+        """Save the results of a run.
+
+        @param key: conditions the run was taken under, from make_key
+        @param results: dict of arrays, from CalibrationAnalyser.results
+        @param source: dict describing the frames the results were reduced from
+        @param summary: dict summarising the results, for listing the runs
+        @param failure_reason: why the sweep the run was taken from failed, if it did
+        @returns: the index entry of the run
+        """
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            run_key = key_id(key)
+            run_number = sum(1 for run in self.runs if run["key_id"] == run_key) + 1
+            run_id = "{}_{}".format(run_key, run_number)
+            file_name = "{}.npz".format(run_id)
+            np.savez_compressed(os.path.join(self.directory, file_name), **results)
+            entry = {
+                "id": run_id,
+                "key_id": run_key,
+                "key": key,
+                "file": file_name,
+                "created": time.time(),
+                "source": source or {},
+                "summary": summary or {},
+                "complete": failure_reason is None,
+                "failure_reason": failure_reason
+            }
+            self.runs.append(entry)
+            self.write_index()
+            self.remember(run_id, results)
+        logging.debug("Stored calibration run %s", run_id)
+        return entry
+
+    def find(self, key, source=None, include_incomplete=False):
+        """Find the latest run taken under the same conditions, and from the same frames if given.
+
+        @param include_incomplete: also find runs from aborted or failed sweeps
+        @returns: the index entry of the run, or None if there is none
+        """
+        run_key = key_id(key)
+        with self.lock:
+            for entry in reversed(self.runs):
+                # runs stored before completion was recorded were complete
+                if not include_incomplete and not entry.get("complete", True):
+                    continue
+                if entry["key_id"] == run_key and (source is None or entry["source"] == source):
+                    return entry
+        return None
+
+    def get(self, run_id):
+        """Load the results of a run, from memory if it was used recently.
+
+        @returns: dict of arrays, or None if the run is not in the store
+        """
+        with self.lock:
+            results = self.loaded.pop(run_id, None)
+            if results is not None:
+                # most recently used last
+                self.loaded[run_id] = results
+                return results
+            entry = self.get_entry(run_id)
+            if entry is None:
+                return None
+            with np.load(os.path.join(self.directory, entry["file"])) as data:
+                results = dict((name, data[name]) for name in data.files)
+            self.remember(run_id, results)
+            return results
+
+    def get_entry(self, run_id):
+        for entry in self.runs:
+            if entry["id"] == run_id:
+                return entry
+        return None
+
+    def list_runs(self):
+        """Index entries of every run, oldest first, without their results."""
+        with self.lock:
+            return [dict(entry) for entry in self.runs]
+
+    def remember(self, run_id, results):
+        self.loaded[run_id] = results
+        while len(self.loaded) > self.max_loaded:
+            self.loaded.popitem(last=False)
+
+    def write_index(self):
+        """Write the index to a temporary file, and then move it into place."""
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        temp_path = index_path + ".tmp"
+        with open(temp_path, "w") as index_file:
+            json.dump(self.runs, index_file, indent=1, sort_keys=True)
+        os.rename(temp_path, index_path)
@@ -0,0 +1,472 @@
+"""FEM-II Emulator.
+
+Standalone emulation of the FEM-II RDMA control interface, for benchmarking and soak testing the
+control software without hardware.
+
+Listens for the same UDP command datagrams that RdmaUDP sends and answers reads with the same
+response format. Keeps a model of the registers and the sequencer RAM, including the idelay lock
+and aligner status words, and can add latency, jitter and packet loss.
+
+To run against a QemFem on a single host, give the emulator its own loopback address as the
+camera control address, so both ends can bind the fixed RDMA ports:
+
+    python -m qemii.detector.FemEmulator --address 127.0.0.2 --latency 0.0002 --loss 0.001
+
+and configure the FEM with server_ctrl_ip_addr = 127.0.0.1, camera_ctrl_ip_addr = 127.0.0.2.
+Adding --benchmark DIR FILE instead runs the emulator in the background and times connecting,
+setup_camera and vector file uploads of a QemFem against it. --rdma-benchmark times RdmaUDP reads and
+writes alone, with every read answered straight back through loopback, both as they are now and
+as they were encoded before the preallocated buffers.
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import argparse
+import heapq
+import logging
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# command codes, from the command byte of each command header
+CMD_WRITE = 2
+CMD_READ = 3
+CMD_NOP = 255
+
+COMMAND_HEADER = struct.Struct('=BBBBI')
+DATA_WORD = struct.Struct('=Q')
+RESPONSE = struct.Struct('=IIIIQQQQQ')
+# the nop command used as padding carries 5 data cycles
+NOP_DATA_WORDS = 5
+
+# reliable write acknowledgements, as sent by RdmaUDP.write_many_reliable
+ACK_REQUEST_ADDRESS = 0xFFFFFFFF
+ACK_MARKER = 0xAC4B0000
+ACK_WORDS = 5
+# how many reliable write datagrams are remembered, to discard resends that were not needed
+MAX_RECEIVED_SEQUENCES = 4096
+
+SEQUENCER = 0xB0000000
+SEQUENCER_RAM = SEQUENCER + 0x01000000
+RECEIVER = 0xC0000000
+
+
+class EyeModel(object):
+    """Model of the receiver eye of each lane, for exercising the eye scan.
+
+    The receiver only locks while every lane's idelay tap is within its eye, and each channel only
+    aligns while its lanes are also at the right sub-cycle and cycle shifts.
+    """
+
+    def __init__(self, idelay_centres=None, idelay_half_width=6, scsr=None, ivsr=None):
+        # lanes are data_1, cdn_1, data_0, cdn_0, in the order of the idelay word.
+        # The default eyes are skewed, but overlap from tap 11 to 18
+        self.idelay_centres = idelay_centres or [12, 15, 17, 13]
+        self.idelay_half_width = idelay_half_width
+        # shifts are data_1, data_0, cdn_1, cdn_0, in the order of the shift words.
+        # The defaults are the settings used by QemFem.setup_camera
+        self.scsr = scsr or [7, 7, 7, 7]
+        self.ivsr = ivsr or [0, 0, 27, 27]
+
+    @staticmethod
+    def unpack(word):
+        return [word >> 24 & 0xFF, word >> 16 & 0xFF, word >> 8 & 0xFF, word & 0xFF]
+
+    def idelay_in_eye(self, idelay_word):
+        return all(abs(tap - centre) <= self.idelay_half_width
+                   for tap, centre in zip(self.unpack(idelay_word), self.idelay_centres))
+
+    def channel_aligned(self, channel, scsr_word, ivsr_word):
+        # data and cdn lanes of channel 1 are bytes 0 and 2 of the shift words, channel 0 1 and 3
+        lanes = (0, 2) if channel == 1 else (1, 3)
+        scsr = self.unpack(scsr_word)
+        ivsr = self.unpack(ivsr_word)
+        return all(scsr[lane] == self.scsr[lane] and ivsr[lane] == self.ivsr[lane]
+                   for lane in lanes)
+
+
+class FemEmulator(object):
+    """Register and sequencer RAM model of a single FEM-II.
+
+    Independent of any socket, so it can be driven directly with command datagrams. Without an
+    EyeModel every idelay and shift setting locks and aligns.
+    """
+
+    def __init__(self, eye_model=None):
+        self.eye_model = eye_model
+        self.registers = {}
+        self.received_sequences = OrderedDict()
+        self.duplicates = 0
+        self.sequencer_ram = {}
+        self.sequencer_running = False
+        self.idelay_loaded = False
+        self.commands = 0
+        self.reads = 0
+        self.writes = 0
+
+    def process(self, datagram):
+        """Process a command datagram, returning the response datagrams to send back.
+
+        @param datagram: a datagram of one or more commands, as sent by RdmaUDP
+        @returns: list of response datagrams, one per read command
+        """
+        commands = []
+        offset = 0
+        while offset + COMMAND_HEADER.size <= len(datagram):
+            count, tag_low, tag_high, command, address = COMMAND_HEADER.unpack_from(datagram, offset)
+            offset += COMMAND_HEADER.size
+            num_words = NOP_DATA_WORDS if command == CMD_NOP else count
+            words = []
+            while len(words) < num_words and offset + DATA_WORD.size <= len(datagram):
+                words.append(DATA_WORD.unpack_from(datagram, offset)[0])
+                offset += DATA_WORD.size
+            commands.append((command, tag_high << 8 | tag_low, address, words))
+
+        # a reliable write datagram is numbered in the tag of its closing nop, and is only
+        # carried out the first time it arrives
+        if commands and commands[-1][0] == CMD_NOP and commands[-1][1]:
+            sequence = commands[-1][1]
+            if sequence in self.received_sequences:
+                self.duplicates += 1
+                return []
+            self.received_sequences[sequence] = True
+            while len(self.received_sequences) > MAX_RECEIVED_SEQUENCES:
+                self.received_sequences.popitem(last=False)
+
+        responses = []
+        for command, tag, address, words in commands:
+            self.commands += 1
+            if command == CMD_WRITE:
+                # a burst of data words is written to consecutive addresses
+                for i, data in enumerate(words):
+                    self.write(address + i, data)
+            elif command == CMD_READ:
+                # the command tag is not echoed, as the firmware is not known to echo it
+                responses.append(RESPONSE.pack(1, 0, address,
+                                               self.read(address) & 0xFFFFFFFF, 0, 0, 0, 0, 0))
+            elif command == CMD_NOP:
+                if address == ACK_REQUEST_ADDRESS:
+                    responses.append(self.acknowledge(words[0], words[1], words[2]))
+            else:
+                logging.warning("Unknown RDMA command %d at %08X", command, address)
+        return responses
+
+    def acknowledge(self, base, count, request_id):
+        """Build the coalesced acknowledgement of a window of reliable write datagrams"""
+        bitmap = [0] * ACK_WORDS
+        for index in range(min(count, ACK_WORDS * 64)):
+            if ((base + index - 1) % 0xFFFF) + 1 in self.received_sequences:
+                bitmap[index // 64] |= 1 << (index % 64)
+        return RESPONSE.pack(ACK_MARKER, base, count, request_id, *bitmap)
+
+    def write(self, address, data):
+        self.writes += 1
+        if address >= SEQUENCER_RAM and address < SEQUENCER_RAM + 0x01000000:
+            self.sequencer_ram[address - SEQUENCER_RAM] = data
+        elif address == SEQUENCER:
+            # 1 starts and 2 stops the sequencer, 0 is the null command between them
+            if data == 0x1:
+                self.sequencer_running = True
+            elif data == 0x2:
+                self.sequencer_running = False
+        elif address == RECEIVER | 0x00 and data & 0x10:
+            # idelay load strobe
+            self.registers[RECEIVER | 0x12] = self.registers.get(RECEIVER | 0x02, 0)
+            self.idelay_loaded = True
+        self.registers[address] = data
+
+    def read(self, address):
+        self.reads += 1
+        if address >= SEQUENCER_RAM and address < SEQUENCER_RAM + 0x01000000:
+            return self.sequencer_ram.get(address - SEQUENCER_RAM, 0)
+        if address == RECEIVER | 0x13:
+            return self.get_idelay_lock_word()
+        if address == RECEIVER | 0x14:
+            return self.get_aligner_status_word()
+        return self.registers.get(address, 0)
+
+    def is_locked(self):
+        """The receiver locks once the idelay is loaded and the sequencer is clocking the sensor"""
+        if not (self.idelay_loaded and self.sequencer_running):
+            return False
+        return self.eye_model is None or self.eye_model.idelay_in_eye(
+            self.registers.get(RECEIVER | 0x12, 0))
+
+    def get_idelay_lock_word(self):
+        return 0x1 if self.is_locked() else 0x0
+
+    def get_aligner_status_word(self):
+        if not self.is_locked():
+            return 0x0
+        if self.eye_model is None:
+            return 0xFFFFFFFF
+        scsr = self.registers.get(RECEIVER | 0x05, 0)
+        ivsr = self.registers.get(RECEIVER | 0x03, 0)
+        word = 0
+        if self.eye_model.channel_aligned(1, scsr, ivsr):
+            word |= 0xFFFF0000
+        if self.eye_model.channel_aligned(0, scsr, ivsr):
+            word |= 0x0000FFFF
+        return word
+
+
+class FemEmulatorServer(object):
+    """Serves a FemEmulator over UDP, with optional latency, jitter and packet loss."""
+
+    def __init__(self, address='127.0.0.2', port=61651, reply_port=61651,
+                 latency=0.0, jitter=0.0, loss=0.0, emulator=None):
+        self.emulator = emulator or FemEmulator()
+        self.reply_port = reply_port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.dropped = 0
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.socket.bind((address, port))
+        self.running = False
+        self.thread = None
+        # responses waiting for their latency to pass: (send time, sequence, datagram, address)
+        self.scheduled = []
+        self.sequence = 0
+
+    def start(self):
+        """Serve in a background thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.socket.close()
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            timeout = 0.1
+            if self.scheduled:
+                timeout = max(0.0, min(timeout, self.scheduled[0][0] - time.time()))
+            readable, _, _ = select.select([self.socket], [], [], timeout)
+            if readable:
+                datagram, (sender, _) = self.socket.recvfrom(65536)
+                self.handle_datagram(datagram, sender)
+            self.send_due()
+
+    def handle_datagram(self, datagram, sender):
+        if self.loss and random.random() < self.loss:
+            self.dropped += 1
+            return
+        for response in self.emulator.process(datagram):
+            if self.loss and random.random() < self.loss:
+                self.dropped += 1
+                continue
+            delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+            self.sequence += 1
+            heapq.heappush(self.scheduled,
+                           (time.time() + delay, self.sequence, response, (sender, self.reply_port)))
+
+    def send_due(self):
+        now = time.time()
+        while self.scheduled and self.scheduled[0][0] <= now:
+            _, _, response, address = heapq.heappop(self.scheduled)
+            self.socket.sendto(response, address)
+
+
+class LoopbackResponder(object):
+    """Stands in for the RdmaUDP tx socket, answering each read straight back through loopback.
+
+    Commands are still sent through a real socket, to a sink socket that is never read, so the
+    kernel cost of each datagram is included without the emulator itself in the loop.
+    """
+
+    def __init__(self, tx_socket, rx_address):
+        self.socket = tx_socket
+        self.rx_address = rx_address
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sink.bind(('127.0.0.1', 0))
+        self.sink_address = self.sink.getsockname()
+        self.response = RESPONSE.pack(1, 0, 0, 0, 0, 0, 0, 0, 0)
+
+    def sendto(self, data, address):
+        sent = self.socket.sendto(data, self.sink_address)
+        if bytearray(data[3:4])[0] == CMD_READ:
+            self.socket.sendto(self.response, self.rx_address)
+        return sent
+
+    def close(self):
+        self.socket.close()
+        self.sink.close()
+
+
+class UnbufferedRdmaEncoding(object):
+    """RdmaUDP reads and writes as they were encoded before the preallocated buffers, without the
+    locking, for comparison by the RDMA benchmark.
+
+    Mixed in ahead of RdmaUDP: every call packs a new datagram from the format strings and
+    receives a new response.
+    """
+
+    def read(self, address, comment=''):
+        command = struct.pack('=BBBBIQBBBBIQQQQQ',
+                              1, 0, 0, 3, address, 0, 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+        self.txsocket.sendto(command, (self.TgtRxUDPIPAddr, self.TgtRxUDPIPPrt))
+        response = self.rxsocket.recv(self.UDPMaxRx)
+        return struct.unpack(self.RESPONSE, response)[3] if len(response) == 56 else 0
+
+    def write(self, address, data, comment=''):
+        command = struct.pack('=BBBBIQBBBBIQQQQQ',
+                              1, 0, 0, 2, address, data, 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+        self.txsocket.sendto(command, (self.TgtRxUDPIPAddr, self.TgtRxUDPIPPrt))
+
+    def write_many(self, writes, comment=''):
+        write_size = struct.calcsize(self.WRITE_COMMAND)
+        nop = struct.pack(self.NOP_COMMAND, 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+        max_writes = max(1, (self.UDPMax - self.UDP_HEADER_SIZE - len(nop)) // write_size)
+        for start in range(0, len(writes), max_writes):
+            commands = [struct.pack(self.WRITE_COMMAND, 1, 0, 0, 2, address, data)
+                        for address, data in writes[start:start + max_writes]]
+            commands.append(nop)
+            self.txsocket.sendto(b''.join(commands), (self.TgtRxUDPIPAddr, self.TgtRxUDPIPPrt))
+
+
+def run_rdma_benchmark(iterations=100000, repeats=5):
+    """Time RdmaUDP reads and writes over loopback, with every read answered immediately.
+
+    Each is timed before and after the preallocated buffers, in the same run.
+    """
+    from qemii.detector.RdmaUDP import RdmaUDP
+
+    class UnbufferedRdmaUDP(UnbufferedRdmaEncoding, RdmaUDP):
+        pass
+
+    def open_rdma(rdma_class):
+        rdma = rdma_class('127.0.0.1', 0, '127.0.0.1', 0, '127.0.0.1', 0, '127.0.0.1', 0,
+                          RxUDPBuf=4 * 1024 * 1024, UDPMTU=8000, UDPTimeout=1)
+        rdma.txsocket = LoopbackResponder(rdma.txsocket, rdma.rxsocket.getsockname())
+        rdma.ack = True
+        return rdma
+
+    writes = [(SEQUENCER_RAM + address, address) for address in range(64)]
+
+    def timed(function, ops_per_call=1):
+        best = 0
+        for _ in range(repeats):
+            start = time.time()
+            for _ in range(iterations):
+                function()
+            best = max(best, iterations * ops_per_call / (time.time() - start))
+        return best
+
+    def run(rdma):
+        return [
+            ("read", timed(lambda: rdma.read(RECEIVER | 0x13))),
+            ("write", timed(lambda: rdma.write(RECEIVER | 0x02, 0x01020304))),
+            ("write_many (64)", timed(lambda: rdma.write_many(writes), len(writes)))]
+
+    results = []
+    for rdma_class in (UnbufferedRdmaUDP, RdmaUDP):
+        rdma = open_rdma(rdma_class)
+        try:
+            results.append(run(rdma))
+        finally:
+            rdma.close()
+    print("{:<24} {:>14} {:>14} {:>8}".format("", "before ops/s", "after ops/s", "change"))
+    for (name, before), (_, after) in zip(*results):
+        print("{:<24} {:14.0f} {:14.0f} {:7.0f}%".format(
+            name, before, after, (after / before - 1) * 100))
+
+
+def run_benchmark(server, vector_file_dir, vector_file, iterations=10):
+    """Time the main QemFem register sequences against a running emulator server."""
+    from qemii.detector.QemFem import QemFem
+
+    fem = QemFem("127.0.0.1", 8070, 0, "127.0.0.1", server.socket.getsockname()[0],
+                 "127.0.0.1", "127.0.0.1", vector_file_dir, vector_file)
+
+    def timed(name, function):
+        start = time.time()
+        for _ in range(iterations):
+            function()
+        elapsed = (time.time() - start) / iterations
+        print("{:<24} {:10.3f} ms".format(name, elapsed * 1000))
+
+    def reconnect():
+        if fem.x10g_rdma is not None:
+            fem.disconnect()
+        fem.connect()
+
+    timed("connect", reconnect)
+    timed("setup_camera", fem.setup_camera)
+    timed("load_vectors full", fem.load_vectors_full)
+    timed("frame_gate_trigger", fem.frame_gate_trigger)
+    timed("get_idelay_lock_status", fem.get_idelay_lock_status)
+    timed("get_status", fem.get_status)
+    fem.eye_scan.settle_time = 0
+    timed("eye_scan", fem.eye_scan.scan)
+    timed("load_vectors delta", fem.load_vectors_from_file)
+    fem.set_reliable_writes(True)
+    timed("load_vectors reliable", fem.load_vectors_full)
+    print("emulator: {} commands, {} reads, {} writes, {} dropped, {} duplicates".format(
+        server.emulator.commands, server.emulator.reads, server.emulator.writes, server.dropped,
+        server.emulator.duplicates))
+    fem.disconnect()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Emulate the FEM-II RDMA control interface")
+    parser.add_argument("--address", default="127.0.0.2", help="address to listen on")
+    parser.add_argument("--port", type=int, default=61651, help="port to listen on")
+    parser.add_argument("--reply-port", type=int, default=61651, help="port to send responses to")
+    parser.add_argument("--latency", type=float, default=0.0, help="response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="maximum random extra latency in seconds")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="probability of dropping each datagram")
+    parser.add_argument("--eye", action="store_true",
+                        help="model the receiver eye of each lane, so only some settings lock")
+    parser.add_argument("--benchmark", nargs=2, metavar=("VECTOR_FILE_DIR", "VECTOR_FILE"),
+                        help="benchmark a QemFem against the emulator, then exit")
+    parser.add_argument("--rdma-benchmark", action="store_true",
+                        help="benchmark RdmaUDP reads and writes over loopback, then exit")
+    parser.add_argument("--iterations", type=int, default=10, help="benchmark iterations")
+    args = parser.parse_args(argv)
+
+    if args.rdma_benchmark:
+        run_rdma_benchmark(args.iterations)
+        return 0
+
+    logging.basicConfig(level=logging.WARNING)
+    server = FemEmulatorServer(args.address, args.port, args.reply_port,
+                               args.latency, args.jitter, args.loss,
+                               FemEmulator(EyeModel() if args.eye else None))
+    if args.benchmark:
+        server.start()
+        try:
+            run_benchmark(server, args.benchmark[0], args.benchmark[1], args.iterations)
+        finally:
+            server.stop()
+        return 0
+
+    print("Emulating FEM-II on {}:{}".format(args.address, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.socket.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
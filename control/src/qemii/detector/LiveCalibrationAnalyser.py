@@ -0,0 +1,251 @@
+"""Live Calibration Analyser for the QEM Detector System.
+
+Feeds the frames of a calibration sweep into a CalibrationAnalyser as they are taken, so the
+transfer curves are complete as soon as the sweep ends, and a sweep going wrong can be stopped
+early.
+
+Frames come from either:
+- zmq: the FrameProcessor live view socket. The live view plugin must pass on every frame, with
+  a frame_frequency of 1, or the curves will have gaps.
+- swmr: tailing the HDF5 file being written, which the file writer must open for SWMR.
+
+From the live view, the frame taken at the first calibration step is taken to be the first frame
+seen, and each later frame is placed by its frame number, so frames the live view drops only leave
+gaps. From the file, the first step is a given frame of the dataset, as the file writer appends
+each acquisition to the same file.
+
+Frames are taken to be at consecutive steps unless the steps are given with add_steps, in the
+order they will be taken, as an adaptive scan does.
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import glob
+import json
+import logging
+import threading
+import time
+
+import h5py
+import numpy as np
+import zmq
+
+from qemii.detector.CalibrationAnalyser import (CalibrationAnalyser, DEFAULT_MEMORY_BUDGET,
+                                                frame_dataset)
+
+LIVE_VIEW_ENDPOINT = "tcp://127.0.0.1:5020"
+
+
+class LiveCalibrationAnalyser():
+    """Runs a CalibrationAnalyser on the frames of a sweep while it is taken."""
+
+    def __init__(self, calibrate_type, voltages, source="zmq", endpoint=LIVE_VIEW_ENDPOINT,
+                 file_pattern=None, first_frame=0, dataset_name=None, poll_interval=0.1,
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        @param calibrate_type: fine or coarse
+        @param voltages: input voltage of each calibration step
+        @param source: "zmq" for the live view socket, or "swmr" to tail the HDF5 file
+        @param endpoint: live view socket to subscribe to
+        @param file_pattern: glob pattern of the HDF5 file to tail, which may not exist yet
+        @param first_frame: index in the HDF5 dataset of the frame taken at the first step
+        @param dataset_name: dataset of frames in the HDF5 file, or None for the first in it, as
+        adc_plot reads
+        @param poll_interval: time to wait for new frames before checking for a stop
+        """
+        if source not in ("zmq", "swmr"):
+            raise ValueError("Unknown live calibration source {}".format(source))
+        self.calibrate_type = calibrate_type
+        self.voltages = voltages
+        self.source = source
+        self.endpoint = endpoint
+        self.file_pattern = file_pattern
+        self.first_frame = first_frame
+        self.dataset_name = dataset_name
+        self.poll_interval = poll_interval
+        self.memory_budget = memory_budget
+
+        self.analyser = None
+        self.lock = threading.Lock()
+        self.first_frame_number = None
+        # step of each frame of the sweep, in the order taken, or None if the steps are in order
+        self.frame_steps = None
+        self.frames_received = 0
+        self.frames_placed = 0
+        self.frames_outside_sweep = 0
+        self.error = None
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        target = self.receive_live_view if self.source == "zmq" else self.tail_file
+        self.thread = threading.Thread(target=self.run, args=(target,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def add_steps(self, steps):
+        """Give the steps of the next frames of the sweep, in the order they will be taken."""
+        with self.lock:
+            if self.frame_steps is None:
+                self.frame_steps = []
+            self.frame_steps.extend(steps)
+
+    @property
+    def frames_expected(self):
+        return len(self.frame_steps) if self.frame_steps is not None else len(self.voltages)
+
+    def wait_for_frames(self, timeout):
+        """Wait until every frame expected so far has been added, or the timeout passes.
+
+        @returns: True if every expected frame was added
+        """
+        deadline = time.time() + timeout
+        while self.frames_placed < self.frames_expected and self.running:
+            if time.time() > deadline:
+                return False
+            time.sleep(self.poll_interval / 10)
+        return self.frames_placed >= self.frames_expected
+
+    @property
+    def steps_added(self):
+        return self.analyser.frames_added if self.analyser is not None else 0
+
+    def run(self, target):
+        try:
+            target()
+        except Exception as e:
+            self.error = str(e)
+            logging.error("Live calibration analysis from %s failed: %s", self.source, e)
+        finally:
+            self.running = False
+
+    def receive_live_view(self):
+        """Add each frame published on the live view socket."""
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b"")
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        try:
+            while self.running:
+                if not socket.poll(int(self.poll_interval * 1000)):
+                    continue
+                header, data = socket.recv_multipart()[:2]
+                header = json.loads(header.decode("utf-8"))
+                shape = [int(dimension) for dimension in header["shape"]]
+                frame = np.frombuffer(data, dtype=header["dtype"]).reshape(shape)
+                self.add_frames(frame, int(header["frame_num"]))
+        finally:
+            socket.close()
+
+    def tail_file(self):
+        """Add the frames appended to the HDF5 file, as the file writer flushes them."""
+        file_names = []
+        while self.running and not file_names:
+            file_names = glob.glob(self.file_pattern)
+            if not file_names:
+                time.sleep(self.poll_interval)
+        if not self.running:
+            return
+        with h5py.File(file_names[0], "r", libver="latest", swmr=True) as hdf_file:
+            dataset = frame_dataset(hdf_file, self.dataset_name)
+            slab_frames = CalibrationAnalyser.slab_frames(dataset, self.memory_budget)
+            frames_read = self.first_frame
+            while self.running:
+                dataset.refresh()
+                frames = dataset.shape[0]
+                if frames <= frames_read:
+                    time.sleep(self.poll_interval)
+                    continue
+                for start in range(frames_read, frames, slab_frames):
+                    stop = min(start + slab_frames, frames)
+                    self.add_frames(dataset[start:stop], start)
+                frames_read = frames
+
+    def add_frames(self, frames, first_frame_number):
+        """Add frames to the analyser, placing them by frame number."""
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        with self.lock:
+            if self.analyser is None:
+                self.analyser = CalibrationAnalyser.for_type(
+                    self.calibrate_type, self.voltages, frames.shape[-1])
+                self.first_frame_number = first_frame_number
+            self.frames_received += len(frames)
+            first_index = first_frame_number - self.first_frame_number
+            # only the frames that fall within the sweep
+            start = max(0, -first_index)
+            stop = min(len(frames), self.frames_expected - first_index)
+            placed = max(0, stop - start)
+            self.frames_outside_sweep += len(frames) - placed
+            self.frames_placed += placed
+            if not placed:
+                return
+            if self.frame_steps is None:
+                self.analyser.add_frames(frames[start:stop], first_index + start)
+            else:
+                self.analyser.add_frames(
+                    frames[start:stop],
+                    steps=self.frame_steps[first_index + start:first_index + stop])
+
+    def curves(self, steps):
+        """Mean code of each column at the given steps."""
+        with self.lock:
+            if self.analyser is None:
+                return np.full((len(steps), 1), np.nan)
+            return self.analyser.curves()[steps]
+
+    def stuck_columns(self):
+        """Columns whose code has not changed over the steps added so far."""
+        with self.lock:
+            if self.analyser is None:
+                return np.zeros(0, dtype=bool)
+            curves = self.analyser.curves()
+        added = np.isfinite(curves[:, 0])
+        if added.sum() < 2:
+            return np.zeros(curves.shape[1], dtype=bool)
+        curves = curves[added]
+        return curves.max(axis=0) - curves.min(axis=0) < 1
+
+    def check(self, steps_triggered, min_steps, max_stuck_fraction):
+        """Check whether the sweep is still worth finishing.
+
+        @param steps_triggered: number of frames triggered so far
+        @param min_steps: steps to wait for before judging the sweep
+        @param max_stuck_fraction: fraction of columns that may not yet have changed code
+        @returns: the reason the sweep has failed, or None if it has not
+        """
+        if self.error is not None:
+            return "live analysis failed: {}".format(self.error)
+        if steps_triggered < min_steps:
+            return None
+        if self.steps_added == 0:
+            return "no frames received after {} steps".format(steps_triggered)
+        if self.steps_added < min_steps:
+            return None
+        stuck = self.stuck_columns()
+        if stuck.mean() > max_stuck_fraction:
+            return "{} of {} columns unchanged after {} steps".format(
+                int(stuck.sum()), len(stuck), self.steps_added)
+        return None
+
+    def get_status(self):
+        return {
+            "source": self.source,
+            "running": self.running,
+            "frames_received": self.frames_received,
+            "frames_expected": self.frames_expected,
+            "steps_added": self.steps_added,
+            "steps": len(self.voltages),
+            "frames_outside_sweep": self.frames_outside_sweep,
+            "error": self.error
+        }
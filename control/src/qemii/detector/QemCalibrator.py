@@ -8,7 +8,10 @@ Adam Neaves, Detector Systems Software Group, STFC. 2019
 
 import logging
 import glob
+import os
+import time
 import h5py
+import numpy as np
 
 
 from tornado.ioloop import IOLoop
@@ -18,6 +21,13 @@ from concurrent import futures
 from odin.adapters.adapter import ApiAdapterRequest
 from odin.adapters.parameter_tree import ParameterTree
 from odin.adapters.proxy import ProxyAdapter
+
+from qemii.detector.QemFem import QemFem, run_on_fems
+from qemii.detector.CalibrationAnalyser import (CalibrationAnalyser, COARSE_BIT_MASK, FINE_BIT_MASK,
+                                                DEFAULT_MEMORY_BUDGET, coarse_scan_values,
+                                                refine_scan_values, frame_dataset)
+from qemii.detector.LiveCalibrationAnalyser import LiveCalibrationAnalyser, LIVE_VIEW_ENDPOINT
+from qemii.detector.CalibrationStore import CalibrationStore, make_key
 # from odin_data.frame_processor_adapter import FrameProcessorAdapter
 # from odin_data.frame_receiver_adapter import FrameReceiverAdapter
 
@@ -28,8 +38,14 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-COARSE_BIT_MASK = 0x7C0
-FINE_BIT_MASK = 0x3F
+# column of the sensor plotted by adc_plot
+PLOT_COLUMN = 33
+# steps between checks of the live analysis during a sweep
+LIVE_CHECK_STEPS = 64
+# each pass of an adaptive scan samples at this fraction of the previous pass's stride
+ADAPTIVE_REFINE_FACTOR = 4
+# directory, within the data directory, that calibration results are stored in
+STORE_DIR = "calibration"
 
 # defined from previous version of software
 VOLT_OFFSET_BASE = 0.19862
@@ -51,8 +67,43 @@ class QemCalibrator():
         self.max_calibration = 4096
         self.min_calibration = 0
         self.calibration_step = 1
+        # time each calibration step is held for, while a single frame is taken
+        self.calibration_dwell = 0.02
 
         self.calibration_value = 0
+        self.late_triggers = 0
+
+        self.analysis_file = None
+        self.analysis_memory_budget = DEFAULT_MEMORY_BUDGET
+        self.analysis_summary = {}
+
+        # analysis of the frames while the sweep is taken
+        self.live_enable = False
+        self.live_source = "zmq"
+        self.live_endpoint = LIVE_VIEW_ENDPOINT
+        self.live_abort_on_failure = True
+        # fraction of the sweep to take before judging it, and of columns allowed to be unchanged
+        self.live_min_fraction = 0.1
+        self.live_max_stuck_fraction = 0.5
+        self.live_analyser = None
+        self.abort_requested = False
+        self.failure_reason = None
+        self.steps_triggered = 0
+
+        # coarse to fine scan, sampling densely only where the codes change
+        self.adaptive_enable = False
+        self.adaptive_stride = 64
+        self.adaptive_point_budget = 1024
+        self.adaptive_points = 0
+
+        # the calibration being, or last, taken: its type, the key of the conditions it was
+        # started under, the index in the data file of its first frame, and the step of each
+        # frame, or None if the steps were taken in order
+        self.acquisition = None
+
+        # results of every calibration run, reused rather than reduced again from the raw frames
+        self.results_store = None
+        self.comparison = {}
 
         self.param_tree = ParameterTree({
             "start_calibrate": (None, self.adc_calibrate),
@@ -61,8 +112,38 @@ class QemCalibrator():
                 "max": (lambda: self.max_calibration, self.set_max_calib),
                 "min": (lambda: self.min_calibration, self.set_min_calib),
                 "step": (lambda: self.calibration_step, self.set_calib_step),
+                "dwell": (lambda: self.calibration_dwell, self.set_calib_dwell, {"units": "s"}),
                 "current": (lambda: self.calibration_value, None)
-            }
+            },
+            "analysis": {
+                "file": (lambda: self.analysis_file, None),
+                "memory_budget": (lambda: self.analysis_memory_budget // (1024 * 1024),
+                                  self.set_analysis_memory_budget, {"units": "MB"}),
+                "summary": (lambda: self.analysis_summary, None)
+            },
+            "live_analysis": {
+                "enable": (lambda: self.live_enable, self.set_live_enable),
+                "source": (lambda: self.live_source, self.set_live_source),
+                "endpoint": (lambda: self.live_endpoint, self.set_live_endpoint),
+                "abort_on_failure": (lambda: self.live_abort_on_failure,
+                                     self.set_live_abort_on_failure),
+                "status": (lambda: self.live_analyser.get_status()
+                           if self.live_analyser is not None else {}, None)
+            },
+            "adaptive": {
+                "enable": (lambda: self.adaptive_enable, self.set_adaptive_enable),
+                "initial_stride": (lambda: self.adaptive_stride, self.set_adaptive_stride),
+                "point_budget": (lambda: self.adaptive_point_budget, self.set_adaptive_point_budget),
+                "points": (lambda: self.adaptive_points, None)
+            },
+            "store": {
+                "runs": (lambda: self.get_results_store().list_runs(), None),
+                "plot": (None, self.plot_stored_run),
+                "compare": (None, self.compare_stored_runs),
+                "comparison": (lambda: self.comparison, None)
+            },
+            "abort": (None, self.abort_calibration),
+            "failure": (lambda: self.failure_reason, None)
         })
 
     def set_max_calib(self, value):
@@ -74,6 +155,71 @@ class QemCalibrator():
     def set_calib_step(self, value):
         self.calibration_step = value
 
+    def set_calib_dwell(self, value):
+        self.calibration_dwell = float(value) if value > 0 else self.calibration_dwell
+
+    def set_analysis_memory_budget(self, value):
+        self.analysis_memory_budget = max(1, int(value)) * 1024 * 1024
+
+    def set_live_enable(self, value):
+        self.live_enable = bool(value)
+
+    def set_live_source(self, value):
+        value = str(value).lower().strip()
+        if value not in ("zmq", "swmr"):
+            logging.warning("Live analysis source %s not recognised", value)
+            return
+        self.live_source = value
+
+    def set_live_endpoint(self, value):
+        self.live_endpoint = str(value)
+
+    def set_live_abort_on_failure(self, value):
+        self.live_abort_on_failure = bool(value)
+
+    def set_adaptive_enable(self, value):
+        self.adaptive_enable = bool(value)
+
+    def set_adaptive_stride(self, value):
+        self.adaptive_stride = max(1, int(value))
+
+    def set_adaptive_point_budget(self, value):
+        self.adaptive_point_budget = max(2, int(value))
+
+    def abort_calibration(self, put_data=None):
+        """Stop the calibration sweep in progress after the current step."""
+        logging.warning("Calibration aborted")
+        self.abort_requested = True
+
+    def get_results_store(self):
+        """Store of calibration results in the current data directory."""
+        directory = os.path.join(self.qem_daq.file_dir, STORE_DIR)
+        if self.results_store is None or self.results_store.directory != directory:
+            self.results_store = CalibrationStore(directory)
+        return self.results_store
+
+    def get_store_key(self, calibrate_type, adaptive=None):
+        """Key of the conditions a calibration of the given type is taken under.
+
+        @param adaptive: whether the steps were taken out of order, or None for the current setting
+        """
+        vector_file = self.qem_fems[0].vector_file if self.qem_fems else None
+        vector_hash = vector_file.get_hash() if vector_file is not None else None
+        biases = vector_file.bias if vector_file is not None else None
+        return make_key(calibrate_type, self.min_calibration, self.max_calibration,
+                        self.calibration_step, self.coarse_calibration_value,
+                        vector_hash, biases,
+                        self.adaptive_enable if adaptive is None else adaptive)
+
+    def get_data_source(self, first_frame, frames):
+        """Describe the frames of the data file a calibration run was reduced from."""
+        file_name = self.get_h5_file()
+        return {
+            "data_file": os.path.abspath(file_name) if file_name != "not_found" else None,
+            "first_frame": int(first_frame),
+            "frames": int(frames)
+        }
+
     def initialize(self, adapters):
         """Receives references to the other adapters needed for calibration
         """
@@ -143,13 +289,12 @@ class QemCalibrator():
             return
         register_name = "AUXSAMPLE_{}".format(calibrate_type)
         logging.debug(register_name)
-        self.qem_daq.start_acquisition(self.max_calibration)
-        for fem in self.qem_fems:
-            fem.setup_camera()
-            fem.get_aligner_status()  # TODO: is this required?
-            locked = fem.get_idelay_lock_status()
-            if not locked:
-                fem.load_vectors_from_file()
+        if self.adaptive_enable:
+            # the number of frames depends on the curves, but is at most the point budget
+            self.qem_daq.start_acquisition(self.adaptive_point_budget)
+        else:
+            self.qem_daq.start_acquisition(self.max_calibration)
+        run_on_fems(self.qem_fems, QemFem.prepare_for_acquisition, "calibration setup")
         # Set other register to default value for calibration
         if calibrate_type == "COARSE":
             logging.debug("Setting fine auxsample to max")
@@ -157,22 +302,278 @@ class QemCalibrator():
         else:
             self.set_backplane_register("AUXSAMPLE_COARSE", self.coarse_calibration_value)
 
+        self.acquisition = {
+            "type": calibrate_type.lower(),
+            # the vectors, biases and coarse value may change before the frames are analysed
+            "key": self.get_store_key(calibrate_type.lower()),
+            "first_frame": int(getattr(self.qem_daq, "frame_start_acquisition", 0)),
+            "steps": [] if self.adaptive_enable else None,
+            "failure_reason": None
+        }
         self.calibration_value = self.min_calibration
+        self.abort_requested = False
+        self.failure_reason = None
+        self.steps_triggered = 0
+        self.live_analyser = None
+        if self.live_enable or self.adaptive_enable:
+            self.start_live_analysis(calibrate_type.lower())
+
+        # the fems take one frame per trigger
+        self.qem_fems[0].frame_gate_settings(0, 0)
+        if self.adaptive_enable:
+            self.adaptive_calibration_sweep(register_name)
+            return
+        sweep_start = self.start_backplane_sweep(register_name)
+        if sweep_start is not None:
+            self.calibration_sweep(register_name, sweep_start)
+        else:
+            logging.warning("Backplane sweep unavailable, setting each calibration step in turn")
+            IOLoop.instance().add_callback(self.calibration_loop, register=register_name)
 
-        IOLoop.instance().add_callback(self.calibration_loop, register=register_name)
+    def start_backplane_sweep(self, register, values=None):
+        """Start the backplane stepping the calibration register itself.
+
+        @param values: register values to set in turn, or None for every step of the calibration
+        @returns: estimated time the first step was set, or None if the sweep could not be started
+        """
+        settings = {"register": register, "dwell": self.calibration_dwell}
+        if values is None:
+            settings.update({
+                "start": self.min_calibration,
+                "stop": self.max_calibration,
+                "step": self.calibration_step
+            })
+        else:
+            settings["values"] = list(values)
+        data = {"sweep": {"start": settings}}
+        sent = time.time()
+        response = self.proxy_adapter.put("backplane", ApiAdapterRequest(data))
+        received = time.time()
+        if response.status_code != 200:
+            logging.error("BACKPLANE SWEEP START FAILED: %s", response.data)
+            return None
+        if received - sent > self.calibration_dwell / 2:
+            logging.warning("Backplane sweep took %.3fs to start, longer than half the dwell time"
+                            " of %.3fs: frames may not match their steps",
+                            received - sent, self.calibration_dwell)
+        # the first step is set while the request is in flight
+        return (sent + received) / 2
+
+    def get_voltages(self, calibrate_type):
+        data_size = self.max_calibration - self.min_calibration
+        if calibrate_type == "fine":
+            return self.generate_fine_voltages(data_size)
+        return self.generate_coarse_voltages(data_size)
+
+    def start_live_analysis(self, calibrate_type):
+        """Start analysing the frames of the sweep as they are taken."""
+        self.live_analyser = LiveCalibrationAnalyser(
+            calibrate_type, self.get_voltages(calibrate_type), self.live_source,
+            endpoint=self.live_endpoint,
+            file_pattern="{}/*{}*h5".format(self.qem_daq.file_dir, self.qem_daq.file_name),
+            first_frame=self.acquisition["first_frame"],
+            memory_budget=self.analysis_memory_budget)
+        self.live_analyser.start()
+
+    def check_live_analysis(self, steps_triggered):
+        """Check the live analysis, aborting the sweep if it has failed and abort is enabled."""
+        if self.live_analyser is None or self.failure_reason is not None:
+            return
+        total_steps = self.live_analyser.frames_expected
+        reason = self.live_analyser.check(
+            steps_triggered, max(2, int(total_steps * self.live_min_fraction)),
+            self.live_max_stuck_fraction)
+        if reason is not None:
+            self.failure_reason = reason
+            logging.error("Calibration sweep failing: %s", reason)
+            if self.live_abort_on_failure:
+                self.abort_requested = True
+
+    def finish_live_analysis(self, calibrate_type):
+        """Wait for the last frames of the sweep, then save and plot the analysis."""
+        # kept with the acquisition, so its results are stored as incomplete if it failed
+        self.acquisition["failure_reason"] = self.failure_reason or (
+            "calibration aborted" if self.abort_requested else None)
+        live = self.live_analyser
+        if live is None:
+            return
+        if not self.abort_requested and not live.wait_for_frames(1.0 + self.calibration_dwell * 10):
+            logging.warning("Live calibration analysis missing %d of %d frames",
+                            live.frames_expected - live.frames_placed, live.frames_expected)
+        live.stop()
+        if live.analyser is None:
+            logging.error("Live calibration analysis received no frames")
+            return
+        source = self.get_data_source(self.acquisition["first_frame"], live.frames_expected)
+        results = self.save_analysis(live.analyser, calibrate_type, self.acquisition["key"],
+                                     source, self.acquisition["failure_reason"])
+        self.save_plot(results, calibrate_type)
+
+    @run_on_executor(executor='thread_executor')
+    def calibration_sweep(self, register, sweep_start):
+        """Take a frame at each step of a backplane sweep through every calibration step."""
+        self.late_triggers = 0
+        self.trigger_sweep(
+            range(self.min_calibration, self.max_calibration, self.calibration_step), sweep_start)
+        self.finish_live_analysis(register.split("_")[-1].lower())
+        logging.debug("Calibration Complete")
+
+    @run_on_executor(executor='thread_executor')
+    def adaptive_calibration_sweep(self, register):
+        """Sweep coarsely, then sample densely only where the codes change.
+
+        The first pass samples every adaptive_stride steps. Each later pass fills in the intervals
+        between the values sampled so far where any column changed code, at a quarter of the
+        previous stride, until the stride reaches calibration_step or the point budget runs out.
+        """
+        self.late_triggers = 0
+        live = self.live_analyser
+        stride = max(self.adaptive_stride, self.calibration_step)
+        values = coarse_scan_values(self.min_calibration, self.max_calibration, stride)
+        values = values[:self.adaptive_point_budget]
+        sampled = []
+        while values:
+            steps = [value - self.min_calibration for value in values]
+            live.add_steps(steps)
+            self.acquisition["steps"].extend(steps)
+            sweep_start = self.start_backplane_sweep(register, values)
+            if sweep_start is None:
+                self.failure_reason = "backplane sweep unavailable for adaptive calibration"
+                break
+            if not self.trigger_sweep(values, sweep_start):
+                break
+            if not live.wait_for_frames(1.0 + self.calibration_dwell * 10):
+                # the intervals either side of a missing frame are sampled again
+                logging.warning("Adaptive calibration pass missing %d frames",
+                                live.frames_expected - live.frames_placed)
+            sampled = sorted(sampled + values)
+            if stride <= self.calibration_step:
+                break
+            stride = max(self.calibration_step, stride // ADAPTIVE_REFINE_FACTOR)
+            curves = live.curves([value - self.min_calibration for value in sampled])
+            values = refine_scan_values(sampled, curves, stride,
+                                        self.adaptive_point_budget - len(sampled))
+            logging.debug("Adaptive calibration refining %d points at a stride of %d",
+                          len(values), stride)
+        self.adaptive_points = len(sampled)
+        # the acquisition was started for the whole point budget
+        self.qem_daq.stop_acquisition()
+        self.finish_live_analysis(register.split("_")[-1].lower())
+        logging.debug("Adaptive Calibration Complete after %d points", self.adaptive_points)
+
+    def trigger_sweep(self, values, sweep_start):
+        """Take a frame in the middle of each step of a backplane sweep.
+
+        The backplane sets step n at about sweep_start + n * dwell, so each frame is triggered at
+        the middle of its step, timed by the calibrator alone. The backplane records any step it
+        sets too late for its frame. Its progress is read every LIVE_CHECK_STEPS frames, to stop
+        early if it has aborted or fallen behind, and once the sweep has finished.
+        @returns: True if every frame was taken at its step, False if the sweep was aborted or
+        some frames may not match their steps
+        """
+        for index, value in enumerate(values):
+            if self.abort_requested:
+                break
+            trigger_time = sweep_start + (index + 0.5) * self.calibration_dwell
+            delay = trigger_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.calibration_dwell / 2:
+                self.late_triggers += 1
+            self.calibration_value = value
+            self.qem_fems[0].frame_gate_trigger()
+            self.steps_triggered += 1
+            # checked just after a trigger, leaving a whole dwell before the next one is due
+            if self.steps_triggered % LIVE_CHECK_STEPS == 0:
+                self.check_live_analysis(self.steps_triggered)
+                self.check_backplane_sweep(index + 1, len(values))
+        if self.abort_requested:
+            self.proxy_adapter.put("backplane", ApiAdapterRequest({"sweep": {"abort": True}}))
+            return False
+        # let the backplane finish the last step before asking how the sweep went
+        time.sleep(max(0, sweep_start + len(values) * self.calibration_dwell - time.time()))
+        return self.check_sweep_complete(len(values))
+
+    def check_backplane_sweep(self, steps_triggered, total_steps):
+        """Abort the calibration if the backplane sweep has stopped or fallen behind the frames.
+
+        A sweep whose progress cannot be read is left to run, and checked again at the end.
+        """
+        sweep = self.get_backplane_sweep()
+        steps_done = sweep.get("steps_done")
+        if sweep.get("aborted"):
+            reason = "backplane sweep aborted after {} of {} steps: {}".format(
+                steps_done, total_steps, sweep.get("error"))
+        elif steps_done is not None and steps_done < steps_triggered:
+            reason = "backplane sweep was at step {} of {} after {} frames".format(
+                steps_done, total_steps, steps_triggered)
+        else:
+            return
+        self.failure_reason = reason
+        logging.error("Calibration sweep failed: %s", reason)
+        self.abort_requested = True
+
+    def check_sweep_complete(self, total_steps):
+        """Check that every frame of a finished sweep was taken at its step.
+
+        @returns: True if so, otherwise False, with the calibration failed
+        """
+        problems = []
+        if self.late_triggers:
+            problems.append("{} frames triggered late".format(self.late_triggers))
+        sweep = self.get_backplane_sweep()
+        if not sweep:
+            problems.append("backplane sweep progress could not be read")
+        else:
+            late_steps = sweep.get("late_step_indices") or []
+            if late_steps:
+                problems.append("backplane set {} steps late, the first at step {}".format(
+                    len(late_steps), late_steps[0] + 1))
+            if sweep.get("aborted"):
+                problems.append("backplane sweep aborted: {}".format(sweep.get("error")))
+            elif sweep.get("steps_done") != total_steps:
+                problems.append("backplane sweep set {} of {} steps".format(
+                    sweep.get("steps_done"), total_steps))
+        if not problems:
+            return True
+        # kept with any failure of the live analysis, which does not abort the sweep if disabled
+        self.failure_reason = "; ".join([reason for reason in [self.failure_reason] if reason]
+                                        + problems)
+        logging.error("Calibration sweep failed: %s", self.failure_reason)
+        return False
+
+    def get_backplane_sweep(self):
+        """Get the progress of the backplane sweep, or an empty dict if it cannot be read."""
+        response = self.proxy_adapter.get("backplane/sweep", ApiAdapterRequest(None))
+        if response.status_code != 200:
+            return {}
+        return response.data.get("sweep", response.data)
 
     def calibration_loop(self, register):
+        steps_triggered = (self.calibration_value - self.min_calibration) // self.calibration_step
+        if steps_triggered % LIVE_CHECK_STEPS == 0:
+            self.check_live_analysis(steps_triggered)
+        if self.abort_requested:
+            self.thread_executor.submit(self.finish_live_analysis, register.split("_")[-1].lower())
+            return
         self.set_backplane_register(register, self.calibration_value)
-        self.qem_fems[0].frame_gate_settings(0, 0)  # set fem to take a single frame
         self.qem_fems[0].frame_gate_trigger()
         self.calibration_value += self.calibration_step
         if self.calibration_value < self.max_calibration:
             IOLoop.instance().call_later(0, self.calibration_loop, register)
         else:
+            # waits for the last frames, so keep it off the IOLoop
+            self.thread_executor.submit(self.finish_live_analysis, register.split("_")[-1].lower())
             logging.debug("Calibration Complete")
 
     @run_on_executor(executor='thread_executor')
     def adc_plot(self, plot_type):
+        """Analyse and plot the frames of the last calibration of a type.
+
+        The frames are those of the acquisition the calibrator took, in the order their steps were
+        taken. Without one, as after a restart, the last frames of the file are taken to be a
+        calibration taken in order.
+        """
         if self.qem_daq.in_progress:
             logging.warning("Cannot Start Plot: Calibrator is Busy")
             return
@@ -181,28 +582,123 @@ class QemCalibrator():
             logging.warning("Cannot Start Plot: Plot type %s not recognised", plot_type)
             return
         logging.debug("Start Plot %s", plot_type)
-        averages = []
         file_name = self.get_h5_file()
-        f = h5py.File(file_name, 'r')
-        dataset_key = f.keys()[0]
-        dataset = f[dataset_key]
-        data_size = self.max_calibration - self.min_calibration
-        dataset = dataset[-data_size:]
-        logging.debug("GOT %d FRAMES", len(dataset))
-        if plot_type == "fine":
-            voltages = self.generate_fine_voltages(data_size)
-            # assign function used repeatedly to a variable so we don't have to keep checking
-            # plot_type in the for loop below
-            get_bits_column = self.get_fine_bits_column
+        voltages = self.get_voltages(plot_type)
+        data_size = len(voltages)
+        store = self.get_results_store()
+        acquisition = self.acquisition
+        if acquisition is not None and acquisition["type"] != plot_type:
+            acquisition = None
+        if acquisition is not None:
+            steps = acquisition["steps"]
+            key = acquisition["key"]
+            failure_reason = acquisition["failure_reason"]
         else:
-            voltages = self.generate_coarse_voltages(data_size)
-            get_bits_column = self.get_coarse_bits_column
-        f.close()
+            steps = None
+            key = self.get_store_key(plot_type, adaptive=False)
+            failure_reason = None
+        with h5py.File(file_name, 'r') as f:
+            dataset = frame_dataset(f)
+            if acquisition is not None:
+                first_frame = acquisition["first_frame"]
+                frames = len(steps) if steps is not None else data_size
+            else:
+                logging.warning("No %s calibration taken since start up: plotting the last %d "
+                                "frames as steps taken in order", plot_type, data_size)
+                first_frame = max(0, len(dataset) - data_size)
+                frames = data_size
+            frames = max(0, min(frames, len(dataset) - first_frame))
+            logging.debug("GOT %d FRAMES", frames)
+            source = self.get_data_source(first_frame, frames)
+            # the same frames, taken under the same conditions, have already been analysed;
+            # a failed sweep's own frames may be, but other lookups skip its results
+            entry = store.find(key, source, include_incomplete=failure_reason is not None)
+            if entry is None:
+                # analyse every column in the same pass over the file
+                analyser = CalibrationAnalyser.for_type(plot_type, voltages, dataset.shape[-1])
+                analyser.add_dataset(dataset, first_frame, self.analysis_memory_budget, steps)
         logging.debug("Closed file")
-        for frame in dataset:
-            column = get_bits_column(list(frame), 33)
-            average = sum(column) / len(column)
-            averages.append(average)
+        if entry is not None:
+            logging.debug("Reusing stored calibration run %s", entry["id"])
+            results = self.load_stored_run(entry)
+        else:
+            results = self.save_analysis(analyser, plot_type, key, source, failure_reason)
+        self.save_plot(results, plot_type)
+
+    def load_stored_run(self, entry):
+        """Load the results of a stored run, making it the current analysis."""
+        results = self.get_results_store().get(entry["id"])
+        self.analysis_file = os.path.join(self.get_results_store().directory, entry["file"])
+        self.analysis_summary = entry["summary"]
+        return results
+
+    @run_on_executor(executor='thread_executor')
+    def plot_stored_run(self, run_id):
+        """Plot a stored run, without going back to its raw frames."""
+        entry = self.get_results_store().get_entry(run_id)
+        if entry is None:
+            logging.warning("Cannot Plot: No stored calibration run %s", run_id)
+            return
+        self.save_plot(self.load_stored_run(entry), entry["key"]["type"])
+
+    @run_on_executor(executor='thread_executor')
+    def compare_stored_runs(self, run_ids):
+        """Overlay the PLOT_COLUMN curves of stored runs, and compare their fits to the first.
+
+        @param run_ids: list, or comma separated string, of the ids of the runs to compare
+        """
+        if not isinstance(run_ids, list):
+            run_ids = [run_id.strip() for run_id in str(run_ids).split(",") if run_id.strip()]
+        store = self.get_results_store()
+        runs = []
+        for run_id in run_ids:
+            entry = store.get_entry(run_id)
+            if entry is None:
+                logging.warning("Cannot Compare: No stored calibration run %s", run_id)
+                return
+            runs.append((entry, store.get(run_id)))
+        if not runs:
+            return
+
+        fig = plt.figure()
+        ax = fig.add_subplot(1, 1, 1)
+        for entry, results in runs:
+            voltages, averages = self.plot_points(results)
+            ax.plot(voltages, averages, '-', label=entry["id"])
+        ax.grid(True)
+        ax.legend()
+        ax.set_xlabel('Voltage')
+        ax.set_ylabel("value")
+        fig.savefig("static/img/calibration_compare.png", dpi=100)
+        fig.clf()
+
+        _, reference = runs[0]
+        comparison = {}
+        for entry, results in runs[1:]:
+            gains = np.abs(results["gains"] - reference["gains"])
+            offsets = np.abs(results["offsets"] - reference["offsets"])
+            # columns fit in both runs
+            fit = np.isfinite(gains) & np.isfinite(offsets)
+            comparison[entry["id"]] = {
+                "columns": int(fit.sum()),
+                "median_gain_difference": float(np.median(gains[fit])) if fit.any() else None,
+                "max_gain_difference": float(gains[fit].max()) if fit.any() else None,
+                "median_offset_difference": float(np.median(offsets[fit])) if fit.any() else None,
+                "max_offset_difference": float(offsets[fit].max()) if fit.any() else None
+            }
+        self.comparison = {"reference": runs[0][0]["id"], "runs": comparison}
+        logging.debug("Calibration comparison: %s", self.comparison)
+
+    @staticmethod
+    def plot_points(results):
+        """Voltages and mean codes of PLOT_COLUMN, at the steps with a frame."""
+        averages = results["curves"][:, PLOT_COLUMN]
+        added = np.isfinite(averages)
+        return results["voltages"][added], averages[added]
+
+    def save_plot(self, results, plot_type):
+        """Plot the curve of PLOT_COLUMN from the results of an analysis."""
+        voltages, averages = self.plot_points(results)
         logging.debug("Got Averages")
 
         fig = plt.figure()
@@ -216,6 +712,30 @@ class QemCalibrator():
         fig.clf()
         logging.debug("Plot Complete")
 
+    def save_analysis(self, analyser, plot_type, key, source=None, failure_reason=None):
+        """Store the curves, offsets, gains and missing codes of every column.
+
+        @param key: conditions the frames were taken under, from get_store_key when the
+        calibration was started
+        @param source: the frames the analysis was reduced from, from get_data_source
+        @param failure_reason: why the sweep failed, if it did, to store the run as incomplete
+        """
+        results = analyser.results()
+        missing = results["missing_code_count"]
+        self.analysis_summary = {
+            "type": plot_type,
+            "frames": analyser.frames_added,
+            "columns": analyser.columns,
+            "columns_unfit": int(np.count_nonzero(np.isnan(results["gains"]))),
+            "columns_with_missing_codes": int(np.count_nonzero(missing)),
+            "missing_codes": int(missing.sum())
+        }
+        store = self.get_results_store()
+        entry = store.put(key, results, source, self.analysis_summary, failure_reason)
+        self.analysis_file = os.path.join(store.directory, entry["file"])
+        logging.debug("Calibration analysis: %s", self.analysis_summary)
+        return results
+
     def set_backplane_register(self, register, value):
         """Sets the value of a resistor on the backplane
         """
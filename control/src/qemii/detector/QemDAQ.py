@@ -109,6 +109,9 @@ class QemDAQ():
         self.set_file_writing(True)
 
     def acquisition_check_loop(self):
+        if not self.in_progress:
+            # stopped before all the frames were written
+            return
         hdf_status = self.get_od_status('fp').get('hdf', {"frames_written": 0})
         if hdf_status['frames_written'] == self.frame_end_acquisition:
             self.stop_acquisition()
@@ -21,8 +21,9 @@ from odin_data.frame_processor_adapter import FrameProcessorAdapter
 from odin_data.frame_receiver_adapter import FrameReceiverAdapter
 
 from qemii.detector.QemCalibrator import QemCalibrator
-from qemii.detector.QemFem import QemFem
+from qemii.detector.QemFem import QemFem, run_on_fems
 from qemii.detector.QemDAQ import QemDAQ
+from qemii.detector.VectorFile import VectorFile
 
 
 class QemDetectorAdapter(ApiAdapter):
@@ -146,6 +147,10 @@ class QemDetector():
         self.acq_gap = options.get("acquisition_frame_gap", defaults.acq_gap)
         odin_data_dir = options.get("odin_data_dir", defaults.odin_data_dir)
         odin_data_dir = os.path.expanduser(odin_data_dir)
+        # options are strings when read from the config file
+        shared_rdma = str(options.get("shared_rdma", defaults.shared_rdma)).lower() in ("true", "1")
+        cache_size = float(options.get("vector_file_cache_mb", defaults.vector_file_cache_mb))
+        VectorFile.cache.set_limit(cache_size * 1024 * 1024)
 
         self.daq = QemDAQ(self.file_dir, self.file_name, odin_data_dir=odin_data_dir)
 
@@ -168,7 +173,8 @@ class QemDetector():
                     fem_dict.get("camera_data_ip_addr", defaults.fem["camera_data_ip"]),
                     # vector file only required for the "main" FEM, fem_0
                     self.vector_file_dir,
-                    self.vector_file
+                    self.vector_file,
+                    shared_rdma
                 ))
 
         if not self.fems:  # if self.fems is empty
@@ -181,14 +187,13 @@ class QemDetector():
                 server_data_ip_addr=defaults.fem["server_data_ip"],
                 camera_data_ip_addr=defaults.fem["camera_data_ip"],
                 vector_file_dir=self.vector_file_dir,
-                vector_file=self.vector_file
+                vector_file=self.vector_file,
+                shared_rdma=shared_rdma
             ))
 
+        run_on_fems(self.fems, QemFem.connect_and_setup, "connect and setup")
         fem_tree = {}
         for fem in self.fems:
-            fem.connect()
-            fem.setup_camera()
-
             fem_tree["fem_{}".format(fem.id)] = fem.param_tree
 
         self.file_writing = False
@@ -254,12 +259,7 @@ class QemDetector():
             logging.warning("Cannot Start Acquistion: Already in progress")
             return
         self.daq.start_acquisition(self.acq_num)
-        for fem in self.fems:
-            fem.setup_camera()
-            fem.get_aligner_status()  # TODO: is this required?
-            locked = fem.get_idelay_lock_status()
-            if not locked:
-                fem.load_vectors_from_file()
+        run_on_fems(self.fems, QemFem.prepare_for_acquisition, "acquisition setup")
         self.fems[0].frame_gate_settings(self.acq_num - 1, self.acq_gap)
         self.fems[0].frame_gate_trigger()
 
@@ -271,6 +271,8 @@ class QemDetectorDefaults():
         self.save_file = "default_file"
         self.vector_file_dir = "/aeg_sw/work/projects/qem/python/03052018/"
         self.vector_file = "QEM_D4_198_ADC_10_icbias30_ifbias24.txt"
+        self.vector_file_cache_mb = 64
+        self.shared_rdma = False
         self.odin_data_dir = "~/develop/projects/qemii/install/"
         self.acq_num = 4096
         self.acq_gap = 1
@@ -0,0 +1,282 @@
+"""QEM Eye Scan.
+
+Finds the receiver idelay taps and shift register settings of a FEM-II automatically, rather than
+by trial and error.
+
+The receiver only locks while all four lanes are within their eyes, so the idelay scan first sweeps
+every lane together through all 32 taps, to find taps common to every eye. It then sweeps each lane
+through all 32 taps in turn, holding the other lanes at the centre of the common eye, and records
+whether the receiver is locked and the lane's channel aligned at each one.
+
+The shift register scan then sweeps the data lanes, and then the cdn lanes, of both channels
+together through every sub-cycle (SCSR) and cycle (IVSR) shift, with the idelay taps at the eye
+centres just found. Channels are aligned independently, so each channel's aligner status shows
+whether its own lane passed. The lanes not being swept are held at their current settings, so the
+scan should follow setup_camera.
+
+Each point costs one batched write datagram and single reads of the lock and aligner status
+registers.
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import logging
+import time
+from collections import namedtuple
+
+from tornado.concurrent import run_on_executor
+
+from odin.adapters.parameter_tree import ParameterTree
+
+IDELAY_TAPS = 32
+SCSR_STEPS = 8
+ALIGNED = 0xFFFF
+
+LANES = ("data_1", "cdn_1", "data_0", "cdn_0")
+# the order of the lanes in the SCSR and IVSR words
+SHIFT_LANES = ("data_1", "data_0", "cdn_1", "cdn_0")
+
+# the receiver status measured at each point of the scan
+EyePoint = namedtuple("EyePoint", [
+    "locked",          # idelay lock flag
+    "aligner_status"   # aligner status words, as [aligner_status_1, aligner_status_0]
+])
+
+
+def find_eye_centre(passed):
+    """Find the centre of the longest run of passing points.
+
+    @param passed: list of pass/fail flags, in order of increasing delay
+    @returns: tuple of (index of the centre, width of the run), or (None, 0) if nothing passed
+    """
+    best_start, best_width = None, 0
+    start = None
+    for index, point in enumerate(list(passed) + [False]):
+        if point and start is None:
+            start = index
+        elif not point and start is not None:
+            if index - start > best_width:
+                best_start, best_width = start, index - start
+            start = None
+    if best_start is None:
+        return None, 0
+    return best_start + (best_width - 1) // 2, best_width
+
+
+def idelay_word(taps):
+    """Pack the idelay taps of each lane into the data_cdn_idelay word."""
+    return taps["data_1"] << 24 | taps["cdn_1"] << 16 | taps["data_0"] << 8 | taps["cdn_0"]
+
+
+def shift_word(shifts):
+    """Pack the SCSR or IVSR shift of each lane into its data_cdn word."""
+    return shifts["data_1"] << 24 | shifts["data_0"] << 16 | shifts["cdn_1"] << 8 | shifts["cdn_0"]
+
+
+def unpack_idelay_word(word):
+    return dict(zip(LANES, (word >> 24 & 0xFF, word >> 16 & 0xFF, word >> 8 & 0xFF, word & 0xFF)))
+
+
+def unpack_shift_word(word):
+    return dict(zip(SHIFT_LANES,
+                    (word >> 24 & 0xFF, word >> 16 & 0xFF, word >> 8 & 0xFF, word & 0xFF)))
+
+
+class QemEyeScan():
+    """Eye scan of the receiver lanes of a single FEM-II."""
+
+    def __init__(self, fem):
+        self.fem = fem
+        self.thread_executor = fem.thread_executor
+        self.in_progress = False
+        self.apply = True
+        self.settle_time = 0.001
+        self.ivsr_max = 31
+        self.results = {}
+
+        receiver = fem.rmda_addr["receiver"]
+        self.idelay_address = receiver | 0x02
+        self.load_address = receiver | 0x00
+        self.ivsr_address = receiver | 0x03
+        self.scsr_address = receiver | 0x05
+
+        self.param_tree = ParameterTree({
+            "start": (None, self.start),
+            "in_progress": (lambda: self.in_progress, None),
+            "apply": (lambda: self.apply, self.set_apply),
+            "settle_time": (lambda: self.settle_time, self.set_settle_time, {"units": "s"}),
+            "ivsr_max": (lambda: self.ivsr_max, self.set_ivsr_max),
+            "results": (lambda: self.results, None)
+        })
+
+    def set_apply(self, apply):
+        self.apply = bool(apply)
+
+    def set_settle_time(self, settle_time):
+        self.settle_time = float(settle_time)
+
+    def set_ivsr_max(self, ivsr_max):
+        self.ivsr_max = max(0, min(int(ivsr_max), 0xFF))
+
+    @run_on_executor(executor='thread_executor')
+    def start(self, put_data=None):
+        if self.in_progress:
+            logging.warning("FEM %d: Eye scan already in progress", self.fem.id)
+            return
+        self.scan()
+
+    def scan(self):
+        """Run the full eye scan, then apply the eye centres or restore the original settings.
+
+        @returns: dictionary of the pass/fail maps and chosen settings of each lane
+        """
+        original = self.get_current_settings()
+        self.in_progress = True
+        start = time.time()
+        self.points = 0
+        results = {"idelay_common": {}, "idelay": {}, "shift": {}, "applied": False}
+        try:
+            results["idelay_common"] = self.scan_idelay_common()
+            held = original["idelay"]
+            if results["idelay_common"]["centre"] is not None:
+                held = dict((lane, results["idelay_common"]["centre"]) for lane in LANES)
+            results["idelay"] = self.scan_idelay(held)
+            taps = dict(original["idelay"])
+            for lane, result in results["idelay"].items():
+                if result["centre"] is not None:
+                    taps[lane] = result["centre"]
+            results["shift"] = self.scan_shift(taps, original)
+
+            found = all(result["centre"] is not None for result in results["idelay"].values())
+            found = found and all(result["scsr"] is not None for result in results["shift"].values())
+            if self.apply and found:
+                self.set_lanes(taps,
+                               dict((lane, r["scsr"]) for lane, r in results["shift"].items()),
+                               dict((lane, r["ivsr"]) for lane, r in results["shift"].items()))
+                results["applied"] = True
+            else:
+                if self.apply:
+                    logging.warning("FEM %d: Eye scan found no eye on some lanes, "
+                                    "settings restored", self.fem.id)
+                self.set_lanes(original["idelay"], original["scsr"], original["ivsr"])
+        finally:
+            results["points"] = self.points
+            results["duration"] = time.time() - start
+            self.results = results
+            self.in_progress = False
+        logging.debug("FEM %d: Eye scan of %d points took %.3fs",
+                      self.fem.id, self.points, results["duration"])
+        return results
+
+    def get_current_settings(self):
+        """Get the settings to restore if the scan finds no eye.
+
+        The idelay taps are read back from the FEM. The shift registers cannot be read back, so
+        they are taken from the shadow registers, or are the setup_camera settings if the shadow
+        has been invalidated since they were written.
+        """
+        idelay = self.fem.x10g_rdma.read(self.fem.readback_addr[self.idelay_address],
+                                         'data_cdn_idelay word')
+        scsr = self.fem.register_shadow.get(self.scsr_address)
+        ivsr = self.fem.register_shadow.get(self.ivsr_address)
+        return {
+            "idelay": unpack_idelay_word(idelay),
+            "scsr": (unpack_shift_word(scsr) if scsr is not None
+                     else dict(zip(SHIFT_LANES, self.fem.DEFAULT_SCSR))),
+            "ivsr": (unpack_shift_word(ivsr) if ivsr is not None
+                     else dict(zip(SHIFT_LANES, self.fem.DEFAULT_IVSR)))
+        }
+
+    def scan_idelay_common(self):
+        """Sweep every lane together through each idelay tap."""
+        passed = []
+        for tap in range(IDELAY_TAPS):
+            self.write(self.idelay_writes(dict((lane, tap) for lane in LANES)))
+            passed.append(self.measure().locked)
+        centre, width = find_eye_centre(passed)
+        return {"passed": passed, "centre": centre, "width": width}
+
+    def scan_idelay(self, held):
+        """Sweep each lane through every idelay tap, with the other lanes held."""
+        results = {}
+        for lane in LANES:
+            taps = dict(held)
+            passed = []
+            for tap in range(IDELAY_TAPS):
+                taps[lane] = tap
+                self.write(self.idelay_writes(taps))
+                status = self.measure()
+                passed.append(status.locked and self.channel_aligned(status, lane))
+            centre, width = find_eye_centre(passed)
+            results[lane] = {"passed": passed, "centre": centre, "width": width}
+        return results
+
+    def scan_shift(self, taps, original):
+        """Sweep the data lanes, then the cdn lanes, of both channels through every shift.
+
+        The shift of a lane is ivsr * 8 + scsr data bits, so each lane's eye is found along that
+        combined axis.
+        """
+        self.write(self.idelay_writes(taps))
+        results = {}
+        for lanes in (("data_1", "data_0"), ("cdn_1", "cdn_0")):
+            scsr = dict(original["scsr"])
+            ivsr = dict(original["ivsr"])
+            passed = dict((lane, []) for lane in lanes)
+            for ivsr_value in range(self.ivsr_max + 1):
+                for scsr_value in range(SCSR_STEPS):
+                    for lane in lanes:
+                        scsr[lane] = scsr_value
+                        ivsr[lane] = ivsr_value
+                    self.write(self.shift_writes(scsr, ivsr))
+                    status = self.measure()
+                    for lane in lanes:
+                        passed[lane].append(self.channel_aligned(status, lane))
+            for lane in lanes:
+                centre, width = find_eye_centre(passed[lane])
+                results[lane] = {
+                    # rows of ivsr, columns of scsr
+                    "passed": [passed[lane][row:row + SCSR_STEPS]
+                               for row in range(0, len(passed[lane]), SCSR_STEPS)],
+                    "scsr": centre % SCSR_STEPS if centre is not None else None,
+                    "ivsr": centre // SCSR_STEPS if centre is not None else None,
+                    "width": width
+                }
+        return results
+
+    def idelay_writes(self, taps):
+        """The idelay word followed by the load strobe, to go in a single datagram."""
+        return [
+            (self.idelay_address, idelay_word(taps)),
+            (self.load_address, 0x00),
+            (self.load_address, 0x10),
+            (self.load_address, 0x00)
+        ]
+
+    def shift_writes(self, scsr, ivsr):
+        return [(self.scsr_address, shift_word(scsr)), (self.ivsr_address, shift_word(ivsr))]
+
+    def write(self, writes):
+        self.fem.x10g_rdma.write_many(writes, 'eye scan')
+        # keep the shadow registers in step, so later writes of the same values are skipped
+        for address, data in writes:
+            if address != self.load_address:
+                self.fem.register_shadow[address] = data
+
+    def measure(self):
+        if self.settle_time:
+            time.sleep(self.settle_time)
+        self.points += 1
+        # single register reads, rather than a burst read of the whole status block
+        return EyePoint(locked=self.fem.get_idelay_lock_status() != 0,
+                        aligner_status=self.fem.get_aligner_status())
+
+    @staticmethod
+    def channel_aligned(status, lane):
+        # aligner status is [channel 1, channel 0]
+        return status.aligner_status[0 if lane.endswith("1") else 1] == ALIGNED
+
+    def set_lanes(self, taps, scsr, ivsr):
+        self.fem.set_idelay(taps["data_1"], taps["cdn_1"], taps["data_0"], taps["cdn_0"])
+        self.fem.set_scsr(scsr["data_1"], scsr["data_0"], scsr["cdn_1"], scsr["cdn_0"])
+        self.fem.set_ivsr(ivsr["data_1"], ivsr["data_0"], ivsr["cdn_1"], ivsr["cdn_0"])
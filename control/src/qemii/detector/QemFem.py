@@ -7,6 +7,9 @@ import logging
 import tornado
 import h5py
 import time
+import numpy as np
+from collections import namedtuple
+from contextlib import contextmanager
 from concurrent import futures
 from tornado.ioloop import IOLoop
 from tornado.concurrent import run_on_executor
@@ -15,7 +18,25 @@ from socket import error as socket_error
 from odin.adapters.parameter_tree import ParameterTree, ParameterTreeError
 
 from qemii.detector.VectorFile import VectorFile
-from qemii.detector.RdmaUDP import RdmaUDP
+from qemii.detector.RdmaUDP import RdmaUDP, RdmaTelemetry
+from qemii.detector.RdmaMux import RdmaMux
+from qemii.detector.QemEyeScan import QemEyeScan
+from qemii.detector.RegisterScript import RegisterScript
+
+
+# the QEM-II decoder supports up to 4 FEMs
+MAX_NUM_FEMS = 4
+
+# the receiver status block, read in a single burst
+STATUS_BLOCK_OFFSET = 0x10
+STATUS_BLOCK_SIZE = 0x10
+
+FemStatus = namedtuple("FemStatus", [
+    "idelay",          # loaded data_cdn_idelay taps, as [data_1, cdn_1, data_0, cdn_0]
+    "locked",          # idelay lock flag
+    "aligner_status",  # aligner status words, as [aligner_status_1, aligner_status_0]
+    "registers"        # the raw status block, receiver | 0x10 to 0x1F
+])
 
 
 class QemFemError(Exception):
@@ -24,18 +45,56 @@ class QemFemError(Exception):
     pass
 
 
+def run_on_fems(fems, function, description="setup"):
+    """Run a function for each FEM concurrently, returning once every FEM has finished.
+
+    Each FEM has its own RDMA connection, so the time taken is that of the slowest FEM rather
+    than the sum of them all.
+    @param fems: list of QemFem objects
+    @param function: function to call with each FEM
+    @param description: what the function does, for the error message
+    @returns: list of the results of the function, in the order of the FEMs
+    @raises QemFemError: listing every FEM that failed, once all of them have finished
+    """
+    if len(fems) == 1:
+        tasks = [(fems[0], None)]
+    else:
+        tasks = [(fem, QemFem.fem_executor.submit(function, fem)) for fem in fems]
+
+    results = []
+    errors = []
+    for fem, task in tasks:
+        try:
+            results.append(function(fem) if task is None else task.result())
+        except Exception as e:
+            logging.error("FEM %d %s failed: %s", fem.id, description, e)
+            errors.append("FEM {}: {}".format(fem.id, e))
+            results.append(None)
+    if errors:
+        raise QemFemError("{} failed on {} of {} FEMs. {}".format(
+            description, len(errors), len(fems), "; ".join(errors)))
+    return results
+
+
 class QemFem():
     """Qem Fem class. Represents a single FEM-II module.
 
     Controls and configures each FEM-II module ready for a DAQ via UDP.
     """
+    # receiver lane settings written by setup_camera, in the order of their setter's arguments
+    DEFAULT_IDELAY = (0, 0, 0, 0)
+    DEFAULT_SCSR = (7, 7, 7, 7)
+    DEFAULT_IVSR = (0, 0, 27, 27)
     thread_executor = futures.ThreadPoolExecutor(max_workers=1)
+    # shared by all FEMs, for running the same sequence on each at once
+    fem_executor = futures.ThreadPoolExecutor(max_workers=MAX_NUM_FEMS)
 
     def __init__(self, ip_address, port, fem_id,
                  server_ctrl_ip_addr, camera_ctrl_ip_addr,
                  server_data_ip_addr, camera_data_ip_addr,
                  vector_file_dir="/aeg_sw/work/projects/qem/python/03052018/",
-                 vector_file="QEM_D4_198_ADC_10_icbias30_ifbias24.txt"):
+                 vector_file="QEM_D4_198_ADC_10_icbias30_ifbias24.txt",
+                 shared_rdma=False):
 
         self.ip_address = ip_address
         self.port = port
@@ -44,6 +103,8 @@ class QemFem():
         self.x10g_stream = None
         self.server_ctrl_ip_addr = server_ctrl_ip_addr
         self.camera_ctrl_ip_addr = camera_ctrl_ip_addr
+        # share one RDMA socket pair with the other FEMs on the same server control address
+        self.shared_rdma = shared_rdma
 
         self.server_data_ip_addr = server_data_ip_addr
         self.camera_data_ip_addr = camera_data_ip_addr
@@ -73,6 +134,11 @@ class QemFem():
             "Unused_0":        0xE0000000,  # unused
             "Unused_1":        0xF0000000   # unused
         }
+        # the only registers known to read back what was written, by the address each is written
+        # to, and the address it is read back from. Scripts only verify these
+        self.readback_addr = {
+            self.rmda_addr["receiver"] | 0x02: self.rmda_addr["receiver"] | 0x12  # idelay taps
+        }
 
         #
         self.image_size_x    = 0x100
@@ -87,16 +153,68 @@ class QemFem():
         self.rdma_mtu = 8000
         #
         self.frame_time = 1
+        # last value written to each cached RDMA address, so unchanged writes can be skipped
+        self.register_shadow = {}
+        # 64 bit sequencer words last uploaded to the sequencer RAM, for delta uploads. Only kept
+        # once every word written has been read back, as RDMA writes are not acknowledged
+        self.uploaded_vectors = None
+        self.delta_upload = True
+        # RDMA transaction telemetry, kept across reconnects and only recorded while enabled
+        self.rdma_telemetry = RdmaTelemetry()
+        self.diagnostics_enabled = False
+        # acknowledged writes, only enabled once the FEM has answered a probe for them. Only the
+        # FemEmulator does at present
+        self.reliable_writes = False
+        self.eye_scan = QemEyeScan(self)
+        # recorded register scripts, by name, and the one being recorded
+        self.scripts = {}
+        self.recording = None
+        self.verify_scripts = False
+        self.script_result = {}
+        # the last status read, so fetching the tree never waits on the FEM
+        self.status = None
 
         param_tree_dict = {
             "ip_addr": (self.get_address, None),
             "port": (self.get_port, None),
             "setup_camera": (None, self.setup_camera),
-            "id": (self.id, None)
+            "id": (self.id, None),
+            "register_shadow": {
+                "entries": (lambda: len(self.register_shadow), None),
+                "invalidate": (None, self.invalidate_register_shadow)
+            },
+            "status": {
+                "refresh": (None, self.refresh_status),
+                "values": (lambda: self.status, None)
+            },
+            "reliable_writes": (lambda: self.reliable_writes, self.set_reliable_writes),
+            "eye_scan": self.eye_scan.param_tree,
+            "scripts": {
+                "names": (lambda: sorted(self.scripts), None),
+                "info": (lambda: dict((name, script.get_info())
+                                      for name, script in self.scripts.items()), None),
+                "recording": (lambda: self.recording.name if self.recording else None,
+                              self.start_recording),
+                "stop_recording": (None, self.stop_recording),
+                "run": (None, self.run_script),
+                "verify": (lambda: self.verify_scripts, self.set_verify_scripts),
+                "last_result": (lambda: self.script_result, None)
+            },
+            "diagnostics": {
+                "enable": (lambda: self.diagnostics_enabled, self.set_diagnostics_enabled),
+                "snapshot": (self.get_diagnostics, None),
+                "reset": (None, self.rdma_telemetry.reset)
+            }
         }
         if self.id == 0:
             param_tree_dict["vector_file"] = self.vector_file.param_tree
             param_tree_dict["load_vector_file"] = (None, self.load_vectors_from_file)
+            param_tree_dict["load_vector_file_full"] = (None, self.load_vectors_full)
+            param_tree_dict["delta_upload"] = {
+                "enable": (lambda: self.delta_upload, self.set_delta_upload),
+                # whether the next upload can skip unchanged words
+                "active": (lambda: self.delta_upload and self.uploaded_vectors is not None, None)
+            }
 
         self.param_tree = ParameterTree(param_tree_dict)
 
@@ -112,6 +230,37 @@ class QemFem():
     def set_selected_vector_file(self, file):
         self.selected_vector_file = file
 
+    def set_delta_upload(self, enabled):
+        self.delta_upload = bool(enabled)
+        if not self.delta_upload:
+            self.uploaded_vectors = None
+
+    def set_diagnostics_enabled(self, enabled):
+        self.diagnostics_enabled = bool(enabled)
+        if self.x10g_rdma is not None:
+            self.x10g_rdma.telemetry = self.rdma_telemetry if self.diagnostics_enabled else None
+
+    def set_reliable_writes(self, enabled):
+        self.reliable_writes = bool(enabled)
+        if self.x10g_rdma is not None:
+            self.enable_reliable_writes()
+
+    def enable_reliable_writes(self):
+        """Turn reliable writes on the connection on or off, checking the FEM supports them.
+
+        If the FEM does not answer the probe, reliable writes stay off.
+        """
+        if self.reliable_writes and not self.x10g_rdma.probe_reliable_writes():
+            logging.warning("FEM %d does not acknowledge reliable writes. They stay disabled",
+                            self.id)
+            self.reliable_writes = False
+        self.x10g_rdma.reliable = self.reliable_writes
+
+    def get_diagnostics(self):
+        """Get a snapshot of the RDMA telemetry, with the address regions named."""
+        region_names = dict((base, name) for name, base in self.rmda_addr.items())
+        return self.rdma_telemetry.snapshot(region_names)
+
     def get_address(self):
         return self.ip_address
 
@@ -131,7 +280,7 @@ class QemFem():
         self.set_10g_mtu('data', 7344)
         self.set_image_size(102, 288, 11, 16)
         #set idelay in 1 of 32 80fs steps  - d1, d0, c1, c0
-        self.set_idelay(0,0,0,0)
+        self.set_idelay(*self.DEFAULT_IDELAY)
         # time.sleep(1)
         locked = self.get_idelay_lock_status() != 0
         if locked:
@@ -142,46 +291,189 @@ class QemFem():
         # set shift register delay in 1 of 16 divide by 8 clock steps - d1, d0, c1, c0
         #
         # Shift 72 + 144 bits
-        self.set_scsr(7,7,7,7)		# sub-cycle (1 bit)
-        self.set_ivsr(0,0,27,27)		# cycle (8 bits)
+        self.set_scsr(*self.DEFAULT_SCSR)		# sub-cycle (1 bit)
+        self.set_ivsr(*self.DEFAULT_IVSR)		# cycle (8 bits)
         
         logging.debug("SETTING UP CAMERA: DONE")
     #Rob Halsall Code#
+
+    def connect_and_setup(self):
+        self.connect()
+        self.setup_camera()
+
+    def prepare_for_acquisition(self):
+        """Set up the camera and reload the vectors if the idelay has lost lock."""
+        self.setup_camera()
+        locked = self.get_idelay_lock_status() != 0
+        if not locked:
+            self.load_vectors_from_file(full=True)
+        return locked
     
     def connect(self):
         #must be called as first method after instatiating class.
-        self.x10g_rdma = RdmaUDP(
-            self.server_ctrl_ip_addr, 61650,  # 10.0.1.2
-            self.server_ctrl_ip_addr, 61651,  # 10.0.1.2
-            self.camera_ctrl_ip_addr, 61650,  # 10.0.1.102
-            self.camera_ctrl_ip_addr, 61651,  # 10.0.1.102
-            2000000, 9000, 20)
+        if self.shared_rdma:
+            self.x10g_rdma = RdmaMux.get(self.server_ctrl_ip_addr, 61650, 61651).open_session(
+                self.camera_ctrl_ip_addr, 61651, 9000, 20)
+        else:
+            self.x10g_rdma = RdmaUDP(
+                self.server_ctrl_ip_addr, 61650,  # 10.0.1.2
+                self.server_ctrl_ip_addr, 61651,  # 10.0.1.2
+                self.camera_ctrl_ip_addr, 61650,  # 10.0.1.102
+                self.camera_ctrl_ip_addr, 61651,  # 10.0.1.102
+                2000000, 9000, 20)
         self.x10g_rdma.setDebug(False)
         self.x10g_rdma.ack = True
+        if self.diagnostics_enabled:
+            self.x10g_rdma.telemetry = self.rdma_telemetry
+        self.enable_reliable_writes()
+        self.invalidate_register_shadow()
+        # the contents of the sequencer RAM are unknown on a new connection
+        self.uploaded_vectors = None
+        self.status = None
+        # batched writes are packed up to the FEM's control channel MTU
+        self.x10g_rdma.UDPMax = self.rdma_mtu
 
     def disconnect(self):
         # should be called on shutdown to close sockets
         self.x10g_rdma.close()
         # self.x10g_stream.close()
 
+    def write_registers(self, writes, comment=''):
+        """Write to registers through the shadow register map.
+
+        Writes that would not change the value last written to an address are skipped.
+        Must not be used for strobe or trigger registers, which need every write sent.
+        @param writes: list of (address, data) tuples, written in order
+        @param comment: comment to print out
+        @returns: the number of writes actually sent
+        """
+        if self.recording is not None:
+            self.recording.add(writes, readback=self.readback_addr)
+        changed = []
+        values = {}
+        for address, data in writes:
+            if values.get(address, self.register_shadow.get(address)) != data:
+                values[address] = data
+                changed.append((address, data))
+        if changed:
+            # the shadow only holds values the FEM was sent, so a failed send is retried next time
+            try:
+                self.x10g_rdma.write_many(changed, comment)
+            except Exception:
+                for address in values:
+                    self.register_shadow.pop(address, None)
+                raise
+            self.register_shadow.update(values)
+        return len(changed)
+
+    def send_writes(self, writes, comment=''):
+        """Send writes that must always be sent, such as strobes and triggers.
+
+        @param writes: list of (address, data) tuples, written in order
+        @param comment: comment to print out
+        """
+        if self.recording is not None:
+            self.recording.add(writes, held=False, readback=self.readback_addr)
+        return self.x10g_rdma.write_many(writes, comment)
+
+    def set_verify_scripts(self, verify):
+        self.verify_scripts = bool(verify)
+
+    def start_recording(self, name):
+        """Start recording register writes into a named script.
+
+        The shadow registers are invalidated, so every write of the recorded sequence is sent,
+        and recorded, even if the register already holds the value.
+        """
+        self.invalidate_register_shadow()
+        self.recording = RegisterScript(str(name))
+
+    def stop_recording(self, put_data=None):
+        """Stop recording, and compile and keep the recorded script.
+
+        @returns: the recorded RegisterScript, or None if nothing was being recorded
+        """
+        script = self.recording
+        if script is None:
+            return None
+        self.recording = None
+        if self.x10g_rdma is not None:
+            script.compile(self.x10g_rdma)
+        self.scripts[script.name] = script
+        return script
+
+    @contextmanager
+    def recording_script(self, name):
+        """Record the writes of the operations run inside the with block into a named script.
+        The script is discarded if any of them fail."""
+        self.start_recording(name)
+        try:
+            yield
+        except Exception:
+            self.recording = None
+            raise
+        self.stop_recording()
+
+    def run_script(self, name, verify=None):
+        """Replay a recorded script.
+
+        @param name: name of the script
+        @param verify: read back and check the registers the script writes, or None to use the
+        verify_scripts setting
+        @returns: list of (address, expected, read) tuples for each register that did not match
+        """
+        script = self.scripts.get(name)
+        if script is None:
+            raise QemFemError("No register script named {}".format(name))
+        if verify is None:
+            verify = self.verify_scripts
+        mismatches = script.replay(self.x10g_rdma, verify)
+        self.register_shadow.update(script.register_values)
+        sequencer_ram = self.rmda_addr["sequencer"] + 0x01000000
+        if any(sequencer_ram <= address < sequencer_ram + 0x01000000
+               for address, _ in script.writes):
+            self.uploaded_vectors = None
+        for address, expected, value in mismatches:
+            logging.warning("Script %s: register %08X read back %08X, expected %08X",
+                            name, address, value, expected)
+        self.script_result = {
+            "name": name,
+            "verified": verify,
+            "mismatches": ["{:08X}".format(address) for address, _, _ in mismatches]
+        }
+        return mismatches
+
+    def invalidate_register_shadow(self, put_data=None):
+        """Forget the shadow register values, so the next write to each register is sent.
+
+        Done on every connect. The shadow cannot see the FEM being power cycled or reset, so it
+        must also be invalidated after either, before the registers are set up again.
+        """
+        self.register_shadow = {}
+
     def set_ifg(self):
-        self.x10g_rdma.write(self.rmda_addr["udp_10G_data"]+0xF, 0x0, '10G Ctrl reg rdma ifg en, udpchecksum zero en')
-        self.x10g_rdma.write(self.rmda_addr["udp_10G_data"]+0xD, 0x3, '10G Ctrl reg rdma ifg value 3 x 8B idle')
-        self.x10g_rdma.write(self.rmda_addr["udp_10G_control"]+0xF, 0x0, '10G Ctrl reg rdma ifg en, udpchecksum zero en')
-        self.x10g_rdma.write(self.rmda_addr["udp_10G_control"]+0xD, 0x3, '10G Ctrl reg rdma ifg value 3 x 8B idle')
+        # 10G Ctrl reg rdma ifg en, udpchecksum zero en, then rdma ifg value 3 x 8B idle
+        self.write_registers([
+            (self.rmda_addr["udp_10G_data"]+0xF, 0x0),
+            (self.rmda_addr["udp_10G_data"]+0xD, 0x3),
+            (self.rmda_addr["udp_10G_control"]+0xF, 0x0),
+            (self.rmda_addr["udp_10G_control"]+0xD, 0x3)
+        ], '10G Ctrl reg rdma ifg')
 
     def stop_sequencer(self):
-        self.x10g_rdma.write(self.rmda_addr["sequencer"], 0x0, 'qem seq null')
-        # time.sleep(self.delay)
-        self.x10g_rdma.write(self.rmda_addr["sequencer"], 0x2, 'qem seq stop')
-        # time.sleep(self.delay)
+        # qem seq null, then qem seq stop
+        self.send_writes([
+            (self.rmda_addr["sequencer"], 0x0),
+            (self.rmda_addr["sequencer"], 0x2)
+        ], 'qem seq stop')
         return
 
     def start_sequencer(self):
-        self.x10g_rdma.write(self.rmda_addr["sequencer"], 0x0, 'qem seq null')
-        # time.sleep(self.delay)
-        self.x10g_rdma.write(self.rmda_addr["sequencer"], 0x1, 'qem seq stop')
-        # time.sleep(self.delay)
+        # qem seq null, then qem seq start
+        self.send_writes([
+            (self.rmda_addr["sequencer"], 0x0),
+            (self.rmda_addr["sequencer"], 0x1)
+        ], 'qem seq start')
         return
 
     def get_aligner_status(self):
@@ -193,15 +485,45 @@ class QemFem():
         # time.sleep(self.delay)
         return [aligner_status_1, aligner_status_0]
 
+    def get_status(self):
+        """Read the whole receiver status block in one burst and decode it.
+
+        @returns: a FemStatus, or None if the FEM is not connected
+        """
+        if self.x10g_rdma is None:
+            return None
+        address = self.rmda_addr["receiver"] | STATUS_BLOCK_OFFSET
+        registers = self.x10g_rdma.read_burst(address, STATUS_BLOCK_SIZE, 'receiver status block')
+        idelay_word = registers[0x12 - STATUS_BLOCK_OFFSET]
+        aligner_status = registers[0x14 - STATUS_BLOCK_OFFSET]
+        return FemStatus(
+            idelay=[idelay_word >> 24 & 0xFF, idelay_word >> 16 & 0xFF,
+                    idelay_word >> 8 & 0xFF, idelay_word & 0xFF],
+            locked=bool(registers[0x13 - STATUS_BLOCK_OFFSET] & 0x00000001),
+            aligner_status=[aligner_status >> 16 & 0xFFFF, aligner_status & 0xFFFF],
+            registers=registers
+        )
+
+    @run_on_executor(executor='thread_executor')
+    def refresh_status(self, put_data=None):
+        """Read the status block off the IOLoop, keeping it for the parameter tree."""
+        status = self.get_status()
+        self.status = dict(status._asdict()) if status is not None else None
+
     def set_idelay(self, data_1=0x00, cdn_1=0x00, data_0=0x00, cdn_0=0x00):
         data_cdn_word = data_1 << 24 | cdn_1 << 16 | data_0 << 8 | cdn_0
-        address = self.rmda_addr["receiver"] | 0x02
-        self.x10g_rdma.write(address, data_cdn_word, 'data_cdn_idelay word')
-        #issue load command
-        address = self.rmda_addr["receiver"] | 0x00
-        self.x10g_rdma.write(address, 0x00, 'set delay load low')
-        self.x10g_rdma.write(address, 0x10, 'set delay load high')
-        self.x10g_rdma.write(address, 0x00, 'set delay load low')
+        # write the data_cdn_idelay word, then issue load command (low, high, low).
+        # Both are always sent, not shadowed: a FEM power cycle clears the loaded idelay without
+        # the shadow knowing, and the idelay word is only loaded by the strobe
+        load_address = self.rmda_addr["receiver"] | 0x00
+        self.send_writes([
+            (self.rmda_addr["receiver"] | 0x02, data_cdn_word),
+            (load_address, 0x00),
+            (load_address, 0x10),
+            (load_address, 0x00)
+        ], 'data_cdn_idelay word and load')
+        # kept in the shadow for the eye scan, which starts from the current taps
+        self.register_shadow[self.rmda_addr["receiver"] | 0x02] = data_cdn_word
         address = self.rmda_addr["receiver"] | 0x12
         data_cdn_idelay_word = self.x10g_rdma.read(address, 'data_cdn_idelay word')
         return data_cdn_idelay_word
@@ -209,13 +531,13 @@ class QemFem():
     def set_ivsr(self, data_1=0x00, data_0=0x00, cdn_1=0x00, cdn_0=0x00):
         data_cdn_word = data_1 << 24 | data_0 << 16 | cdn_1 << 8 | cdn_0
         address = self.rmda_addr["receiver"] | 0x03
-        self.x10g_rdma.write(address, data_cdn_word, 'data_cdn_ivsr word')
+        self.write_registers([(address, data_cdn_word)], 'data_cdn_ivsr word')
         return
 
     def set_scsr(self, data_1=0x00, data_0=0x00, cdn_1=0x00, cdn_0=0x00):
         data_cdn_word = data_1 << 24 | data_0 << 16 | cdn_1 << 8 | cdn_0
         address = self.rmda_addr["receiver"] | 0x05
-        self.x10g_rdma.write(address, data_cdn_word, 'data_cdn_ivsr word')
+        self.write_registers([(address, data_cdn_word)], 'data_cdn_scsr word')
         return
 
     # Working with descrambling logic in place
@@ -238,7 +560,7 @@ class QemFem():
         # calculate pixel packing settings
         if p_size >= 11 and p_size <= 13:
             pixel_extract = self.pixel_extract.index(p_size)
-            pixel_count_max = y_size / 2
+            pixel_count_max = y_size // 2
         else:
             size_status = size_status + 1
 
@@ -247,10 +569,12 @@ class QemFem():
             logging.debug("Size Error %-8s %-8s %-8s %-8s %-8s %-8s", 'no_bytes', 'no_by_r4', 'no_by_r8', 'no_pkts', 'lp_no_by_r8', 'lp_n0_by_r32' )
             logging.debug("Size Error %8i %8i %8i %8i %8i %8i", number_bytes, number_bytes_r4, number_bytes_r8, first_packets, lp_number_bytes_r8, lp_number_bytes_r32 )
         else:
-            address = self.rmda_addr["receiver"] | 0x01
+            # pixel count max, then pixel size in bits 10,11,12 or 13
             data = (pixel_count_max & 0x1FFFF) - 1
-            self.x10g_rdma.write(address, data, 'pixel count max')
-            self.x10g_rdma.write(self.rmda_addr["receiver"] + 4, p_size - 10, 'Pixel size in bits 10,11,12 or 13')
+            self.write_registers([
+                (self.rmda_addr["receiver"] | 0x01, data),
+                (self.rmda_addr["receiver"] + 4, p_size - 10)
+            ], 'image size')
         return
 
     def get_idelay_lock_status(self):
@@ -262,40 +586,89 @@ class QemFem():
         else:
             return 0
 
+    def get_changed_vector_runs(self, vectors):
+        """Find the sequencer RAM words that differ from the last upload.
+
+        @param vectors: array of 64 bit sequencer words to upload
+        @returns: list of (start, end) sequencer address ranges, end exclusive, that need writing
+        """
+        changed = np.ones(len(vectors), dtype=np.int8)
+        if self.delta_upload and self.uploaded_vectors is not None:
+            compared = min(len(vectors), len(self.uploaded_vectors))
+            changed[:compared] = vectors[:compared] != self.uploaded_vectors[:compared]
+
+        # runs start where changed goes 0 -> 1 and end where it goes 1 -> 0
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], changed, [0]))))
+        return list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+    def verify_ram_writes(self, ram_writes):
+        """Read back each sequencer RAM word written, one register at a time.
+
+        @param ram_writes: list of (address, data) tuples written to the sequencer RAM
+        @returns: the number of words that did not read back as written
+        """
+        return sum(1 for address, data in ram_writes
+                   if self.x10g_rdma.read(address, 'qem seq ram readback') != data)
+
+    def load_vectors_full(self, put_data=None):
+        """Upload every sequencer word, regardless of what was uploaded before."""
+        self.load_vectors_from_file(full=True)
+
     # @run_on_executor(executor='thread_executor')
-    def load_vectors_from_file(self, vector_file_name=None):
+    def load_vectors_from_file(self, vector_file_name=None, full=False):
 
         init_length  = self.vector_file.vector_length
         loop_length  = self.vector_file.vector_loop_position
 
         self.stop_sequencer()
+        # reloading the sequencer can disturb the receiver, so resend every register afterwards
+        self.invalidate_register_shadow()
+        if full:
+            self.uploaded_vectors = None
 
         # load sequencer RAM
         logging.debug("Loading Sequncer RAM")
 
-        for seq_address, vector_line in enumerate(self.vector_file.vector_data):
-            vector_str = "".join(str(x) for x in vector_line)
-            vector = int(vector_str, 2)
-            lower_vector_word = vector & 0xFFFFFFFF
-            upper_vector_word = vector >> 32
-            # load fpga block ram
-            ram_address = (seq_address * 2) + self.rmda_addr['sequencer'] + 0x01000000
-            self.x10g_rdma.write(ram_address, lower_vector_word, 'qem seq ram loop 0')
-            # time.sleep(self.delay)
-            ram_address = ram_address + 1
-            self.x10g_rdma.write(ram_address, upper_vector_word, 'qem seq ram loop 0')
-            # time.sleep(self.delay)
-
-        # set loop limit
-        self.x10g_rdma.write(self.rmda_addr['sequencer'] + 1, loop_length - 1, 'qem seq loop limit')
-        # time.sleep(self.delay)
-        # set init limit
-        self.x10g_rdma.write(self.rmda_addr['sequencer'] + 2, init_length - 1, 'qem seq init limit')
-        # time.sleep(self.delay)
+        # precompiled sequencer words, kept up to date by the vector file
+        vectors = self.vector_file.vector_words
+
+        # only the runs of words that changed since the last upload are written
+        runs = self.get_changed_vector_runs(vectors)
+        seq_addresses = np.concatenate(
+            [np.arange(start, end) for start, end in runs] + [np.zeros(0, dtype=np.intp)])
+        # each word is loaded into fpga block ram as lower then upper 32 bits
+        ram_addresses = np.empty(len(seq_addresses) * 2, dtype=np.uint64)
+        ram_addresses[0::2] = (seq_addresses * 2) + self.rmda_addr['sequencer'] + 0x01000000
+        ram_addresses[1::2] = ram_addresses[0::2] + 1
+        ram_data = np.empty(len(seq_addresses) * 2, dtype=np.uint64)
+        ram_data[0::2] = vectors[seq_addresses] & np.uint64(0xFFFFFFFF)
+        ram_data[1::2] = vectors[seq_addresses] >> np.uint64(32)
+        ram_writes = list(zip(ram_addresses.tolist(), ram_data.tolist()))
+
+        # unknown until the upload has finished, in case it fails part way through
+        self.uploaded_vectors = None
+        datagrams = self.send_writes(ram_writes, 'qem seq ram loop 0')
+        # a lost datagram would leave words that later delta uploads skip, so the upload is only
+        # relied on once every word written has been read back
+        if self.delta_upload:
+            mismatches = self.verify_ram_writes(ram_writes)
+            if mismatches:
+                logging.warning("%d of %d sequencer RAM words did not read back as written. "
+                                "Delta uploads turned off", mismatches, len(ram_writes))
+                self.delta_upload = False
+            else:
+                # copy, as the vector file updates its words in place when a bias changes
+                self.uploaded_vectors = np.array(vectors)
+        logging.debug("Sequencer RAM loaded: %d of %d words in %d runs, %d datagrams",
+                      len(ram_writes) // 2, len(vectors), len(runs), datagrams)
+        # set loop limit and init limit
+        self.write_registers([
+            (self.rmda_addr['sequencer'] + 1, loop_length - 1),
+            (self.rmda_addr['sequencer'] + 2, init_length - 1)
+        ], 'qem seq loop and init limits')
         self.start_sequencer()
         time.sleep(0.1)  # this sleep might have been the missing thing allowing this whole bloody thing to work?
-        self.get_aligner_status()
-        lock = self.get_idelay_lock_status() != 0
+        lock = self.get_idelay_lock_status()
         if not lock:
             logging.warning("Idelay Not locked after Vector File Upload. Check Vector File")
         else:
@@ -308,17 +681,23 @@ class QemFem():
         return
 
     def frame_gate_trigger(self):
-        self.x10g_rdma.write(self.rmda_addr["frm_gate"], 0x0, 'frame gate trigger off')
-        self.x10g_rdma.write(self.rmda_addr["frm_gate"], 0x1, 'frame gate trigger on')
+        # frame gate trigger off, then on
+        self.send_writes([
+            (self.rmda_addr["frm_gate"], 0x0),
+            (self.rmda_addr["frm_gate"], 0x1)
+        ], 'frame gate trigger')
         return
 
     def frame_gate_settings(self, frame_number, frame_gap):
-        self.x10g_rdma.write(self.rmda_addr["frm_gate"] + 1, frame_number, 'frame gate frame number')
-        self.x10g_rdma.write(self.rmda_addr["frm_gate"] + 2, frame_gap,    'frame gate frame gap')
+        # frame gate frame number and frame gap
+        self.write_registers([
+            (self.rmda_addr["frm_gate"] + 1, frame_number),
+            (self.rmda_addr["frm_gate"] + 2, frame_gap)
+        ], 'frame gate settings')
 
     def set_10g_mtu(self, core_num, new_mtu):
         #mtu is set in clock cycles where each clock is 8 bytes -2
-        val_mtu = new_mtu / 8 - 2
+        val_mtu = new_mtu // 8 - 2
 
         if core_num == 'control':
             address = self.rmda_addr["udp_10G_control"]
@@ -328,7 +707,7 @@ class QemFem():
             address = self.rmda_addr["udp_10G_data"]
             self.strm_mtu = new_mtu
 
-        self.x10g_rdma.write(address+0xC, val_mtu, 'set 10G mtu')
+        self.write_registers([(address+0xC, val_mtu)], 'set 10G mtu')
 
     def cleanup(self):
         self.disconnect()
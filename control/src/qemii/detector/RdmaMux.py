@@ -0,0 +1,183 @@
+""" RdmaMux
+
+Shared RDMA transport for driving several FEM-II modules from one control server address.
+
+A single RdmaUDP binds the fixed RDMA ports on the server control address, so only one FEM can
+use each address. RdmaMux instead owns one socket pair per server address and gives each FEM a
+lightweight RdmaSession. Commands from every session go out of the shared tx socket, and a single
+background thread reads the shared rx socket and passes each response to the session for the FEM
+it came from, by source address.
+
+RdmaSession is an RdmaUDP, so a QemFem uses it exactly as it would its own connection.
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import logging
+import select
+import socket
+import threading
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+from qemii.detector.RdmaUDP import RdmaUDP
+
+
+class RdmaMux(object):
+    """One RDMA socket pair on a server address, shared by a session for each FEM."""
+
+    # open multiplexers, keyed by (server address, tx port, rx port)
+    registry = {}
+    registry_lock = threading.Lock()
+
+    def __init__(self, server_address, tx_port=61650, rx_port=61651, rx_buffer=2000000,
+                 max_datagram=9000):
+        self.key = (server_address, tx_port, rx_port)
+        self.max_datagram = max_datagram
+        self.sessions = {}  # FEM address: RdmaSessionSocket
+        self.lock = threading.Lock()
+        self.unmatched_responses = 0
+
+        self.txsocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rxsocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rxsocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rx_buffer)
+        self.rxsocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        self.txsocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        self.rxsocket.bind((server_address, rx_port))
+        self.txsocket.bind((server_address, tx_port))
+        self.rxsocket.setblocking(0)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.receive_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def get(cls, server_address, tx_port=61650, rx_port=61651):
+        """Get the multiplexer for a server address, opening it if it is not already open."""
+        key = (server_address, tx_port, rx_port)
+        with cls.registry_lock:
+            mux = cls.registry.get(key)
+            if mux is None:
+                mux = cls(server_address, tx_port, rx_port)
+                cls.registry[key] = mux
+            return mux
+
+    def open_session(self, target_address, target_port=61651, UDPMTU=9000, UDPTimeout=10):
+        """Open a session for the FEM at the target address.
+
+        A FEM that already has a session, as when it reconnects without disconnecting first, is
+        given a new one in its place. The old session no longer receives any responses, and
+        responses to its reads that arrive late go to the new session's queue, which is flushed
+        after any read of it times out.
+        @param target_address: control address of the FEM, which its responses come from
+        @param target_port: port the FEM receives commands on
+        @returns: an RdmaSession
+        """
+        with self.lock:
+            if target_address in self.sessions:
+                logging.info("Replacing the RDMA session of FEM %s on %s",
+                             target_address, self.key[0])
+            session_socket = RdmaSessionSocket(self, target_address, UDPTimeout)
+            self.sessions[target_address] = session_socket
+        return RdmaSession(session_socket, target_address, target_port, UDPMTU, UDPTimeout)
+
+    def close_session(self, session_socket):
+        """Close a FEM's session, closing the multiplexer once no sessions are left.
+
+        A session that has since been replaced is only dropped, leaving its replacement open.
+        """
+        with self.lock:
+            if self.sessions.get(session_socket.target_address) is not session_socket:
+                return
+            del self.sessions[session_socket.target_address]
+            last = not self.sessions
+        if last:
+            with self.registry_lock:
+                if self.registry.get(self.key) is self:
+                    del self.registry[self.key]
+            self.close()
+
+    def receive_loop(self):
+        """Pass each response on to the session of the FEM it came from."""
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.rxsocket], [], [], 0.1)
+            except (select.error, ValueError):
+                # the socket was closed underneath us
+                break
+            if not readable:
+                continue
+            while True:
+                try:
+                    response, (sender, _) = self.rxsocket.recvfrom(self.max_datagram)
+                except socket.error:
+                    break
+                session_socket = self.sessions.get(sender)
+                if session_socket is None:
+                    self.unmatched_responses += 1
+                    logging.warning("RDMA response from unknown FEM %s ignored", sender)
+                    continue
+                session_socket.responses.put(response)
+
+    def close(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        self.txsocket.close()
+        self.rxsocket.close()
+
+
+class RdmaSessionSocket(object):
+    """Stands in for both RdmaUDP sockets of a session.
+
+    Sends through the shared tx socket, and receives the responses the multiplexer has passed
+    on from this session's FEM.
+    """
+
+    def __init__(self, mux, target_address, timeout):
+        self.mux = mux
+        self.target_address = target_address
+        self.timeout = timeout
+        self.responses = queue.Queue()
+
+    def sendto(self, data, address):
+        return self.mux.txsocket.sendto(data, address)
+
+    def recv(self, size):
+        try:
+            return self.responses.get(timeout=self.timeout)[:size]
+        except queue.Empty:
+            raise socket.timeout("timed out")
+
+    def recv_into(self, buffer, size=0):
+        response = self.recv(size or len(buffer))
+        buffer[:len(response)] = response
+        return len(response)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        # the shared sockets are closed by the multiplexer, once its last session closes
+        pass
+
+
+class RdmaSession(RdmaUDP):
+    """RdmaUDP connection to a single FEM over a shared RdmaMux."""
+
+    def __init__(self, session_socket, TargetRxUDPIPAddress, TargetRxUDPIPPort=61651,
+                 UDPMTU=9000, UDPTimeout=10):
+        self.session_socket = session_socket
+        self.txsocket = session_socket
+        self.rxsocket = session_socket
+        self.setup_target(TargetRxUDPIPAddress, TargetRxUDPIPPort, UDPMTU, UDPTimeout)
+
+    def close(self):
+        if self.session_socket is not None:
+            self.session_socket.mux.close_session(self.session_socket)
+            self.session_socket = None
@@ -7,11 +7,175 @@ Rob Halsall 2018, Sophie Kirkham, Application Engineering Group, STFC, 2019.
 
 import socket
 import struct
+import threading
 import time
 import logging
+from functools import wraps
+
+
+# monotonic where available, for timing round trips
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class RdmaUDPError(Exception):
+    """Simple exception class for RdmaUDP to wrap lower-level exceptions."""
+
+    pass
+
+
+def locked(method):
+    """Run an RdmaUDP method holding the connection's lock.
+
+    Every transaction packs into the same preallocated buffers and reads responses from the same
+    socket, so a connection used from several threads at once must only run one at a time.
+    """
+    @wraps(method)
+    def locked_method(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked_method
+
+
+class RdmaTelemetry(object):
+    """Transaction counters and a read latency histogram for an RdmaUDP connection.
+
+    Only recorded while attached to a connection as its telemetry attribute, so a connection
+    without telemetry pays a single attribute check per transaction.
+    """
+
+    # read latency buckets are powers of two of microseconds, the last one catching the rest
+    LATENCY_BUCKETS = 24
+    # addresses are grouped by their top nibble, the same blocks as the FEM base addresses
+    REGION_SHIFT = 28
+    NUM_REGIONS = 16
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, put_data=None):
+        """Clear all counters."""
+        self.reads = 0
+        self.writes = 0
+        self.datagrams_sent = 0
+        self.datagrams_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timeouts = 0
+        self.short_responses = 0
+        self.resent = 0
+        self.region_reads = [0] * self.NUM_REGIONS
+        self.region_writes = [0] * self.NUM_REGIONS
+        self.read_latency = [0] * self.LATENCY_BUCKETS
+        self.read_latency_total = 0.0
+        self.read_latency_max = 0.0
+        self.start_time = time.time()
+
+    def record_sent(self, num_bytes):
+        self.datagrams_sent += 1
+        self.bytes_sent += num_bytes
+
+    def record_received(self, num_bytes):
+        self.datagrams_received += 1
+        self.bytes_received += num_bytes
+
+    def record_write(self, address):
+        self.writes += 1
+        self.region_writes[(address >> self.REGION_SHIFT) & 0xF] += 1
+
+    def record_read(self, address, latency):
+        """Record an answered read and its round trip time in seconds."""
+        self.reads += 1
+        self.region_reads[(address >> self.REGION_SHIFT) & 0xF] += 1
+        bucket = min(int(latency * 1e6).bit_length(), self.LATENCY_BUCKETS - 1)
+        self.read_latency[bucket] += 1
+        self.read_latency_total += latency
+        if latency > self.read_latency_max:
+            self.read_latency_max = latency
+
+    def record_timeout(self, address):
+        self.timeouts += 1
+        self.region_reads[(address >> self.REGION_SHIFT) & 0xF] += 1
+
+    def record_resent(self, num_bytes):
+        self.resent += 1
+        self.record_sent(num_bytes)
+
+    def record_short_response(self, num_bytes):
+        self.short_responses += 1
+        self.record_received(num_bytes)
+
+    def snapshot(self, region_names=None):
+        """Get a copy of the counters as a dictionary.
+
+        @param region_names: optional dictionary of base address: name, used to label the
+        per region counts. Regions without a name are labelled by their base address.
+        @returns: dictionary of counters, with only the regions and latency buckets in use
+        """
+        region_names = region_names or {}
+        regions = {}
+        for region in range(self.NUM_REGIONS):
+            if self.region_reads[region] or self.region_writes[region]:
+                base = region << self.REGION_SHIFT
+                regions[region_names.get(base, "{:08X}".format(base))] = {
+                    "reads": self.region_reads[region],
+                    "writes": self.region_writes[region]
+                }
+        # bucket n holds latencies below 2^n microseconds
+        latency = {}
+        for bucket, count in enumerate(self.read_latency):
+            if count:
+                label = "<{}us".format(1 << bucket)
+                if bucket == self.LATENCY_BUCKETS - 1:
+                    label = ">={}us".format(1 << (bucket - 1))
+                latency[label] = count
+        return {
+            "elapsed": time.time() - self.start_time,
+            "reads": self.reads,
+            "writes": self.writes,
+            "datagrams_sent": self.datagrams_sent,
+            "datagrams_received": self.datagrams_received,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "timeouts": self.timeouts,
+            "short_responses": self.short_responses,
+            "resent": self.resent,
+            "regions": regions,
+            "read_latency": {
+                "histogram": latency,
+                "mean": self.read_latency_total / self.reads if self.reads else 0.0,
+                "max": self.read_latency_max
+            }
+        }
 
 
 class RdmaUDP(object):
+
+    # a single 64 bit write command and the 5 data cycle nop command used to pad each datagram
+    WRITE_COMMAND = '=BBBBIQ'
+    NOP_COMMAND = '=BBBBIQQQQQ'
+    # IPv4 + UDP header bytes that count against the MTU but not the payload
+    UDP_HEADER_SIZE = 28
+    RESPONSE = '=IIIIQQQQQ'
+    # reliable write sequence numbers are carried in the two reserved bytes of the nop header
+    SEQUENCE_MASK = 0xFFFF
+
+    # reliable writes carry a sequence number in the tag of the nop command ending each datagram.
+    # A nop with the ack request address asks for a single coalesced acknowledgement of a window
+    # of datagrams. Its data words are the first sequence number of the window, the number of
+    # datagrams and a request number. It is answered by a response of the ack marker, the first
+    # sequence number, the number of datagrams and the request number, then a bitmap of the
+    # datagrams received in the five 64 bit words.
+    # This protocol is only implemented by the FemEmulator. The FEM-II firmware does not answer
+    # ack requests, so probe_reliable_writes must succeed before reliable writes are enabled
+    ACK_REQUEST_ADDRESS = 0xFFFFFFFF
+    ACK_MARKER = 0xAC4B0000
+    ACK_WINDOW = 5 * 64
+
+    # precompiled forms of the formats above, so the hot register path never re-parses them
+    COMMAND_STRUCT = struct.Struct(WRITE_COMMAND)
+    NOP_STRUCT = struct.Struct(NOP_COMMAND)
+    RESPONSE_STRUCT = struct.Struct(RESPONSE)
+
     def __init__(self, MasterTxUDPIPAddress='192.168.0.1', MasterTxUDPIPPort=65535, 
                  MasterRxUDPIPAddress='192.168.0.1', MasterRxUDPIPPort=65536,
                  TargetTxUDPIPAddress='192.168.0.2', TargetTxUDPIPPort=65535,
@@ -27,21 +191,47 @@ class RdmaUDP(object):
         self.rxsocket.bind((MasterRxUDPIPAddress, MasterRxUDPIPPort))
         self.txsocket.bind((MasterTxUDPIPAddress, MasterTxUDPIPPort))
 
-        #self.rxsocket.settimeout(None)
-        #self.txsocket.settimeout(None)
+        # blocking reads give up after UDPTimeout seconds rather than hanging forever
+        self.rxsocket.settimeout(UDPTimeout)
 
-        self.rxsocket.setblocking(1)
-        #self.txsocket.setblocking(1)
+        self.setup_target(TargetRxUDPIPAddress, TargetRxUDPIPPort, UDPMTU, UDPTimeout)
 
+    def setup_target(self, TargetRxUDPIPAddress, TargetRxUDPIPPort, UDPMTU, UDPTimeout):
+        """Set up the target address and the preallocated buffers, independent of the sockets."""
         self.TgtRxUDPIPAddr = TargetRxUDPIPAddress
         self.TgtRxUDPIPPrt  = TargetRxUDPIPPort
         self.UDPMaxRx = UDPMTU
+        self.UDPMax = UDPMTU
+        self.UDPTimeout = UDPTimeout
+        self.target = (TargetRxUDPIPAddress, TargetRxUDPIPPort)
         self.debug = False
         self.ack = False
+        # optional acknowledged, retried writes, only for targets that pass probe_reliable_writes
+        self.reliable = False
+        self.reliable_retries = 5
+        self.ack_timeout = 0.1
+        self.write_sequence = 0
+        # set once a read times out, as its response may still arrive and be taken for the
+        # response to the next read
+        self.stale_responses = False
+
+        # preallocated datagrams for single reads and writes, each already padded with the nop
+        # command, so only the leading command has to be packed on each call
+        nop = self.NOP_STRUCT.pack(9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+        self.read_buffer = bytearray(self.COMMAND_STRUCT.size) + nop
+        self.write_buffer = bytearray(self.COMMAND_STRUCT.size) + nop
+        self.batch_buffer = bytearray()
+        self.rx_buffer = bytearray(UDPMTU)
+        # optional RdmaTelemetry, recording every transaction while set
+        self.telemetry = None
+        # held for each transaction, as the buffers above are shared. Reentrant, as writes can
+        # call one another
+        self.lock = threading.RLock()
 
     def __del__(self):
         self.close()
 
+    @locked
     def read(self, address, comment=''):
         """ Read 64 bits from the address.
 
@@ -49,32 +239,340 @@ class RdmaUDP(object):
         @param address: the address to read from
         @param comment: comment to print out 
         """
-        command = struct.pack('=BBBBIQBBBBIQQQQQ', 1,0,0,3, address, 0, 9,0,0,255, 0, 0,0,0,0,0)
-        self.txsocket.sendto(command,(self.TgtRxUDPIPAddr,self.TgtRxUDPIPPrt))
+        if self.stale_responses:
+            self.discard_stale_responses()
+        telemetry = self.telemetry
+        self.COMMAND_STRUCT.pack_into(self.read_buffer, 0, 1, 0, 0, 3, address, 0)
+        if telemetry is not None:
+            start = timer()
+            telemetry.record_sent(len(self.read_buffer))
+        self.txsocket.sendto(self.read_buffer, self.target)
 
+        data = 0x00000000
         if self.ack:
-            response = self.rxsocket.recv(self.UDPMaxRx)
-            data = 0x00000000
-            if len(response) == 56:
-                decoded = struct.unpack('=IIIIQQQQQ', response)
-                data = decoded[3]
-                #print decoded
+            try:
+                received = self.rxsocket.recv_into(self.rx_buffer)
+            except socket.timeout:
+                logging.warning('R %08X : timed out after %ss %s', address, self.UDPTimeout, comment)
+                self.stale_responses = True
+                if telemetry is not None:
+                    telemetry.record_timeout(address)
+                return data
+            if received == self.RESPONSE_STRUCT.size:
+                data = self.RESPONSE_STRUCT.unpack_from(self.rx_buffer)[3]
+                if telemetry is not None:
+                    telemetry.record_received(received)
+                    telemetry.record_read(address, timer() - start)
+            elif telemetry is not None:
+                telemetry.record_short_response(received)
 
         if self.debug:
             logging.debug('R %08X : %08X %s', address, data, comment)
-        print("Data: {}".format(data))
         return data
 
+    @locked
+    def write_many_reliable(self, writes, comment=''):
+        """ Write a list of values, resending any datagrams the target does not acknowledge.
+
+        Datagrams are numbered and sent in windows of up to ACK_WINDOW, each followed by one ack
+        request. Only the datagrams missing from the acknowledgement are resent, up to
+        reliable_retries times. The target discards any it has already received.
+        @param writes: list of (address, data) tuples, written in order
+        @param comment: comment to print out
+        @returns: the number of datagrams sent, not counting resends
+        @raises RdmaUDPError: if some datagrams are still unacknowledged after every retry
+        """
+        command = self.COMMAND_STRUCT
+        max_writes = max(1, (self.UDPMax - self.UDP_HEADER_SIZE - self.NOP_STRUCT.size)
+                         // command.size)
+        telemetry = self.telemetry
+
+        datagrams = []
+        for start in range(0, len(writes), max_writes):
+            sequence = self.get_write_sequence()
+            commands = []
+            for address, data in writes[start:start + max_writes]:
+                if self.debug:
+                    logging.debug('W %08X : %08X %s [%04X]', address, data, comment, sequence)
+                commands.append(command.pack(1, 0, 0, 2, address, data))
+                if telemetry is not None:
+                    telemetry.record_write(address)
+            commands.append(self.NOP_STRUCT.pack(9, sequence & 0xFF, sequence >> 8, 255, 0,
+                                                 0, 0, 0, 0, 0))
+            datagrams.append((sequence, b''.join(commands)))
+
+        for start in range(0, len(datagrams), self.ACK_WINDOW):
+            self.send_window(datagrams[start:start + self.ACK_WINDOW], comment)
+        return len(datagrams)
+
+    @locked
+    def probe_reliable_writes(self):
+        """ Check whether the target acknowledges reliable writes.
+
+        Sends ack requests for an empty window, each waiting ack_timeout seconds for an answer,
+        up to reliable_retries times. Nothing is written.
+        @returns: True if the target acknowledged a request
+        """
+        if self.stale_responses:
+            self.discard_stale_responses()
+        # the next sequence number, without using it up
+        base = (self.write_sequence % self.SEQUENCE_MASK) + 1
+        self.rxsocket.settimeout(self.ack_timeout)
+        try:
+            for request_id in range(1, self.reliable_retries + 1):
+                self.txsocket.sendto(self.NOP_STRUCT.pack(9, 0, 0, 255, self.ACK_REQUEST_ADDRESS,
+                                                          base, 0, request_id, 0, 0),
+                                     self.target)
+                if self.receive_ack(base) is not None:
+                    return True
+            return False
+        finally:
+            self.rxsocket.settimeout(self.UDPTimeout)
+
+    def discard_stale_responses(self):
+        """Drop any responses already waiting, left over from reads that timed out."""
+        self.rxsocket.settimeout(0)
+        discarded = 0
+        try:
+            while True:
+                self.rxsocket.recv_into(self.rx_buffer)
+                discarded += 1
+        except (socket.timeout, socket.error):
+            pass
+        finally:
+            self.rxsocket.settimeout(self.UDPTimeout)
+        if discarded:
+            logging.debug('Discarded %d late RDMA responses', discarded)
+        self.stale_responses = False
+
+    def get_write_sequence(self):
+        """Get the next reliable write sequence number. Zero marks an unreliable datagram."""
+        self.write_sequence = (self.write_sequence % self.SEQUENCE_MASK) + 1
+        return self.write_sequence
+
+    def send_window(self, window, comment=''):
+        """Send a window of numbered datagrams until every one has been acknowledged.
+
+        The ack request is repeated every ack_timeout seconds until an acknowledgement arrives,
+        for up to UDPTimeout seconds. Missing datagrams are resent up to reliable_retries times.
+        """
+        base = window[0][0]
+        telemetry = self.telemetry
+        unacked = window
+        send = window
+        resends = 0
+        # requests are numbered, so acks from before the latest datagrams were sent are ignored
+        request_id = 0
+        self.rxsocket.settimeout(self.ack_timeout)
+        try:
+            deadline = timer() + self.UDPTimeout
+            while True:
+                for _, datagram in send:
+                    self.txsocket.sendto(datagram, self.target)
+                    if telemetry is not None:
+                        if resends:
+                            telemetry.record_resent(len(datagram))
+                        else:
+                            telemetry.record_sent(len(datagram))
+                if send:
+                    first_request_id = request_id + 1
+                request_id += 1
+                self.txsocket.sendto(self.NOP_STRUCT.pack(9, 0, 0, 255, self.ACK_REQUEST_ADDRESS,
+                                                          base, len(window), request_id, 0, 0),
+                                     self.target)
+                received = self.receive_ack(base, first_request_id)
+                if received is None:
+                    if timer() > deadline:
+                        raise RdmaUDPError(
+                            "No acknowledgement of {} write datagrams after {}s {}".format(
+                                len(window), self.UDPTimeout, comment))
+                    # the request or its ack was lost, so only the request needs sending again
+                    send = []
+                    continue
+                unacked = [(sequence, datagram) for sequence, datagram in unacked
+                           if not received >> ((sequence - base) % self.SEQUENCE_MASK) & 1]
+                if not unacked:
+                    return
+                resends += 1
+                if resends > self.reliable_retries:
+                    raise RdmaUDPError(
+                        "{} of {} write datagrams unacknowledged after {} retries {}".format(
+                            len(unacked), len(window), self.reliable_retries, comment))
+                logging.debug('Resending %d of %d write datagrams %s',
+                              len(unacked), len(window), comment)
+                send = unacked
+                deadline = timer() + self.UDPTimeout
+        finally:
+            self.rxsocket.settimeout(self.UDPTimeout)
+
+    def receive_ack(self, base, first_request_id=0):
+        """Wait for the acknowledgement of the window starting at base.
+
+        @param base: sequence number of the first datagram of the window
+        @param first_request_id: ignore acks of ack requests numbered before this
+
+        @returns: bitmap of the datagrams received, or None if no acknowledgement arrived
+        """
+        response_struct = self.RESPONSE_STRUCT
+        while True:
+            try:
+                received = self.rxsocket.recv_into(self.rx_buffer)
+            except socket.timeout:
+                return None
+            if received != response_struct.size:
+                continue
+            decoded = response_struct.unpack_from(self.rx_buffer)
+            if decoded[0] != self.ACK_MARKER or decoded[1] != base or decoded[3] < first_request_id:
+                # a stale read response, or the ack of an earlier attempt
+                continue
+            if self.telemetry is not None:
+                self.telemetry.record_received(received)
+            bitmap = 0
+            for index, word in enumerate(decoded[4:]):
+                bitmap |= word << (64 * index)
+            return bitmap
+
+    def compile_writes(self, writes):
+        """ Pack a list of writes into datagrams once, ready to be sent any number of times.
+
+        The datagrams are the same as write_many would send with the current MTU.
+        @param writes: list of (address, data) tuples, written in order
+        @returns: list of datagrams, as bytes
+        """
+        command = self.COMMAND_STRUCT
+        nop = self.NOP_STRUCT.pack(9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+        max_writes = max(1, (self.UDPMax - self.UDP_HEADER_SIZE - len(nop)) // command.size)
+        datagrams = []
+        for start in range(0, len(writes), max_writes):
+            datagrams.append(b''.join(
+                [command.pack(1, 0, 0, 2, address, data)
+                 for address, data in writes[start:start + max_writes]] + [nop]))
+        return datagrams
+
+    @locked
+    def send_datagrams(self, datagrams, writes=None, comment=''):
+        """ Send datagrams prepared by compile_writes.
+
+        @param datagrams: list of datagrams to send, in order
+        @param writes: optional list of the writes they contain, for the telemetry and debug log
+        @param comment: comment to print out
+        @returns: the number of datagrams sent
+        """
+        for datagram in datagrams:
+            self.txsocket.sendto(datagram, self.target)
+            if self.telemetry is not None:
+                self.telemetry.record_sent(len(datagram))
+        if writes is not None:
+            for address, data in writes:
+                if self.debug:
+                    logging.debug('W %08X : %08X %s', address, data, comment)
+                if self.telemetry is not None:
+                    self.telemetry.record_write(address)
+        return len(datagrams)
+
+    @locked
+    def read_many(self, addresses, comment=''):
+        """ Read 64 bits from each of a list of addresses, in as few round trips as possible.
+
+        As many read commands as fit in the MTU are sent together in one datagram. The responses
+        carry nothing to match them to their commands by, so they are taken strictly in the order
+        the reads were sent, and may arrive either one per datagram or several back to back.
+        Once a batch times out, the rest of its reads are returned as zero rather than risk
+        pairing a late response with the wrong address.
+        @param addresses: list of addresses to read from
+        @param comment: comment to print out
+        @returns: list of the data read from each address, with 0 for any that timed out
+        """
+        command = self.COMMAND_STRUCT
+        command_size = command.size
+        nop_size = self.NOP_STRUCT.size
+        max_reads = max(1, (self.UDPMax - self.UDP_HEADER_SIZE - nop_size) // command_size)
+        buffer_size = max_reads * command_size + nop_size
+        if len(self.batch_buffer) < buffer_size:
+            self.batch_buffer = bytearray(buffer_size)
+        buffer = self.batch_buffer
+        view = memoryview(buffer)
+        response_struct = self.RESPONSE_STRUCT
+        response_size = response_struct.size
+
+        telemetry = self.telemetry
+        results = [0] * len(addresses)
+        for start in range(0, len(addresses), max_reads):
+            if self.stale_responses:
+                self.discard_stale_responses()
+            batch = addresses[start:start + max_reads]
+            offset = 0
+            for address in batch:
+                command.pack_into(buffer, offset, 1, 0, 0, 3, address, 0)
+                offset += command_size
+            self.NOP_STRUCT.pack_into(buffer, offset, 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+            offset += nop_size
+            if telemetry is not None:
+                sent = timer()
+                telemetry.record_sent(offset)
+            self.txsocket.sendto(view[:offset], self.target)
+            if not self.ack:
+                continue
+
+            index = 0
+            while index < len(batch):
+                try:
+                    received = self.rxsocket.recv_into(self.rx_buffer)
+                except socket.timeout:
+                    self.stale_responses = True
+                    for address in batch[index:]:
+                        logging.warning('R %08X : timed out after %ss %s',
+                                        address, self.UDPTimeout, comment)
+                        if telemetry is not None:
+                            telemetry.record_timeout(address)
+                    break
+                if received < response_size or received % response_size:
+                    if telemetry is not None:
+                        telemetry.record_short_response(received)
+                    continue
+                if telemetry is not None:
+                    telemetry.record_received(received)
+                for record in range(0, min(received, (len(batch) - index) * response_size),
+                                    response_size):
+                    data = response_struct.unpack_from(self.rx_buffer, record)[3]
+                    address = batch[index]
+                    results[start + index] = data
+                    index += 1
+                    if telemetry is not None:
+                        telemetry.record_read(address, timer() - sent)
+                    if self.debug:
+                        logging.debug('R %08X : %08X %s', address, data, comment)
+
+        return results
+
+    def read_burst(self, address, count, comment=''):
+        """ Read a contiguous block of registers in as few round trips as possible.
+
+        @param address: the first address to read from
+        @param count: the number of consecutive registers to read
+        @param comment: comment to print out
+        @returns: list of the data read from each register
+        """
+        return self.read_many(list(range(address, address + count)), comment)
+
+    @locked
     def write(self, address, data, comment=''):
 
+        if self.reliable:
+            self.write_many([(address, data)], comment)
+            return
+
         if self.debug:
             logging.debug('W %08X : %08X %s', address, data, comment)
 
-        #create single write command + 5 data cycle nop command for paddings
-        command = struct.pack('=BBBBIQBBBBIQQQQQ', 1,0,0,2, address, data, 9,0,0,255,0, 0,0,0,0,0)
+        #single write command, followed by the 5 data cycle nop command already in the buffer
+        self.COMMAND_STRUCT.pack_into(self.write_buffer, 0, 1, 0, 0, 2, address, data)
 
         #Send the single write command packet
-        self.txsocket.sendto(command,(self.TgtRxUDPIPAddr,self.TgtRxUDPIPPrt))
+        self.txsocket.sendto(self.write_buffer, self.target)
+        if self.telemetry is not None:
+            self.telemetry.record_sent(len(self.write_buffer))
+            self.telemetry.record_write(address)
 
         # TODO: this bit doesn't seem to do anything so I commented it out - Adam 30/09/19
         # if self.ack:
@@ -87,6 +585,51 @@ class RdmaUDP(object):
 
         # return
 
+    @locked
+    def write_many(self, writes, comment=''):
+        """ Write a list of 32 bit values to the target, packing as many as possible per datagram.
+
+        Each datagram holds as many write commands as will fit in the MTU, followed by the
+        same 5 data cycle nop command used to pad a single write.
+        @param writes: list of (address, data) tuples, written in order
+        @param comment: comment to print out
+        @returns: the number of datagrams sent
+        """
+        if self.reliable:
+            return self.write_many_reliable(writes, comment)
+
+        command = self.COMMAND_STRUCT
+        write_size = command.size
+        nop_size = self.NOP_STRUCT.size
+        max_writes = max(1, (self.UDPMax - self.UDP_HEADER_SIZE - nop_size) // write_size)
+
+        # the batch buffer is kept between calls and only grows when the MTU does
+        buffer_size = max_writes * write_size + nop_size
+        if len(self.batch_buffer) < buffer_size:
+            self.batch_buffer = bytearray(buffer_size)
+        buffer = self.batch_buffer
+        view = memoryview(buffer)
+
+        telemetry = self.telemetry
+        datagrams = 0
+        for start in range(0, len(writes), max_writes):
+            offset = 0
+            for address, data in writes[start:start + max_writes]:
+                if self.debug:
+                    logging.debug('W %08X : %08X %s', address, data, comment)
+                command.pack_into(buffer, offset, 1, 0, 0, 2, address, data)
+                offset += write_size
+                if telemetry is not None:
+                    telemetry.record_write(address)
+            self.NOP_STRUCT.pack_into(buffer, offset, 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+            offset += nop_size
+            self.txsocket.sendto(view[:offset], self.target)
+            if telemetry is not None:
+                telemetry.record_sent(offset)
+            datagrams += 1
+
+        return datagrams
+
     def close(self):
         self.txsocket.close()
         self.rxsocket.close()
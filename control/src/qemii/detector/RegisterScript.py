@@ -0,0 +1,80 @@
+"""QEM Register Script.
+
+A named, recorded sequence of FEM-II register writes, compiled once into ready to send datagrams.
+
+Scripts are recorded by running any sequence of QemFem operations while the FEM is recording, and
+replayed in a single call. Only the writes are recorded: reads, and any waits between writes, are
+not part of the script.
+
+Many FEM-II control registers are write-only, and some read back from a different address than
+they are written to, so only registers with a known readback address are verified.
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+
+class RegisterScript():
+    """Recorded sequence of register writes for a single FEM-II."""
+
+    def __init__(self, name):
+        self.name = name
+        self.writes = []
+        # final value written to each register that holds its value
+        self.register_values = {}
+        # value expected at each readback address, in the order first written
+        self.verify_values = {}
+        self.verify_addresses = []
+        self.datagrams = None
+        self.compiled_mtu = None
+
+    def add(self, writes, held=True, readback=None):
+        """Record writes.
+
+        @param writes: list of (address, data) tuples, in the order they were written
+        @param held: whether the registers hold their values. Strobe and trigger writes do not.
+        @param readback: dict of the address each register is read back from, by the address it
+        is written to. Registers not in it are not verified.
+        """
+        self.writes.extend(writes)
+        self.datagrams = None
+        for address, data in writes:
+            if held:
+                self.register_values[address] = data
+            readback_address = (readback or {}).get(address)
+            if readback_address is not None:
+                if readback_address not in self.verify_values:
+                    self.verify_addresses.append(readback_address)
+                self.verify_values[readback_address] = data
+
+    def compile(self, rdma):
+        """Pack the writes into datagrams for the MTU of an RDMA connection."""
+        self.datagrams = rdma.compile_writes(self.writes)
+        self.compiled_mtu = rdma.UDPMax
+        return self.datagrams
+
+    def replay(self, rdma, verify=False):
+        """Send the script, compiling it first if it has not been compiled for this MTU.
+
+        @param rdma: RDMA connection to send it on
+        @param verify: read back every register with a known readback address and compare it
+        @returns: list of (readback address, expected, read) tuples for each register that did
+        not match
+        """
+        if self.datagrams is None or self.compiled_mtu != rdma.UDPMax:
+            self.compile(rdma)
+        rdma.send_datagrams(self.datagrams, self.writes, 'script {}'.format(self.name))
+        mismatches = []
+        if verify and self.verify_addresses:
+            values = rdma.read_many(self.verify_addresses, 'verify script {}'.format(self.name))
+            for address, value in zip(self.verify_addresses, values):
+                expected = self.verify_values[address]
+                if value != expected:
+                    mismatches.append((address, expected, value))
+        return mismatches
+
+    def get_info(self):
+        return {
+            "writes": len(self.writes),
+            "datagrams": len(self.datagrams) if self.datagrams is not None else None,
+            "verified_registers": len(self.verify_addresses)
+        }
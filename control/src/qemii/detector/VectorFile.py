@@ -4,20 +4,55 @@ Opens, Updates, and uploads vector files to the FEM.
 
 Allows a user to change DAC settings, and plot the vector file much like a logic analyser would.
 
+Vector files are read and written either as text, one line of '0' and '1' characters per sequencer
+word, or in a binary format (BINARY_EXTENSION) that is memory mapped when opened:
+
+    header       BINARY_HEADER: magic, version, signal count, loop position, length,
+                 line count, and the byte sizes of the two tables below
+    signal names tab separated, utf-8
+    bias table   unused and written empty, skipped when read. The biases are always decoded
+                 from the DAC data in the body
+    padding      zeros, up to an 8 byte boundary
+    body         one little endian uint64 sequencer word per line, first signal as MSB
+
+A binary file is only unpacked into its bits if they are asked for. Loading it, decoding the
+biases and changing them all work on the sequencer words alone.
+
 Adam Neaves, Detector Systems Software Group, STFC. 2019
 """
 
+import hashlib
 import logging
+import os
 import os.path
+import struct
 from functools import partial
 
+import numpy as np
+
 from odin.adapters.parameter_tree import ParameterTree
 
+from qemii.detector.VectorFileCache import VectorFileCache
+
+
+class VectorFileError(Exception):
+    """Simple exception class for VectorFile to wrap lower-level exceptions."""
+
+    pass
+
 
 class VectorFile():
 
     BIAS_DEPTH = 6
 
+    BINARY_EXTENSION = ".qvec"
+    BINARY_MAGIC = b"QEMV"
+    BINARY_VERSION = 1
+    BINARY_HEADER = struct.Struct("<4sHHIIIII")
+
+    # parsed files, shared between all vector files
+    cache = VectorFileCache()
+
     # bias names, in the order that they appear in the vector file.
     # DEFAULTS IN COMMENTS
     BIAS_NAMES = ["iBiasCol",        # 001100 - 0x0C - 12
@@ -46,10 +81,17 @@ class VectorFile():
         self.vector_loop_position = 0
         self.vector_length = 0
         self.vector_names = []
-        self.vector_data = []
-
-        self.dac_clock_refs = []
-        self.dac_data_vector = []
+        # number of signals, the bits of each line
+        self.vector_width = 0
+        # 2d array of bits, one row per line of the vector file, or None until first used for a
+        # binary file. Use vector_data, which unpacks it when needed
+        self.vector_bits = np.zeros((0, 0), dtype=np.uint8)
+        # each line of vector_data as the 64 bit word loaded into the sequencer RAM
+        self.vector_words = np.zeros(0, dtype=np.uint64)
+
+        # line numbers of the falling edges of the DAC clock, and the DAC data bit at each
+        self.dac_clock_refs = np.zeros(0, dtype=np.intp)
+        self.dac_data_vector = np.zeros(0, dtype=np.uint8)
 
         self.bias = {}
 
@@ -78,7 +120,8 @@ class VectorFile():
             "length": (lambda: self.vector_length, None),
             "loop_pos": (lambda: self.vector_loop_position, None),
             "save": (None, self.write_vector_file),
-            "reset": (None, self.reset_vector_file)
+            "reset": (None, self.reset_vector_file),
+            "cache": self.cache.param_tree
         })
 
     def get_vector_information(self):
@@ -87,26 +130,122 @@ class VectorFile():
         """
         path = os.path.join(self.file_dir, self.file_name)
         path = os.path.expanduser(path)
+        cache_key = self.cache.get_key(path)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            (self.vector_loop_position, self.vector_length, vector_names, self.vector_width,
+             self.vector_bits, self.vector_words) = cached
+            self.vector_names = list(vector_names)
+        else:
+            if self.file_name.endswith(self.BINARY_EXTENSION):
+                self.read_binary_vector_file(path)
+            else:
+                self.read_text_vector_file(path)
+            # the cache makes the arrays read-only, they are copied before any edits
+            self.cache.put(cache_key, self.vector_loop_position, self.vector_length,
+                           self.vector_names, self.vector_width, self.vector_bits,
+                           self.vector_words)
+
+        self.dac_clk_in = self.vector_names.index("dacCLKin")
+        self.dac_dat_in = self.vector_names.index("dacDin")
+
+        logging.info("Loop Position:      %s", self.vector_loop_position)
+        logging.info("Vector File Length: %s", self.vector_length)
+        logging.info("Vector Data Shape: (%d,%d)", len(self.vector_words), self.vector_width)
+
+    @property
+    def vector_data(self):
+        """2d array of bits, one row per line of the vector file, first signal first.
+
+        Binary files are unpacked from their sequencer words the first time this is used.
+        """
+        if self.vector_bits is None:
+            # unpack the words into bits, big endian so the first signal is the first bit
+            word_bytes = self.vector_words.astype('>u8').view(np.uint8).reshape(-1, 8)
+            self.vector_bits = np.unpackbits(word_bytes, axis=1)[:, 64 - self.vector_width:]
+        return self.vector_bits
+
+    @vector_data.setter
+    def vector_data(self, data):
+        self.vector_bits = data
+
+    def get_signal(self, index):
+        """Get the bit of a single signal on every line, without unpacking the whole file."""
+        if self.vector_bits is not None:
+            return self.vector_bits[:, index]
+        shift = np.uint64(self.vector_width - 1 - index)
+        return ((self.vector_words >> shift) & np.uint64(1)).astype(np.uint8)
+
+    def read_text_vector_file(self, path):
+        """Read the vector data from a text vector file"""
         with open(path, 'r') as f:
 
             self.vector_loop_position = int(f.readline())
             self.vector_length = int(f.readline())
             self.vector_names = f.readline().split()
 
-            self.dac_clk_in = self.vector_names.index("dacCLKin")
-            self.dac_dat_in = self.vector_names.index("dacDin")
-
-            logging.info("Loop Position:      %s", self.vector_loop_position)
-            logging.info("Vector File Length: %s", self.vector_length)
-
             # read the remaining data from the file
             vector_data_string = f.read()
 
-        # convert to 2d array
-        self.vector_data = vector_data_string.splitlines()
-        self.vector_data = [[int(y) for y in x] for x in self.vector_data]
+        # convert to 2d array of bits. All lines are the same width, so the characters can be
+        # converted in one go rather than line by line
+        lines = vector_data_string.split()
+        self.vector_data = np.frombuffer("".join(lines).encode('ascii'), dtype=np.uint8)
+        self.vector_data = (self.vector_data - ord('0')).reshape(len(lines), -1)
+        self.vector_width = self.vector_data.shape[1]
+        self.vector_words = self.compile_vector_words()
 
-        logging.info("Vector Data Shape: (%d,%d)", len(self.vector_data), len(self.vector_data[0]))
+    def read_binary_vector_file(self, path):
+        """Read the vector data from a binary vector file.
+
+        The sequencer words are memory mapped copy-on-write, so they are paged in on demand and
+        bias changes never modify the file itself. They are not unpacked into bits.
+        """
+        with open(path, 'rb') as f:
+            meta = f.read(self.BINARY_HEADER.size)
+            if len(meta) != self.BINARY_HEADER.size or meta[:4] != self.BINARY_MAGIC:
+                raise VectorFileError("{} is not a binary vector file".format(path))
+            (_, version, self.vector_width, self.vector_loop_position, self.vector_length,
+             num_lines, names_size, bias_size) = self.BINARY_HEADER.unpack(meta)
+            if version != self.BINARY_VERSION:
+                raise VectorFileError("Unsupported binary vector file version {}".format(version))
+            self.vector_names = f.read(names_size).decode('utf-8').split('\t')
+
+        body_offset = self.BINARY_HEADER.size + names_size + bias_size
+        body_offset += -body_offset % 8
+        self.vector_words = np.memmap(path, dtype='<u8', mode='c',
+                                      offset=body_offset, shape=(num_lines,))
+        self.vector_bits = None
+
+    def write_binary_vector_file(self, path):
+        """Write the vector data to a binary vector file.
+
+        The file is written alongside and renamed into place, so a file that is currently
+        memory mapped is never truncated underneath its mapping.
+        """
+        names = "\t".join(self.vector_names).encode('utf-8')
+        meta = self.BINARY_HEADER.pack(
+            self.BINARY_MAGIC, self.BINARY_VERSION, self.vector_width,
+            self.vector_loop_position, self.vector_length, len(self.vector_words),
+            len(names), 0) + names
+        meta += b'\0' * (-len(meta) % 8)
+
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(meta)
+            f.write(self.vector_words.astype('<u8').tobytes())
+        os.rename(temp_path, path)
+
+    def compile_vector_words(self, lines=None):
+        """Convert lines of the vector data into 64 bit sequencer words, first signal as MSB.
+
+        @param lines: array of line numbers to convert. Converts the whole file if None
+        @returns: array of uint64 words, one per line
+        """
+        data = self.vector_data if lines is None else self.vector_data[lines]
+        padded = np.zeros((data.shape[0], 64), dtype=np.uint8)
+        padded[:, 64 - data.shape[1]:] = data
+        return np.packbits(padded, axis=1).view('>u8').ravel().astype(np.uint64)
 
         # self.extract_clock_references()
 
@@ -115,20 +254,12 @@ class VectorFile():
         Also extract the value associated with the -ve clock position and list them.
         """
 
-        latch = 0  # stores previous value of clk_in
-        # reset the arrays for clock refs and data vectors
-        self.dac_clock_refs = []
-        self.dac_data_vector = []
+        clk_in = self.get_signal(self.dac_clk_in)
 
         # get all instances of Falling Edges for the clock ref (self.dac_clk_in) going from 1 -> 0
-        for i, row in enumerate(self.vector_data):
-            clk_in = row[self.dac_clk_in]
-            if latch != clk_in and latch == 1:
-                # state has changed from 1 to 0
-                self.dac_clock_refs.append(i)
-                self.dac_data_vector.append(row[self.dac_dat_in])
-            latch = clk_in
-        self.clock_step = self.dac_clock_refs[1] - self.dac_clock_refs[0]
+        self.dac_clock_refs = np.flatnonzero((clk_in[:-1] == 1) & (clk_in[1:] == 0)) + 1
+        self.dac_data_vector = self.get_signal(self.dac_dat_in)[self.dac_clock_refs]
+        self.clock_step = int(self.dac_clock_refs[1] - self.dac_clock_refs[0])
         # self.convert_raw_dac_data()
 
     def convert_raw_dac_data(self):
@@ -136,43 +267,55 @@ class VectorFile():
         and keys
         """
 
-        for i, dac_data_name in enumerate(self.BIAS_NAMES):
-            # bias values are 6 bit. each value in dac_data_vector is one bit
-            data_start = i * self.BIAS_DEPTH
-            data_end = (i * self.BIAS_DEPTH) + self.BIAS_DEPTH
-            data = self.dac_data_vector[data_start: data_end]
-            # using join() + list comprehension
-            # converting binary list to integer
-            self.bias[dac_data_name] = int("".join(str(x) for x in data), 2)
+        # bias values are 6 bit. each value in dac_data_vector is one bit, MSB first
+        num_bits = len(self.BIAS_NAMES) * self.BIAS_DEPTH
+        data = self.dac_data_vector[:num_bits].reshape(len(self.BIAS_NAMES), self.BIAS_DEPTH)
+        values = data.dot(1 << np.arange(self.BIAS_DEPTH - 1, -1, -1))
+        for dac_data_name, value in zip(self.BIAS_NAMES, values):
+            self.bias[dac_data_name] = int(value)
 
     def convert_bias_to_raw(self, bias_name):
         """Convert the data in the bias dictionary into the binary representation required
         in the vector file. Modify the dac_data_vector list to represent this changed data.
-        Modify the vector_data list of lists with this new data
+        Modify the vector_data array with this new data, only around the clock edges
+        that carry this bias.
         """
         i = self.BIAS_NAMES.index(bias_name)
         # convert the bias values from the dict into binary values in the dac_data_vector list
         # for i, bias_name in enumerate(self.BIAS_NAMES):
-        bias = '{:0{depth}b}'.format(self.bias[bias_name], depth=self.BIAS_DEPTH)
-        logging.debug("%-16s: %s", bias_name, bias)
+        logging.debug("%-16s: %s", bias_name,
+                      '{:0{depth}b}'.format(self.bias[bias_name], depth=self.BIAS_DEPTH))
+        bias = (self.bias[bias_name] >> np.arange(self.BIAS_DEPTH - 1, -1, -1)) & 1
+        # the biases are clocked in twice, so each bias has two sets of clock edges
         first_start = i * self.BIAS_DEPTH
         second_start = (i + len(self.BIAS_NAMES)) * self.BIAS_DEPTH
-        self.dac_data_vector[first_start: first_start + self.BIAS_DEPTH] = list(bias)
-        self.dac_data_vector[second_start: second_start + self.BIAS_DEPTH] = list(bias)
+        edges = np.concatenate((np.arange(first_start, first_start + self.BIAS_DEPTH),
+                                np.arange(second_start, second_start + self.BIAS_DEPTH)))
+        self.dac_data_vector[edges] = np.tile(bias, 2)
 
-        self.write_bias_to_vector()
+        self.write_bias_to_vector(edges)
 
     def write_vector_file(self, file_name):
         logging.debug("Saving Vector File: %s", file_name)
         if file_name.lower() == "none" or file_name == "":
             file_name = self.file_name
 
-        logging.debug("Converting Biases to Binary")
-        for bias_name in self.BIAS_NAMES:
-            self.convert_bias_to_raw(bias_name)
-
+        # no conversion needed, every bias change is written into vector_data as it is made
         path = os.path.join(self.file_dir, file_name)
         path = os.path.expanduser(path)
+        if file_name.endswith(self.BINARY_EXTENSION):
+            self.write_binary_vector_file(path)
+        else:
+            self.write_text_vector_file(path)
+        self.file_name = file_name
+
+        # the new contents replace any cached ones, even if the file's modification time and size
+        # are unchanged, as they can be on filesystems with a coarse mtime
+        self.cache.put(self.cache.get_key(path), self.vector_loop_position, self.vector_length,
+                       self.vector_names, self.vector_width, self.vector_bits, self.vector_words)
+
+    def write_text_vector_file(self, path):
+        """Write the vector data to a text vector file"""
         with open(path, 'w') as f:
             logging.debug("FILE NAME: %s", f.name)
             f.write("{}\n".format(self.vector_loop_position))
@@ -180,11 +323,12 @@ class VectorFile():
             f.write("\t".join(self.vector_names))
             f.write('\n')
 
-            # write the actual data, line by line
-            for line in self.vector_data:
-                str_line = "".join([str(x) for x in line])
-                f.write("{}\n".format(str_line))
-        self.file_name = file_name
+            # write the actual data as a single block of '0' and '1' characters
+            lines = np.empty((self.vector_data.shape[0], self.vector_data.shape[1] + 1),
+                             dtype=np.uint8)
+            lines[:, :-1] = self.vector_data + ord('0')
+            lines[:, -1] = ord('\n')
+            f.write(lines.tobytes().decode('ascii'))
 
     def set_file_name(self, name):
         # TODO: some form of verification
@@ -199,6 +343,10 @@ class VectorFile():
             self.extract_clock_references()
             self.convert_raw_dac_data()
 
+    def get_hash(self):
+        """SHA-1 of the sequencer words as they are loaded, including any bias changes."""
+        return hashlib.sha1(np.ascontiguousarray(self.vector_words).tobytes()).hexdigest()
+
     def get_bias_val(self, bias_name):
         return self.bias[bias_name]
 
@@ -211,10 +359,29 @@ class VectorFile():
 
         self.convert_bias_to_raw(bias_name)
 
-    def write_bias_to_vector(self):
-        # write all the biases
-        for i, line_num in enumerate(self.dac_clock_refs):  # for each clock edge
-            # get slice of vector data, full distance of clock edge with current edge in center
-            for line in self.vector_data[line_num - (self.clock_step // 2): line_num + (self.clock_step // 2)]:
-                line[self.dac_dat_in] = self.dac_data_vector[i]
+    def write_bias_to_vector(self, edges=None):
+        """Write the DAC data bits into the vector data around their clock edges.
+
+        @param edges: array of indexes into dac_clock_refs to write. Writes all the biases if None
+        """
+        if edges is None:
+            edges = np.arange(len(self.dac_clock_refs))
+        # shared with the cache, so take private copies before the first change
+        if not self.vector_words.flags.writeable:
+            self.vector_words = np.array(self.vector_words)
+        if self.vector_bits is not None and not self.vector_bits.flags.writeable:
+            self.vector_bits = self.vector_bits.copy()
+        # for each clock edge, the lines a full clock step wide with the edge in the centre
+        half_step = self.clock_step // 2
+        lines = self.dac_clock_refs[edges, np.newaxis] + np.arange(-half_step, half_step)
+        bits = np.broadcast_to(self.dac_data_vector[edges, np.newaxis], lines.shape)
+        in_file = (lines >= 0) & (lines < len(self.vector_words))
+        lines = lines[in_file]
+        bits = bits[in_file]
+        if self.vector_bits is not None:
+            self.vector_bits[lines, self.dac_dat_in] = bits
+        # set or clear the DAC data bit of only the sequencer words that were rewritten
+        mask = np.uint64(1) << np.uint64(self.vector_width - 1 - self.dac_dat_in)
+        self.vector_words[lines] = ((self.vector_words[lines] & ~mask) |
+                                    (bits.astype(np.uint64) * mask))
 
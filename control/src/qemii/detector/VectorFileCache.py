@@ -0,0 +1,118 @@
+"""QEM Vector File Cache.
+
+In-process LRU cache of parsed vector file contents, so switching back and forth between the same
+few vector files does not re-read and re-parse them every time.
+
+Entries are keyed by absolute path, modification time and size, so an edited file is never served
+from the cache. Cached arrays are read-only; VectorFile copies them before making any changes, so
+edits can never corrupt the cached original.
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from odin.adapters.parameter_tree import ParameterTree
+
+
+class VectorFileCache():
+    """Least recently used cache of parsed vector files, limited by total array size."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key: (loop position, length, names, width, data, words)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.param_tree = ParameterTree({
+            "hits": (lambda: self.hits, None),
+            "misses": (lambda: self.misses, None),
+            "entries": (lambda: len(self.entries), None),
+            "size": (lambda: self.size, None, {"units": "bytes"}),
+            "limit": (lambda: self.max_bytes, self.set_limit, {"units": "bytes"}),
+            "clear": (None, self.clear)
+        })
+
+    @staticmethod
+    def get_key(path):
+        """Get the cache key for a file, or None if the file cannot be found."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+    def get(self, key):
+        """Get the cached contents for a key, or None if they are not cached.
+
+        @returns: tuple of (loop position, length, signal names, signal count, vector data,
+        vector words). The vector data is None for a file that has not been unpacked into bits
+        """
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # move to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry
+
+    def put(self, key, loop_position, length, names, width, vector_data, vector_words):
+        """Add the parsed contents of a file to the cache.
+
+        The arrays are made read-only, so the caller must copy them before modifying them.
+        @param vector_data: array of bits, or None if the file has not been unpacked into bits
+        """
+        if key is None:
+            return
+        if vector_data is not None:
+            vector_data.flags.writeable = False
+        vector_words.flags.writeable = False
+        entry_size = self.entry_size(vector_data, vector_words)
+        with self.lock:
+            # older versions of the same file will never be used again
+            for old_key in [old_key for old_key in self.entries if old_key[0] == key[0]]:
+                self.remove(old_key)
+            if entry_size > self.max_bytes:
+                logging.debug("Vector file %s too large to cache", key[0])
+                return
+            self.entries[key] = (loop_position, length, list(names), width, vector_data,
+                                 vector_words)
+            self.size += entry_size
+            self.evict()
+
+    def remove(self, key):
+        """Remove an entry. The lock must be held"""
+        entry = self.entries.pop(key)
+        self.size -= self.entry_size(entry[4], entry[5])
+
+    @staticmethod
+    def entry_size(vector_data, vector_words):
+        return (vector_data.nbytes if vector_data is not None else 0) + vector_words.nbytes
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within its limit.
+        The lock must be held"""
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def set_limit(self, max_bytes):
+        with self.lock:
+            self.max_bytes = int(max_bytes)
+            self.evict()
+
+    def clear(self, put_data=None):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,80 @@
+"""QEM Vector File Converter.
+
+Converts the vector files in one or more directories between the text format and the binary,
+memory mappable format read by VectorFile.
+
+    python -m qemii.detector.VectorFileConverter [--to-text] [--pattern PATTERN] DIR [DIR ...]
+
+Detector Systems Software Group, STFC. 2019
+"""
+
+import argparse
+import glob
+import logging
+import os.path
+import sys
+
+from qemii.detector.VectorFile import VectorFile, VectorFileError
+
+TEXT_EXTENSION = ".txt"
+
+
+def convert_vector_file(file_name, file_dir, to_text=False):
+    """Convert a single vector file, writing the result alongside it.
+
+    @param file_name: name of the vector file to convert
+    @param file_dir: directory containing the vector file
+    @param to_text: convert a binary file to text, rather than text to binary
+    @returns: the name of the converted file
+    """
+    root, _ = os.path.splitext(file_name)
+    new_name = root + (TEXT_EXTENSION if to_text else VectorFile.BINARY_EXTENSION)
+    vector_file = VectorFile(file_name, file_dir)
+    vector_file.write_vector_file(new_name)
+    return new_name
+
+
+def convert_directory(file_dir, pattern="QEM*", to_text=False):
+    """Convert every matching vector file in a directory.
+
+    @param file_dir: directory of vector files
+    @param pattern: glob pattern for the file names, without the extension
+    @param to_text: convert binary files to text, rather than text files to binary
+    @returns: list of (source, converted) file names
+    """
+    extension = VectorFile.BINARY_EXTENSION if to_text else TEXT_EXTENSION
+    file_dir = os.path.expanduser(file_dir)
+    converted = []
+    for path in sorted(glob.glob(os.path.join(file_dir, pattern + extension))):
+        file_name = os.path.basename(path)
+        try:
+            converted.append((file_name, convert_vector_file(file_name, file_dir, to_text)))
+        except (VectorFileError, ValueError, IOError) as e:
+            logging.error("Failed to convert %s: %s", path, e)
+    return converted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert QEM vector files between the text and binary formats")
+    parser.add_argument("directories", nargs="+", help="directories of vector files to convert")
+    parser.add_argument("--to-text", action="store_true",
+                        help="convert binary vector files back to text")
+    parser.add_argument("--pattern", default="QEM*",
+                        help="glob pattern for the vector file names, without the extension")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    status = 0
+    for file_dir in args.directories:
+        if not os.path.isdir(os.path.expanduser(file_dir)):
+            logging.error("%s is not a directory", file_dir)
+            status = 1
+            continue
+        for source, converted in convert_directory(file_dir, args.pattern, args.to_text):
+            print("{} -> {}".format(os.path.join(file_dir, source), converted))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,7 @@
 import logging
+import threading
+import time
+from functools import wraps
 
 
 from odin_devices.tca9548 import TCA9548
@@ -13,6 +16,22 @@ import math
 from odin.adapters.parameter_tree import ParameterTree, ParameterTreeError
 
 
+class BackplaneSweepError(Exception):
+    """Simple exception class for AUXSAMPLE sweeps that cannot be started."""
+
+    pass
+
+
+def i2c_locked(method):
+    """Run a Backplane method holding the I2C lock, so it cannot interleave with a sweep step or
+    the sensor polling."""
+    @wraps(method)
+    def locked_method(self, *args, **kwargs):
+        with self.i2c_lock:
+            return method(self, *args, **kwargs)
+    return locked_method
+
+
 class Backplane():
     """ Backplane object, representing a single Backplane module.
 
@@ -20,9 +39,29 @@ class Backplane():
     onbaord the Backplane.
     """
 
+    # AUXSAMPLE DAC registers that can be swept, and their AD5694 channels
+    SWEEP_CHANNELS = {"AUXSAMPLE_COARSE": 1, "AUXSAMPLE_FINE": 4}
+
     def __init__(self):
         #signal.signal(signal.SIGALRM, self.connect_handler)
         #signal.alarm(6)
+        #AUXSAMPLE DAC sweep state, see start_sweep. The I2C lock is reentrant, as setters call
+        #one another
+        self.i2c_lock = threading.RLock()
+        self.sweep_thread = None
+        self.sweep_abort = threading.Event()
+        self.sweep_status = {
+            "in_progress": False,
+            "register": None,
+            "value": None,
+            "dwell": 0.0,
+            "steps_done": 0,
+            "steps_total": 0,
+            "late_steps": 0,
+            "late_step_indices": [],
+            "aborted": False,
+            "error": None
+        }
         try:
             self.voltages = [0.0] * 16
             self.voltages_raw = [0] * 15
@@ -162,6 +201,20 @@ class Backplane():
                 "dacextref":{   "current":(self.get_dacextref, self.set_dacextref_current, {"description": "Controls the DAC external current reference", "units": "uA"}),
                                 "register":(lambda: self.adjust_resistor_raw[2], self.set_dacextref_register_value, {"description":"register that controls the external reference"})
                 },
+                "sweep":{
+                    "start":(None, self.start_sweep, {"description": "Start a sweep of an AUXSAMPLE register, with a dict of register, start, stop and step or values, and dwell"}),
+                    "abort":(None, self.abort_sweep, {"description": "Abort the sweep in progress"}),
+                    "in_progress":(lambda: self.sweep_status["in_progress"], None),
+                    "register":(lambda: self.sweep_status["register"], None),
+                    "value":(lambda: self.sweep_status["value"], None, {"description": "Register value last set by the sweep"}),
+                    "dwell":(lambda: self.sweep_status["dwell"], None, {"units": "s"}),
+                    "steps_done":(lambda: self.sweep_status["steps_done"], None),
+                    "steps_total":(lambda: self.sweep_status["steps_total"], None),
+                    "late_steps":(lambda: self.sweep_status["late_steps"], None, {"description": "Steps set more than half a dwell after they were due"}),
+                    "late_step_indices":(lambda: self.sweep_status["late_step_indices"], None, {"description": "Index of each step set late, so a frame taken in the middle of it may not match it"}),
+                    "aborted":(lambda: self.sweep_status["aborted"], None),
+                    "error":(lambda: self.sweep_status["error"], None, {"description": "Why the last sweep failed, if it did"})
+                },
                 "status":{
                     "level1_PG":(lambda: self.power_good[0], None, {"description": "Level 1 of power supply sequence status"}),
                     "level2_PG":(lambda: self.power_good[1], None, {"description": "Level 2 of power supply sequence status"}),
@@ -231,18 +284,22 @@ class Backplane():
 
     #Functions below are used to modify the register value on the variable supplies
     #VDD_RST & VRESET are voltages monitored by the ADC's on the module
+    @i2c_locked
     def set_vdd_rst_register_value(self, value):
         """Method to change the register value of VDD_RST"""
         self.tpl0102[2].set_wiper(0, value)
         self.adjust_resistor_raw[4] = self.tpl0102[2].get_wiper(0)
+    @i2c_locked
     def set_vdd_rst_voltage(self, value):
         """Method to change the voltage value of VDD_RST"""
         self.tpl0102[2].set_wiper(0, int(1+(18200/0.0001)*(value-1.78)/(390*18200-390*(value-1.78)/0.0001)))
         self.adjust_resistor_raw[4] = self.tpl0102[2].get_wiper(0)
+    @i2c_locked
     def set_vreset_register_value(self, value):
         """Method to change the register value of VRESET"""
         self.tpl0102[2].set_wiper(1, value)
         self.adjust_resistor_raw[5] = self.tpl0102[2].get_wiper(1)
+    @i2c_locked
     def set_vreset_voltage(self, value):
         """Method to change the voltage value of VRESET"""
         self.tpl0102[2].set_wiper(1, int(1+(49900/0.0001)*value/(390*49900-390*value/0.0001)))
@@ -251,10 +308,12 @@ class Backplane():
     # The following voltages are calculated and NOT monitored with an ADC on the module
     def calc_vctrl_voltage(self, value):
         return -3.775 + (1.225/22600 + .35*.000001) * (390 * self.adjust_resistor_raw[6] + 32400)
+    @i2c_locked
     def set_vctrl_register_value(self, value):
         self.tpl0102[3].set_wiper(0, value)
         self.adjust_resistor_raw[6] = self.tpl0102[3].get_wiper(0)
         self.adjust_voltage[6]= self.calc_vctrl_voltage(6)
+    @i2c_locked
     def set_vctrl_voltage(self, value):
         self.tpl0102[3].set_wiper(0, int(1+((value+3.775)/(1.225/22600+.35*.000001)-32400)/390))
         self.adjust_resistor_raw[6] = self.tpl0102[3].get_wiper(0)
@@ -267,11 +326,13 @@ class Backplane():
     def calc_aux_vcm_register(self, value):
         """Same calculation required for AUXREST and VCM to calculate the register value from a voltage"""
         return int(0.5+(32000/3.3)*value/(390-390*value/3.3))
+    @i2c_locked
     def set_aux_vcm_register_value(self, wiper, vector, value):
         """Sets the register value, pass vector number and value"""
         self.tpl0102[0].set_wiper(wiper, value)
         self.adjust_resistor_raw[vector] = self.tpl0102[0].get_wiper(wiper)
         self.adjust_voltage[vector] = self.calc_aux_vcm_voltage(vector)
+    @i2c_locked
     def set_aux_vcm_voltage(self, wiper, vector, value):
         """Sets the voltage for AUXSAMPLE and VCM"""
         self.tpl0102[0].set_wiper(wiper, self.calc_aux_vcm_register(value))
@@ -332,6 +393,7 @@ class Backplane():
         self.update = value
 
     #functions to control the external chip current DACEXTREF - START
+    @i2c_locked
     def set_dacextref_register_value(self, value):
         """Method to set the register value of the DAXEXTREF, attached to list tpl0102[1] and wiper 0"""
         self.tpl0102[1].set_wiper(0, value)
@@ -353,11 +415,13 @@ class Backplane():
     def calc_coarse_common(self):
         self.voltages[13] = self.voltages_raw[13] * 0.0003734
         self.voltages[15] = self.voltages[13] + self.voltages[14] + 0.197
+    @i2c_locked
     def set_coarse_register(self, value):
         """This function sets the coarse register value"""
         self.voltages_raw[13] = value
         self.calc_coarse_common()
         self.ad5694.set_from_value(1, value)
+    @i2c_locked
     def set_coarse_voltage(self, value):
         """This function sets the coarse voltage value"""
         self.voltages_raw[13] = int(value / 0.0003734)
@@ -368,17 +432,113 @@ class Backplane():
     def calc_fine_common(self):
         self.voltages[14] = self.voltages_raw[14] * 0.00002
         self.voltages[15] = self.voltages[13] + self.voltages[14] + 0.197
+    @i2c_locked
     def set_fine_register(self, value):
         """This sets the fine register value"""
         self.voltages_raw[14] = value
         self.calc_fine_common()
         self.ad5694.set_from_value(4, value) 
+    @i2c_locked
     def set_fine_voltage(self, value):
         """This sets the fine voltage value"""
         self.voltages_raw[14] = int(value / 0.00002)
         self.calc_fine_common()
         self.ad5694.set_from_voltage(4, value)
 
+    #AUXSAMPLE DAC sweep
+    def start_sweep(self, settings):
+        """Start a sweep of an AUXSAMPLE DAC register, stepped locally in a background thread.
+
+        Each step is set at the start time + step index * dwell, so the steps stay evenly spaced
+        however long each I2C write takes. The first step is set before this returns, so a caller
+        can time its own steps from the response. Sensor polling is paused while the sweep runs.
+
+        @param settings: dict of register (AUXSAMPLE_COARSE or AUXSAMPLE_FINE), start, stop
+        (exclusive), step, and dwell time per step in seconds. Instead of start, stop and step, a
+        list of values sets each value in turn.
+        @raises BackplaneSweepError: if a sweep is already in progress, or the settings are invalid
+        """
+        if self.sweep_status["in_progress"]:
+            raise BackplaneSweepError("AUXSAMPLE sweep already in progress")
+        try:
+            register = settings.get("register", "")
+            if "values" in settings:
+                values = [int(value) for value in settings["values"]]
+            else:
+                values = range(int(settings.get("start", 0)), int(settings["stop"]),
+                               int(settings.get("step", 1)))
+            dwell = float(settings.get("dwell", 0.01))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise BackplaneSweepError("Invalid AUXSAMPLE sweep settings {}: {}".format(settings, e))
+        if register not in self.SWEEP_CHANNELS:
+            raise BackplaneSweepError("Cannot sweep register {}".format(register))
+        if not values or dwell <= 0:
+            raise BackplaneSweepError("AUXSAMPLE sweep has no steps")
+
+        self.sweep_abort.clear()
+        self.sweep_status.update({
+            "in_progress": True,
+            "register": register,
+            "value": None,
+            "dwell": dwell,
+            "steps_done": 0,
+            "steps_total": len(values),
+            "late_steps": 0,
+            "late_step_indices": [],
+            "aborted": False,
+            "error": None
+        })
+        start_time = time.time()
+        try:
+            self.set_sweep_step(register, values[0])
+        except Exception as e:
+            self.sweep_status.update({"in_progress": False, "aborted": True, "error": str(e)})
+            raise BackplaneSweepError("AUXSAMPLE sweep failed to set its first step: {}".format(e))
+        self.sweep_thread = threading.Thread(target=self.sweep_loop,
+                                             args=(register, values, dwell, start_time))
+        self.sweep_thread.daemon = True
+        self.sweep_thread.start()
+
+    def sweep_loop(self, register, values, dwell, start_time):
+        """Set the remaining steps of a sweep, each at its own deadline."""
+        try:
+            for index in range(1, len(values)):
+                deadline = start_time + index * dwell
+                if self.sweep_abort.wait(max(0, deadline - time.time())):
+                    self.sweep_status["aborted"] = True
+                    logging.warning("AUXSAMPLE sweep aborted after %d steps",
+                                    self.sweep_status["steps_done"])
+                    return
+                self.set_sweep_step(register, values[index])
+                # set after the middle of the step, where the calibrator takes its frame
+                if time.time() > deadline + dwell / 2:
+                    self.sweep_status["late_steps"] += 1
+                    self.sweep_status["late_step_indices"].append(index)
+            #hold the last step for its full dwell before reporting the sweep complete
+            self.sweep_abort.wait(max(0, start_time + len(values) * dwell - time.time()))
+            logging.debug("AUXSAMPLE sweep of %d steps complete, %d late",
+                          len(values), self.sweep_status["late_steps"])
+        except Exception as e:
+            self.sweep_status["aborted"] = True
+            self.sweep_status["error"] = str(e)
+            logging.error("AUXSAMPLE sweep failed: %s", e)
+        finally:
+            self.sweep_status["in_progress"] = False
+
+    def set_sweep_step(self, register, value):
+        with self.i2c_lock:
+            if register == "AUXSAMPLE_COARSE":
+                self.set_coarse_register(value)
+            else:
+                self.set_fine_register(value)
+        self.sweep_status["value"] = value
+        self.sweep_status["steps_done"] += 1
+
+    def abort_sweep(self, value=None):
+        """Abort the sweep in progress, leaving the register at the last step set"""
+        self.sweep_abort.set()
+
+    @i2c_locked
     def set_gpios(self):
         if self.backplane_power == 1:
             self.mcp23008[1].output(0, MCP23008.HIGH)
@@ -388,11 +548,12 @@ class Backplane():
     
     def poll_all_sensors(self):
         """This function calls all the update functions that are executed every 1 second(s) if update = true"""
-        if self.update == True:
-            self.update_voltages()
-            self.update_currents()
-            self.power_good = self.mcp23008[0].input_pins([0,1,2,3,4,5,6,7,8])
-            self.set_gpios()
+        if self.update == True and not self.sweep_status["in_progress"]:
+            with self.i2c_lock:
+                self.update_voltages()
+                self.update_currents()
+                self.power_good = self.mcp23008[0].input_pins([0,1,2,3,4,5,6,7,8])
+                self.set_gpios()
 
 
     def update_voltages(self):
@@ -21,7 +21,7 @@ from odin.adapters.adapter import ApiAdapter, ApiAdapterResponse, request_types,
 from odin.adapters.parameter_tree import ParameterTree, ParameterTreeError
 from odin._version import get_versions
 
-from qemii.fem.Backplane import Backplane
+from qemii.fem.Backplane import Backplane, BackplaneSweepError
 
 
 class BackplaneAdapter(ApiAdapter):
@@ -91,7 +91,7 @@ class BackplaneAdapter(ApiAdapter):
             self.backplane.set(path, data)
             response = self.backplane.get(path)
             status_code = 200
-        except BackplaneError as e:
+        except (BackplaneError, BackplaneSweepError) as e:
             response = {'error': str(e)}
             status_code = 400
         except (TypeError, ValueError) as e:
@@ -0,0 +1,73 @@
+"""
+Test Cases for the QEMII CalibrationAnalyser in qemii.detector
+Detector Systems Software Group, STFC
+"""
+
+import pytest
+import numpy as np
+
+from qemii.detector.CalibrationAnalyser import CalibrationAnalyser, COARSE_BIT_MASK
+
+
+def ramp_frames(steps, rows, columns, gains, offsets):
+    """Frames of a fine ramp, each column with its own gain and offset, saturating at 0 and 63"""
+    codes = np.clip(np.round(np.arange(steps)[:, np.newaxis] * gains + offsets), 0, 63)
+    return np.repeat(codes[:, np.newaxis, :], rows, axis=1).astype(np.uint16)
+
+
+class TestCalibrationAnalyser():
+
+    def test_offsets_and_gains(self):
+        """Test that each column's gain and offset are found, ignoring where it saturates"""
+        gains = np.array([0.5, 0.25, 1.0])
+        offsets = np.array([-10.0, 5.0, 2.0])
+        frames = ramp_frames(200, 3, 3, gains, offsets)
+        analyser = CalibrationAnalyser.for_type("fine", np.arange(200), 3)
+        # blocks in any order, and split across calls
+        analyser.add_frames(frames[100:], 100)
+        analyser.add_dataset(frames[:100])
+        results = analyser.results()
+        assert analyser.frames_added == 200
+        np.testing.assert_allclose(results["gains"], gains, rtol=0.02)
+        np.testing.assert_allclose(results["offsets"], offsets, atol=0.5)
+
+    def test_missing_codes(self):
+        """Test that codes skipped within a column's range are reported, and only those"""
+        frames = ramp_frames(64, 2, 2, np.array([1.0, 1.0]), np.array([0.0, 0.0]))
+        frames[:, :, 1][frames[:, :, 1] == 17] = 18
+        analyser = CalibrationAnalyser.for_type("fine", np.arange(64), 2)
+        analyser.add_frames(frames[:40])
+        results = analyser.results()
+        assert list(results["missing_code_count"]) == [0, 1]
+        assert np.flatnonzero(results["missing_codes"][1]) == [17]
+
+    def test_coarse_bits(self):
+        analyser = CalibrationAnalyser.for_type("coarse", [0.0], 1)
+        analyser.add_frames(np.array([[[0x7C0 | 0x3F]]], dtype=np.uint16))
+        assert analyser.codes == 32
+        assert analyser.curves()[0, 0] == COARSE_BIT_MASK >> 6
+
+    def test_save(self, tmp_path):
+        analyser = CalibrationAnalyser.for_type("fine", np.arange(4), 288)
+        analyser.add_frames(np.zeros((4, 2, 288), dtype=np.uint16))
+        analyser.save(str(tmp_path / "cal.npz"))
+        results = np.load(str(tmp_path / "cal.npz"))
+        assert results["gains"].shape == (288,)
+        assert results["missing_codes"].shape == (288, 64)
+
+    def test_slabs_within_budget(self, tmp_path):
+        """Test that slabs are whole chunks within the budget, and give the same result"""
+        h5py = pytest.importorskip("h5py")
+        frames = np.random.randint(0, 0x800, (100, 4, 8)).astype(np.uint16)
+        with h5py.File(str(tmp_path / "cal.h5"), "w") as f:
+            f.create_dataset("data", data=frames, chunks=(4, 4, 8))
+        frame_bytes = 4 * 8 * (2 + np.dtype(np.intp).itemsize + 2)
+        whole = CalibrationAnalyser.for_type("fine", np.arange(93), 8)
+        whole.add_frames(frames[7:])
+        with h5py.File(str(tmp_path / "cal.h5"), "r") as f:
+            assert CalibrationAnalyser.slab_frames(f["data"], 10 * frame_bytes) == 8
+            assert CalibrationAnalyser.slab_frames(f["data"], 2 * frame_bytes) == 2
+            slabs = CalibrationAnalyser.for_type("fine", np.arange(93), 8)
+            slabs.add_dataset(f["data"], 7, memory_budget=10 * frame_bytes)
+        np.testing.assert_array_equal(slabs.sums, whole.sums)
+        np.testing.assert_array_equal(slabs.code_counts, whole.code_counts)
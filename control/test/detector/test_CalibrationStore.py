@@ -0,0 +1,71 @@
+"""
+Test Cases for the QEMII CalibrationStore in qemii.detector
+Detector Systems Software Group, STFC
+"""
+
+import numpy as np
+
+from qemii.detector.CalibrationStore import CalibrationStore, make_key, key_id
+
+
+def make_results(gain):
+    return {
+        "voltages": np.arange(4, dtype=np.float64),
+        "curves": np.arange(8, dtype=np.float32).reshape(4, 2) * gain,
+        "gains": np.array([gain, gain])
+    }
+
+
+class TestCalibrationStore():
+
+    def test_key(self):
+        """Test that the key depends on every condition, but not the order of the biases"""
+        key = make_key("fine", 0, 4096, 1, 2000, "0123", {"iBiasPLL": 20, "iBiasLVDS": 45})
+        same = make_key("fine", 0, 4096, 1, 2000, "0123", {"iBiasLVDS": 45, "iBiasPLL": 20})
+        assert key_id(key) == key_id(same)
+        assert key_id(key) != key_id(make_key("fine", 0, 4096, 1, 2000, "0123", {"iBiasPLL": 21}))
+        assert key_id(key) != key_id(make_key("coarse", 0, 4096, 1, 2000, "0123",
+                                              {"iBiasPLL": 20, "iBiasLVDS": 45}))
+
+    def test_put_and_find(self, tmp_path):
+        """Test that the latest run under the same conditions, from the same frames, is found"""
+        store = CalibrationStore(str(tmp_path / "calibration"))
+        key = make_key("fine", 0, 4, 1, 2000)
+        source = {"data_file": "cal.h5", "first_frame": 0, "frames": 4}
+        store.put(key, make_results(1), source)
+        latest = store.put(key, make_results(2), source, {"frames": 4})
+
+        assert store.find(key)["id"] == latest["id"]
+        assert store.find(key, source)["id"] == latest["id"]
+        assert store.find(key, dict(source, first_frame=4)) is None
+        assert store.find(make_key("fine", 0, 4, 2, 2000)) is None
+        assert np.array_equal(store.get(latest["id"])["gains"], [2, 2])
+        assert store.get("missing") is None
+
+    def test_incomplete_runs_not_found(self, tmp_path):
+        """Test that a run from a failed sweep is stored, but only found when asked for"""
+        store = CalibrationStore(str(tmp_path / "calibration"))
+        key = make_key("fine", 0, 4, 1, 2000)
+        complete = store.put(key, make_results(1))
+        failed = store.put(key, make_results(2), failure_reason="calibration aborted")
+
+        assert not failed["complete"]
+        assert failed["failure_reason"] == "calibration aborted"
+        assert store.find(key)["id"] == complete["id"]
+        assert store.find(key, include_incomplete=True)["id"] == failed["id"]
+        assert [entry["complete"] for entry in store.list_runs()] == [True, False]
+
+    def test_index_reloaded(self, tmp_path):
+        """Test that runs are found again, and loaded from their files, by a new store"""
+        directory = str(tmp_path / "calibration")
+        key = make_key("coarse", 0, 4, 1, 2000)
+        entry = CalibrationStore(directory).put(key, make_results(3), summary={"frames": 4})
+
+        store = CalibrationStore(directory, max_loaded=1)
+        assert store.list_runs() == [entry]
+        results = store.get(entry["id"])
+        assert results["curves"].dtype == np.float32
+        assert np.array_equal(results["curves"], make_results(3)["curves"])
+        # the least recently used run is dropped from memory
+        other = store.put(make_key("fine", 0, 4, 1, 2000), make_results(1))
+        assert list(store.loaded) == [other["id"]]
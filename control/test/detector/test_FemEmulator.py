@@ -0,0 +1,76 @@
+"""
+Test Cases for the QEMII FemEmulator in qemii.detector
+Detector Systems Software Group, STFC
+"""
+
+import sys
+import pytest
+import struct
+
+if sys.version_info[0] == 3:  # pragma: no cover
+    from unittest.mock import Mock, MagicMock, call, patch
+else:                         # pragma: no cover
+    from mock import Mock, MagicMock, call, patch
+
+from qemii.detector.FemEmulator import FemEmulator
+
+NOP = struct.pack('=BBBBIQQQQQ', 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+
+
+def write_command(address, data):
+    return struct.pack('=BBBBIQ', 1, 0, 0, 2, address, data)
+
+
+def read_command(address):
+    return struct.pack('=BBBBIQ', 1, 0, 0, 3, address, 0)
+
+
+@pytest.fixture
+def test_emulator():
+    """Test Fixture for testing the FemEmulator"""
+
+    test_emulator = FemEmulator()
+    yield test_emulator
+
+
+class TestFemEmulator():
+
+    def test_batched_write_then_read(self, test_emulator):
+        """Test that every write in a batched datagram is applied, and can be read back"""
+        responses = test_emulator.process(
+            write_command(0xD0000001, 10) + write_command(0xD0000002, 2) + NOP)
+        assert responses == []
+        responses = test_emulator.process(read_command(0xD0000002) + NOP)
+        assert len(responses) == 1
+        decoded = struct.unpack('=IIIIQQQQQ', responses[0])
+        assert decoded[3] == 2
+
+    def test_sequencer_ram(self, test_emulator):
+        """Test that writes to the sequencer RAM are stored in the RAM model"""
+        test_emulator.process(write_command(0xB1000000, 0xAAAA) +
+                              write_command(0xB1000001, 0x5555) + NOP)
+        assert test_emulator.sequencer_ram == {0: 0xAAAA, 1: 0x5555}
+
+    def test_lock_after_idelay_load_and_sequencer_start(self, test_emulator):
+        """Test that the idelay only locks once loaded and the sequencer is running"""
+        assert test_emulator.read(0xC0000013) == 0
+        test_emulator.process(write_command(0xC0000002, 0x01020304) +
+                              write_command(0xC0000000, 0x10) + write_command(0xC0000000, 0) + NOP)
+        assert test_emulator.read(0xC0000012) == 0x01020304
+        assert test_emulator.read(0xC0000013) == 0
+        test_emulator.process(write_command(0xB0000000, 0) + write_command(0xB0000000, 1) + NOP)
+        assert test_emulator.read(0xC0000013) == 1
+        assert test_emulator.read(0xC0000014) == 0xFFFFFFFF
+
+    def test_reliable_duplicates_discarded(self, test_emulator):
+        """Test that a resent reliable datagram is only written once, and is acknowledged"""
+        datagram = write_command(0xC0000000, 0x10) + struct.pack(
+            '=BBBBIQQQQQ', 9, 7, 0, 255, 0, 0, 0, 0, 0, 0)
+        test_emulator.process(datagram)
+        test_emulator.process(datagram)
+        assert test_emulator.writes == 1
+        assert test_emulator.duplicates == 1
+
+        request = struct.pack('=BBBBIQQQQQ', 9, 0, 0, 255, 0xFFFFFFFF, 6, 3, 1, 0, 0)
+        ack = struct.unpack('=IIIIQQQQQ', test_emulator.process(request)[0])
+        assert ack[:5] == (0xAC4B0000, 6, 3, 1, 0b010)
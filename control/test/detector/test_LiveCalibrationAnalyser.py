@@ -0,0 +1,90 @@
+"""
+Test Cases for the QEMII LiveCalibrationAnalyser in qemii.detector
+Detector Systems Software Group, STFC
+"""
+
+import json
+import time
+import pytest
+import numpy as np
+import h5py
+import zmq
+
+from qemii.detector.LiveCalibrationAnalyser import LiveCalibrationAnalyser
+
+
+def ramp_frames(steps, rows=2, columns=4):
+    codes = np.arange(steps)[:, np.newaxis, np.newaxis] % 64
+    return np.repeat(np.repeat(codes, rows, axis=1), columns, axis=2).astype(np.uint16)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestLiveCalibrationAnalyser():
+
+    def test_live_view(self):
+        """Test that live view frames are placed by frame number, leaving gaps for dropped frames"""
+        publisher = zmq.Context.instance().socket(zmq.PUB)
+        port = publisher.bind_to_random_port("tcp://127.0.0.1")
+        live = LiveCalibrationAnalyser("fine", np.arange(8), "zmq",
+                                       endpoint="tcp://127.0.0.1:{}".format(port),
+                                       poll_interval=0.01)
+        live.start()
+        try:
+            frames = ramp_frames(8)
+            # the subscription takes a moment to reach the publisher
+            time.sleep(0.3)
+            for index, frame in enumerate(frames):
+                if index == 3:
+                    continue
+                header = {"frame_num": 100 + index, "dtype": "uint16",
+                          "shape": [str(dimension) for dimension in frame.shape]}
+                publisher.send_multipart([json.dumps(header).encode("utf-8"), frame.tobytes()])
+            assert wait_for(lambda: live.steps_added == 7)
+        finally:
+            live.stop()
+            publisher.close()
+        curves = live.analyser.curves()
+        assert np.isnan(curves[3, 0])
+        assert list(curves[[0, 1, 2, 4, 7], 0]) == [0, 1, 2, 4, 7]
+        assert not live.wait_for_frames(0)
+
+    def test_swmr_tail(self, tmp_path):
+        """Test that frames are read as they are appended, from the first frame of the sweep"""
+        frames = ramp_frames(12)
+        file_name = str(tmp_path / "cal_000001.h5")
+        with h5py.File(file_name, "w", libver="latest") as hdf_file:
+            # the first dataset in the file is read, as adc_plot does, whatever it is named
+            dataset = hdf_file.create_dataset("qem", data=frames[:4], maxshape=(None, 2, 4),
+                                              chunks=(1, 2, 4))
+            hdf_file.swmr_mode = True
+            live = LiveCalibrationAnalyser("fine", np.arange(8), "swmr",
+                                           file_pattern=str(tmp_path / "*cal*h5"),
+                                           first_frame=2, poll_interval=0.01)
+            live.start()
+            try:
+                assert wait_for(lambda: live.steps_added == 2)
+                dataset.resize((12, 2, 4))
+                dataset[4:] = frames[4:]
+                dataset.flush()
+                assert live.wait_for_frames(5)
+            finally:
+                live.stop()
+        assert list(live.analyser.curves()[:, 0]) == list(range(2, 10))
+        assert live.frames_outside_sweep == 2
+
+    def test_check(self):
+        """Test that a sweep is only judged once enough of it has been taken"""
+        live = LiveCalibrationAnalyser("fine", np.arange(100))
+        assert live.check(5, 10, 0.5) is None
+        assert "no frames" in live.check(10, 10, 0.5)
+        frames = ramp_frames(20)
+        frames[:, :, :3] = 5
+        live.add_frames(frames, 0)
+        assert "3 of 4 columns" in live.check(20, 10, 0.5)
+        assert live.check(20, 10, 0.8) is None
@@ -0,0 +1,113 @@
+"""
+Test Cases for the QEMII QemEyeScan in qemii.detector
+Detector Systems Software Group, STFC
+"""
+
+import sys
+import pytest
+
+if sys.version_info[0] == 3:  # pragma: no cover
+    from unittest.mock import Mock, MagicMock, call, patch
+else:                         # pragma: no cover
+    from mock import Mock, MagicMock, call, patch
+
+from qemii.detector.QemEyeScan import find_eye_centre
+from qemii.detector.QemFem import QemFem
+from qemii.detector.FemEmulator import FemEmulator, EyeModel
+
+
+class EmulatedRdma(object):
+    """Connects a QemFem straight to a FemEmulator, without any sockets"""
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def write_many(self, writes, comment=''):
+        for address, data in writes:
+            self.emulator.write(address, data)
+
+    def read(self, address, comment=''):
+        return self.emulator.read(address)
+
+    def read_burst(self, address, count, comment=''):
+        return [self.emulator.read(address + offset) for offset in range(count)]
+
+    def close(self):
+        pass
+
+
+class EyeScanTestFixture(object):
+
+    def __init__(self):
+        self.emulator = FemEmulator(EyeModel())
+        self.emulator.sequencer_running = True
+        with patch("qemii.detector.QemFem.VectorFile"):
+            self.fem = QemFem("127.0.0.1", 8888, 0, "127.0.0.1", "127.0.0.1",
+                              "127.0.0.1", "127.0.0.1")
+        self.fem.x10g_rdma = EmulatedRdma(self.emulator)
+        self.scan = self.fem.eye_scan
+        self.scan.settle_time = 0
+        # the shift registers as set by setup_camera
+        self.fem.set_scsr(7, 7, 7, 7)
+        self.fem.set_ivsr(0, 0, 27, 27)
+
+
+@pytest.fixture
+def test_eye_scan():
+    """Test Fixture for testing the QemEyeScan"""
+
+    test_eye_scan = EyeScanTestFixture()
+    yield test_eye_scan
+
+
+class TestEyeScan():
+
+    def test_find_eye_centre(self):
+        assert find_eye_centre([False, True, True, False, True, True, True, True]) == (5, 4)
+        assert find_eye_centre([True, True, True]) == (1, 3)
+        assert find_eye_centre([False, False]) == (None, 0)
+
+    def test_scan_finds_and_applies_eye(self, test_eye_scan):
+        """Test that the scan finds the centre of each lane's eye and leaves the FEM locked"""
+        with patch.object(EmulatedRdma, "read_burst") as read_burst:
+            results = test_eye_scan.scan.scan()
+        read_burst.assert_not_called()
+
+        assert results["applied"]
+        assert results["idelay_common"]["centre"] == 14
+        centres = dict((lane, result["centre"]) for lane, result in results["idelay"].items())
+        assert centres == {"data_1": 12, "cdn_1": 15, "data_0": 17, "cdn_0": 13}
+        assert results["shift"]["data_1"]["scsr"] == 7
+        assert results["shift"]["data_1"]["ivsr"] == 0
+        assert results["shift"]["cdn_0"]["ivsr"] == 27
+        assert results["shift"]["cdn_0"]["passed"][27][7]
+        assert results["points"] == 32 + (4 * 32) + (2 * 8 * 32)
+
+        status = test_eye_scan.fem.get_status()
+        assert status.locked
+        assert status.idelay == [12, 15, 17, 13]
+        assert status.aligner_status == [0xFFFF, 0xFFFF]
+
+    def test_scan_restores_without_eye(self, test_eye_scan):
+        """Test that the original settings are restored when a lane has no eye"""
+        test_eye_scan.emulator.eye_model.ivsr = [0, 0, 27, 40]  # beyond ivsr_max
+        results = test_eye_scan.scan.scan()
+
+        assert not results["applied"]
+        assert results["shift"]["cdn_0"]["scsr"] is None
+        assert test_eye_scan.fem.get_status().idelay == [0, 0, 0, 0]
+        assert test_eye_scan.emulator.read(0xC0000003) == 27 << 8 | 27
+
+    def test_scan_restores_after_invalidate(self, test_eye_scan):
+        """Test that a failed scan restores the idelay read back from the FEM, and the
+        setup_camera shift settings once the shadow registers have been invalidated"""
+        test_eye_scan.emulator.eye_model.ivsr = [0, 0, 27, 40]
+        test_eye_scan.fem.set_idelay(3, 4, 5, 6)
+        test_eye_scan.fem.set_scsr(1, 1, 1, 1)
+        test_eye_scan.fem.invalidate_register_shadow()
+        results = test_eye_scan.scan.scan()
+
+        assert not results["applied"]
+        assert test_eye_scan.fem.get_status().idelay == [3, 4, 5, 6]
+        assert test_eye_scan.emulator.read(0xC0000005) == 0x07070707
+        assert test_eye_scan.emulator.read(0xC0000003) == 27 << 8 | 27
@@ -0,0 +1,95 @@
+"""
+Test Cases for the QEMII RdmaMux in qemii.detector
+Detector Systems Software Group, STFC
+"""
+
+import sys
+import pytest
+
+if sys.version_info[0] == 3:  # pragma: no cover
+    from unittest.mock import Mock, MagicMock, call, patch
+else:                         # pragma: no cover
+    from mock import Mock, MagicMock, call, patch
+
+from qemii.detector.RdmaMux import RdmaMux, RdmaSession
+from qemii.detector.FemEmulator import FemEmulatorServer
+
+
+class RdmaMuxTestFixture(object):
+
+    def __init__(self):
+        # ephemeral ports, with each emulated FEM on its own loopback address
+        self.mux = RdmaMux("127.0.0.1", 0, 0)
+        rx_port = self.mux.rxsocket.getsockname()[1]
+        self.servers = [FemEmulatorServer(address, 0, rx_port)
+                        for address in ("127.0.0.2", "127.0.0.3")]
+        self.sessions = []
+        for server in self.servers:
+            server.start()
+            address, port = server.socket.getsockname()
+            session = self.mux.open_session(address, port, UDPTimeout=2)
+            session.ack = True
+            self.sessions.append(session)
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+        for server in self.servers:
+            server.stop()
+
+
+@pytest.fixture
+def test_mux():
+    """Test Fixture for testing the RdmaMux"""
+
+    test_mux = RdmaMuxTestFixture()
+    yield test_mux
+    test_mux.close()
+
+
+class TestRdmaMux():
+
+    def test_responses_demultiplexed(self, test_mux):
+        """Test that each session only receives the responses from its own FEM"""
+        for value, session in enumerate(test_mux.sessions):
+            session.write_many([(0xD0000001, value + 10)])
+        for value, session in enumerate(test_mux.sessions):
+            assert isinstance(session, RdmaSession)
+            assert session.read(0xD0000001) == value + 10
+        assert test_mux.mux.unmatched_responses == 0
+
+    def test_reconnect_replaces_session(self, test_mux):
+        """Test that a FEM reconnecting is given a new session, and closing the old one keeps it"""
+        old = test_mux.sessions[0]
+        address, port = test_mux.servers[0].socket.getsockname()
+        old.write_many([(0xD0000001, 7)])
+        new = test_mux.mux.open_session(address, port, UDPTimeout=2)
+        new.ack = True
+        test_mux.sessions[0] = new
+        old.close()
+        assert new.read(0xD0000001) == 7
+        assert test_mux.mux.sessions[address] is new.session_socket
+
+    def test_late_response_discarded(self, test_mux):
+        """Test that the response to a read that timed out is not taken for the next read"""
+        session = test_mux.sessions[0]
+        session.write_many([(0xD0000001, 5), (0xD0000002, 6)])
+        session.session_socket.responses.put(b"late")
+        session.stale_responses = True
+        assert session.read(0xD0000002) == 6
+        assert session.session_socket.responses.empty()
+
+    def test_closed_with_last_session(self, test_mux):
+        """Test that the shared sockets are only closed once every session has closed"""
+        test_mux.sessions[0].close()
+        assert test_mux.mux.running
+        test_mux.sessions[1].close()
+        assert not test_mux.mux.running
+
+    def test_registry(self):
+        """Test that the same multiplexer is shared for a server address"""
+        with patch.object(RdmaMux, "__init__", return_value=None) as mux_init:
+            mux = RdmaMux.get("10.0.1.2")
+            assert RdmaMux.get("10.0.1.2") is mux
+            mux_init.assert_called_once_with("10.0.1.2", 61650, 61651)
+        del RdmaMux.registry[("10.0.1.2", 61650, 61651)]
@@ -65,14 +65,31 @@ class TestVectorFile():
         test_vector_file.vector_file.bias["test_bias_2"] = 0
         test_vector_file.vector_file.convert_bias_to_raw("test_bias")
         test_vector_file.vector_file.convert_bias_to_raw("test_bias_2")
-        assert test_vector_file.vector_file.dac_data_vector == [
-            "1", "1", "1", "0", "0", "0", "1", "1", "1", "0", "0", "0"]
+        assert test_vector_file.vector_file.dac_data_vector.tolist() == [
+            1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0]
+
+    def test_vector_words(self, test_vector_file):
+        assert test_vector_file.vector_file.vector_words.tolist() == [
+            int(line, 2) for line in test_vector_file.vector_data]
+
+    def test_vector_words_follow_bias(self, test_vector_file):
+        vector_file = test_vector_file.vector_file
+        vector_file.set_bias_val("test_bias", 2)
+        assert vector_file.vector_words.tolist() == [
+            int("".join(str(x) for x in line), 2) for line in vector_file.vector_data]
+
+    def test_bias_change_only_touches_own_edges(self, test_vector_file):
+        vector_file = test_vector_file.vector_file
+        with patch.object(vector_file, "write_bias_to_vector") as mocked_write:
+            vector_file.set_bias_val("test_bias_2", 7)
+            edges = mocked_write.call_args[0][0]
+        assert edges.tolist() == [3, 4, 5, 9, 10, 11]
 
     def test_get_set_bias(self, test_vector_file):
         test_vector_file.vector_file.set_bias_val("test_bias", 2)
         assert test_vector_file.vector_file.get_bias_val("test_bias") == 2
-        assert test_vector_file.vector_file.dac_data_vector[0:3] == ["0", "1", "0"]
-        assert test_vector_file.vector_file.dac_data_vector[6:9] == ["0", "1", "0"]
+        assert test_vector_file.vector_file.dac_data_vector[0:3].tolist() == [0, 1, 0]
+        assert test_vector_file.vector_file.dac_data_vector[6:9].tolist() == [0, 1, 0]
 
     def test_set_bias_same_val(self, test_vector_file):
         with patch("qemii.detector.VectorFile.logging") as mocked_log:
@@ -91,8 +108,8 @@ class TestVectorFile():
                 call("{}\n".format(test_vector_file.file_length)),
                 call("\t".join(test_vector_file.vector_file.vector_names))
             ])
-            for line in test_vector_file.vector_data:
-                handle.write.assert_any_call("{}\n".format(line))
+            lines = ["".join(str(x) for x in line) for line in test_vector_file.vector_file.vector_data]
+            handle.write.assert_any_call("{}\n".format("\n".join(lines)))
 
     def test_set_file_name(self, test_vector_file):
         fake_file = mock_open(read_data=test_vector_file.file)
@@ -117,4 +134,73 @@ class TestVectorFile():
                 "r")
 
             assert test_vector_file.vector_file.bias["test_bias"] == 5
-            assert test_vector_file.vector_file.bias["test_bias_2"] == 2
\ No newline at end of file
+            assert test_vector_file.vector_file.bias["test_bias_2"] == 2
+    def test_binary_round_trip(self, test_vector_file, tmpdir):
+        vector_file = test_vector_file.vector_file
+        vector_file.file_dir = str(tmpdir)
+        vector_file.set_bias_val("test_bias", 3)
+        vector_file.write_vector_file("FakeName.qvec")
+
+        binary_file = VectorFile("FakeName.qvec", str(tmpdir))
+        assert binary_file.vector_loop_position == test_vector_file.file_loop_pos
+        assert binary_file.vector_length == test_vector_file.file_length
+        assert binary_file.vector_names == vector_file.vector_names
+        assert binary_file.vector_data.tolist() == vector_file.vector_data.tolist()
+        assert binary_file.vector_words.tolist() == vector_file.vector_words.tolist()
+        assert binary_file.bias == vector_file.bias
+
+    def test_save_replaces_cached_contents(self, test_vector_file, tmpdir):
+        """Test that a reset after a save gets the saved contents, even with an unchanged mtime"""
+        vector_file = test_vector_file.vector_file
+        vector_file.file_dir = str(tmpdir)
+        vector_file.write_vector_file("Saved.txt")
+        path = os.path.join(str(tmpdir), "Saved.txt")
+        mtime = os.stat(path).st_mtime
+        saved = VectorFile("Saved.txt", str(tmpdir))
+
+        saved.set_bias_val("test_bias", 1)
+        saved.write_vector_file("")
+        os.utime(path, (mtime, mtime))
+        saved.reset_vector_file(None)
+        assert saved.bias["test_bias"] == 1
+        assert VectorFile("Saved.txt", str(tmpdir)).bias["test_bias"] == 1
+
+    def test_binary_bias_change_without_unpacking(self, test_vector_file, tmpdir):
+        """Test that a binary file's biases are decoded and changed from its words alone"""
+        vector_file = test_vector_file.vector_file
+        vector_file.file_dir = str(tmpdir)
+        vector_file.write_vector_file("Unpacked.qvec")
+        # opened from the file, not from the contents cached when it was saved
+        VectorFile.cache.clear()
+        binary_file = VectorFile("Unpacked.qvec", str(tmpdir))
+        assert binary_file.bias == test_vector_file.bias_vals
+        binary_file.set_bias_val("test_bias", 2)
+        vector_file.set_bias_val("test_bias", 2)
+        assert binary_file.vector_bits is None
+        assert binary_file.vector_words.tolist() == vector_file.vector_words.tolist()
+        assert binary_file.vector_data.tolist() == vector_file.vector_data.tolist()
+
+    def test_binary_edit_does_not_modify_file(self, test_vector_file, tmpdir):
+        vector_file = test_vector_file.vector_file
+        vector_file.file_dir = str(tmpdir)
+        vector_file.write_vector_file("FakeName.qvec")
+        contents = tmpdir.join("FakeName.qvec").read_binary()
+
+        binary_file = VectorFile("FakeName.qvec", str(tmpdir))
+        binary_file.set_bias_val("test_bias", 0)
+        assert tmpdir.join("FakeName.qvec").read_binary() == contents
+
+    def test_cached_file_edits_are_private(self, test_vector_file, tmpdir):
+        vector_file = test_vector_file.vector_file
+        vector_file.file_dir = str(tmpdir)
+        vector_file.write_vector_file("Cached.txt")
+
+        first = VectorFile("Cached.txt", str(tmpdir))
+        hits = VectorFile.cache.hits
+        second = VectorFile("Cached.txt", str(tmpdir))
+        assert VectorFile.cache.hits == hits + 1
+
+        first.set_bias_val("test_bias", 0)
+        third = VectorFile("Cached.txt", str(tmpdir))
+        assert third.bias == second.bias
+        assert third.bias != first.bias
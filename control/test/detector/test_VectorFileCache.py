@@ -0,0 +1,68 @@
+"""
+Test Cases for the QEMII VectorFileCache in qemii.detector
+Detector Systems Software Group, STFC
+"""
+
+import sys
+import pytest
+import numpy as np
+
+if sys.version_info[0] == 3:  # pragma: no cover
+    from unittest.mock import Mock, MagicMock, call, patch
+else:                         # pragma: no cover
+    from mock import Mock, MagicMock, call, patch
+
+from qemii.detector.VectorFileCache import VectorFileCache
+
+
+class VectorFileCacheTestFixture(object):
+
+    def __init__(self):
+        # room for two entries of 8 lines by 8 signals
+        self.cache = VectorFileCache(max_bytes=2 * (64 + 64))
+
+    def put(self, name, mtime=1.0):
+        key = ("/fake/" + name, mtime, 100)
+        self.cache.put(key, 1, 8, ["a", "b"], 8,
+                       np.zeros((8, 8), dtype=np.uint8), np.zeros(8, dtype=np.uint64))
+        return key
+
+
+@pytest.fixture
+def test_cache():
+    """Test Fixture for testing the VectorFileCache"""
+
+    test_cache = VectorFileCacheTestFixture()
+    yield test_cache
+
+
+class TestVectorFileCache():
+
+    def test_hit_and_miss(self, test_cache):
+        key = test_cache.put("first")
+        assert test_cache.cache.get(key) is not None
+        assert test_cache.cache.get(("/fake/other", 1.0, 100)) is None
+        assert test_cache.cache.hits == 1
+        assert test_cache.cache.misses == 1
+
+    def test_cached_arrays_read_only(self, test_cache):
+        key = test_cache.put("first")
+        data = test_cache.cache.get(key)[4]
+        with pytest.raises(ValueError):
+            data[0, 0] = 1
+
+    def test_least_recently_used_evicted(self, test_cache):
+        first = test_cache.put("first")
+        second = test_cache.put("second")
+        test_cache.cache.get(first)
+        test_cache.put("third")
+        assert test_cache.cache.get(second) is None
+        assert test_cache.cache.get(first) is not None
+        assert test_cache.cache.size == 2 * (64 + 64)
+
+    def test_modified_file_replaces_entry(self, test_cache):
+        old = test_cache.put("first", mtime=1.0)
+        new = test_cache.put("first", mtime=2.0)
+        assert test_cache.cache.get(old) is None
+        assert test_cache.cache.get(new) is not None
+        assert len(test_cache.cache.entries) == 1
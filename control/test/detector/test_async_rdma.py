@@ -0,0 +1,99 @@
+"""
+Test Cases for the QEMII AsyncRdmaUDP in qemii.detector
+Detector Systems Software Group, STFC
+"""
+
+import sys
+import threading
+import pytest
+
+if sys.version_info[0] == 3:  # pragma: no cover
+    from unittest.mock import Mock, MagicMock, call, patch
+else:                         # pragma: no cover
+    from mock import Mock, MagicMock, call, patch
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from qemii.detector.AsyncRdmaUDP import AsyncRdmaUDP
+from qemii.detector.RdmaUDP import RdmaUDPError
+
+
+class AsyncRdmaUDPTestFixture(object):
+
+    def __init__(self):
+        self.rdma = Mock()
+        self.rdma.UDPTimeout = 5
+        self.rdma.read = Mock(return_value=0xAA)
+        self.rdma.read_many = Mock(side_effect=lambda addresses, comment: list(addresses))
+        self.async_rdma = AsyncRdmaUDP(self.rdma, max_in_flight=2)
+        # set to hold the connection busy in a read until released
+        self.release = threading.Event()
+
+    def blocking_read(self, address, comment=''):
+        self.release.wait(5)
+        return address
+
+
+@pytest.fixture
+def test_async_rdma():
+    """Test Fixture for testing the AsyncRdmaUDP"""
+
+    test_async_rdma = AsyncRdmaUDPTestFixture()
+    yield test_async_rdma
+    test_async_rdma.release.set()
+    test_async_rdma.async_rdma.close()
+
+
+class TestAsyncRdmaUDP():
+
+    def test_read(self, test_async_rdma):
+        """Test that a read resolves to the data read by the connection"""
+        data = IOLoop.current().run_sync(lambda: test_async_rdma.async_rdma.read(256, 'test'))
+        assert data == 0xAA
+        test_async_rdma.rdma.read.assert_called_once_with(256, 'test')
+
+    def test_requests_in_order(self, test_async_rdma):
+        """Test that requests in flight together run one at a time, in the order made"""
+        @gen.coroutine
+        def read_both():
+            results = yield [test_async_rdma.async_rdma.read_many([1, 2]),
+                             test_async_rdma.async_rdma.read(3)]
+            raise gen.Return(results)
+
+        assert IOLoop.current().run_sync(read_both) == [[1, 2], 0xAA]
+        assert test_async_rdma.async_rdma.in_flight == 0
+
+    def test_max_in_flight(self, test_async_rdma):
+        """Test that requests beyond max_in_flight are refused"""
+        test_async_rdma.rdma.read = Mock(side_effect=test_async_rdma.blocking_read)
+
+        @gen.coroutine
+        def read_three():
+            pending = [test_async_rdma.async_rdma.read(address) for address in range(2)]
+            try:
+                yield test_async_rdma.async_rdma.read(2)
+            finally:
+                test_async_rdma.release.set()
+                yield pending
+
+        with pytest.raises(RdmaUDPError):
+            IOLoop.current().run_sync(read_three)
+
+    def test_timeout(self, test_async_rdma):
+        """Test that a request that takes too long fails, and one still queued is dropped"""
+        test_async_rdma.rdma.read = Mock(side_effect=test_async_rdma.blocking_read)
+
+        @gen.coroutine
+        def read_two():
+            first = test_async_rdma.async_rdma.read(1, timeout=0.05)
+            second = test_async_rdma.async_rdma.read(2, timeout=0.05)
+            for future in (first, second):
+                with pytest.raises(RdmaUDPError):
+                    yield future
+
+        IOLoop.current().run_sync(read_two)
+        test_async_rdma.release.set()
+        test_async_rdma.async_rdma.executor.submit(lambda: None).result()
+        test_async_rdma.rdma.read.assert_called_once_with(1, '')
+        assert test_async_rdma.async_rdma.in_flight == 0
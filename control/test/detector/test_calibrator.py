@@ -4,7 +4,9 @@ Adam Neaves, STFC Detector Systems Software Group
 """
 
 import sys
+import time
 import pytest
+import numpy as np
 
 if sys.version_info[0] == 3:  # pragma: no cover
     from unittest.mock import Mock, MagicMock, call, patch
@@ -13,22 +15,76 @@ else:                         # pragma: no cover
 
 
 from qemii.detector.QemCalibrator import QemCalibrator
+from qemii.detector.LiveCalibrationAnalyser import LiveCalibrationAnalyser
 
 
 class CalibratorTestFixture(object):
 
-    def __init__(self):
+    def __init__(self, data_dir):
         self.coarse_calibration_val = 2000
         self.fems = [Mock()]
-        self.daq = Mock()
+        self.fems[0].vector_file = Mock(bias={"iBiasPLL": 20})
+        self.fems[0].vector_file.get_hash = Mock(return_value="0123")
+        self.daq = Mock(file_dir=data_dir, file_name="cal", frame_start_acquisition=0)
         self.calibrator = QemCalibrator(self.coarse_calibration_val, self.fems, self.daq)
 
+    def start_acquisition(self, calibrate_type="fine"):
+        """Record the acquisition as adc_calibrate does, before its frames are taken"""
+        self.calibrator.acquisition = {
+            "type": calibrate_type,
+            "key": self.calibrator.get_store_key(calibrate_type),
+            "first_frame": 0,
+            "steps": None,
+            "failure_reason": None
+        }
 
-@pytest.fixture(scope="class")
-def test_calibrator():
+    def plot(self, frames, plot_type="fine"):
+        """Plot the frames as those of the data file, returning the patched pyplot"""
+        with patch.object(self.calibrator, "get_h5_file", return_value="cal.h5"), \
+                patch("qemii.detector.QemCalibrator.h5py") as h5py, \
+                patch("qemii.detector.QemCalibrator.plt") as plt:
+            h5py.File.return_value.__enter__.return_value = {"data": frames}
+            self.calibrator.adc_plot(plot_type)
+            # wait for the plot on the calibrator's single worker thread
+            self.calibrator.thread_executor.submit(lambda: None).result()
+        return plt
+
+
+class BackplaneSweep(object):
+    """Stands in for the backplane sweep, which keeps up with the frames triggered.
+
+    @param stall_step: number of steps after which the backplane stops setting steps
+    @param late_steps: indices of the steps the backplane reports it set late
+    """
+
+    def __init__(self, fem, steps=0, stall_step=None, late_steps=()):
+        self.fem = fem
+        self.steps = steps
+        self.stall_step = stall_step
+        self.late_steps = list(late_steps)
+        self.first_trigger = 0
+
+    def put(self, path, request):
+        settings = request.body.get("sweep", {}).get("start")
+        if settings is not None:
+            self.steps = len(settings["values"])
+            self.first_trigger = self.fem.frame_gate_trigger.call_count
+        return Mock(status_code=200)
+
+    def get(self, path, request):
+        steps_done = min(self.fem.frame_gate_trigger.call_count - self.first_trigger, self.steps)
+        if self.stall_step is not None:
+            steps_done = min(steps_done, self.stall_step)
+        return Mock(status_code=200, data={"sweep": {"steps_done": steps_done,
+                                                     "late_step_indices": self.late_steps,
+                                                     "aborted": False}})
+
+
+@pytest.fixture
+def test_calibrator(tmp_path):
     """Test Fixture for testing the Calibrator"""
 
-    test_calibrator = CalibratorTestFixture()
+    test_calibrator = CalibratorTestFixture(str(tmp_path))
     yield test_calibrator
 
 
@@ -36,4 +92,211 @@ class TestCalibrator():
 
     def test_init(self, test_calibrator):
         assert isinstance(test_calibrator.calibrator, QemCalibrator)
-        assert test_calibrator.calibrator.coarse_calibration_value == test_calibrator.coarse_calibration_val
\ No newline at end of file
+        assert test_calibrator.calibrator.coarse_calibration_value == test_calibrator.coarse_calibration_val
+
+    def test_calibrate_starts_backplane_sweep(self, test_calibrator):
+        """Test that the calibration register is swept by the backplane, from a single request"""
+        calibrator = test_calibrator.calibrator
+        calibrator.proxy_adapter = Mock()
+        calibrator.proxy_adapter.put = Mock(return_value=Mock(status_code=200))
+        test_calibrator.daq.in_progress = False
+        with patch.object(calibrator, "calibration_sweep") as calibration_sweep:
+            calibrator.adc_calibrate("fine")
+        assert calibrator.proxy_adapter.put.call_count == 2
+        sweep = calibrator.proxy_adapter.put.call_args[0][1].body["sweep"]["start"]
+        assert sweep == {"register": "AUXSAMPLE_FINE", "start": 0, "stop": 4096, "step": 1,
+                         "dwell": calibrator.calibration_dwell}
+        assert calibration_sweep.call_args[0][0] == "AUXSAMPLE_FINE"
+        # the conditions are captured when the calibration starts
+        assert calibrator.acquisition["key"] == calibrator.get_store_key("fine")
+
+    def test_calibrate_without_sweep(self, test_calibrator):
+        """Test that each step is set in turn if the backplane cannot sweep"""
+        calibrator = test_calibrator.calibrator
+        calibrator.proxy_adapter = Mock()
+        calibrator.proxy_adapter.put = Mock(side_effect=[Mock(status_code=200),
+                                                         Mock(status_code=400)])
+        test_calibrator.daq.in_progress = False
+        with patch("qemii.detector.QemCalibrator.IOLoop") as ioloop, \
+                patch.object(calibrator, "calibration_sweep") as calibration_sweep:
+            calibrator.adc_calibrate("coarse")
+        ioloop.instance().add_callback.assert_called_once_with(
+            calibrator.calibration_loop, register="AUXSAMPLE_COARSE")
+        calibration_sweep.assert_not_called()
+
+    def test_calibration_sweep_triggers_each_step(self, test_calibrator):
+        """Test that one frame is triggered for each step, reading the backplane only at the end"""
+        calibrator = test_calibrator.calibrator
+        calibrator.proxy_adapter = Mock()
+        calibrator.max_calibration = 8
+        calibrator.calibration_dwell = 0.01
+        test_calibrator.start_acquisition()
+        calibrator.proxy_adapter.get = Mock(
+            side_effect=BackplaneSweep(test_calibrator.fems[0], 8).get)
+        calibrator.calibration_sweep("AUXSAMPLE_FINE", time.time())
+        # wait for the sweep to finish on the calibrator's single worker thread
+        calibrator.thread_executor.submit(lambda: None).result()
+        assert test_calibrator.fems[0].frame_gate_trigger.call_count == 8
+        assert calibrator.calibration_value == 7
+        assert calibrator.failure_reason is None
+        assert calibrator.proxy_adapter.get.call_count == 1
+        calibrator.proxy_adapter.put.assert_not_called()
+
+    def test_sweep_fails_with_late_steps(self, test_calibrator):
+        """Test that the calibration fails if the backplane set any step after its frame"""
+        calibrator = test_calibrator.calibrator
+        calibrator.proxy_adapter = Mock()
+        calibrator.max_calibration = 8
+        calibrator.calibration_dwell = 0.01
+        test_calibrator.start_acquisition()
+        calibrator.proxy_adapter.get = BackplaneSweep(test_calibrator.fems[0], 8,
+                                                      late_steps=[3, 5]).get
+        calibrator.calibration_sweep("AUXSAMPLE_FINE", time.time())
+        calibrator.thread_executor.submit(lambda: None).result()
+        assert test_calibrator.fems[0].frame_gate_trigger.call_count == 8
+        assert calibrator.failure_reason == "backplane set 2 steps late, the first at step 4"
+
+    def test_sweep_aborted_when_backplane_behind(self, test_calibrator):
+        """Test that the sweep is stopped if the backplane has fallen behind the frames"""
+        calibrator = test_calibrator.calibrator
+        calibrator.proxy_adapter = Mock()
+        calibrator.max_calibration = 200
+        calibrator.calibration_dwell = 0.0001
+        test_calibrator.start_acquisition()
+        calibrator.proxy_adapter.get = BackplaneSweep(test_calibrator.fems[0], 200, 100).get
+        calibrator.calibration_sweep("AUXSAMPLE_FINE", time.time())
+        calibrator.thread_executor.submit(lambda: None).result()
+        assert test_calibrator.fems[0].frame_gate_trigger.call_count == 128
+        assert calibrator.failure_reason == \
+            "backplane sweep was at step 100 of 200 after 128 frames"
+        abort = calibrator.proxy_adapter.put.call_args[0][1].body
+        assert abort == {"sweep": {"abort": True}}
+
+    def test_plot_analyses_every_column(self, test_calibrator):
+        """Test that plotting saves the analysis of every column, from one pass over the file"""
+        calibrator = test_calibrator.calibrator
+        test_calibrator.daq.in_progress = False
+        frames = np.random.randint(0, 0x800, (600, 4, 40)).astype(np.uint16)
+        # no calibration taken, so the last frames are taken to be the steps in order
+        calibrator.max_calibration = 590
+        plt = test_calibrator.plot(frames)
+        averages = plt.figure().add_subplot().plot.call_args[0][1]
+        for index in (0, 255, 589):
+            column = calibrator.get_fine_bits_column(list(frames[index + 10]), 33)
+            assert averages[index] == pytest.approx(sum(column) / float(len(column)))
+        results = np.load(calibrator.analysis_file)
+        assert results["curves"].shape == (590, 40)
+        assert calibrator.analysis_summary["columns"] == 40
+
+    def test_plot_reuses_stored_results(self, test_calibrator):
+        """Test that plotting the same frames again uses the stored results, not the raw frames"""
+        calibrator = test_calibrator.calibrator
+        test_calibrator.daq.in_progress = False
+        frames = np.random.randint(0, 0x800, (74, 4, 40)).astype(np.uint16)
+        calibrator.max_calibration = 64
+        test_calibrator.plot(frames)
+        stored_file = calibrator.analysis_file
+        with patch("qemii.detector.QemCalibrator.CalibrationAnalyser") as analyser:
+            plt = test_calibrator.plot(frames)
+            analyser.for_type.assert_not_called()
+            assert calibrator.analysis_file == stored_file
+            assert len(plt.figure().add_subplot().plot.call_args[0][1]) == 64
+
+            # different conditions are analysed again
+            test_calibrator.fems[0].vector_file.bias["iBiasPLL"] = 21
+            test_calibrator.plot(frames)
+            analyser.for_type.assert_called_once()
+
+    def test_compare_stored_runs(self, test_calibrator):
+        """Test that stored runs are compared without going back to the raw frames"""
+        calibrator = test_calibrator.calibrator
+        test_calibrator.daq.in_progress = False
+        calibrator.max_calibration = 64
+        test_calibrator.plot(np.random.randint(0, 0x800, (74, 4, 40)).astype(np.uint16))
+        run_id = calibrator.get_results_store().list_runs()[0]["id"]
+        with patch("qemii.detector.QemCalibrator.plt") as plt:
+            calibrator.param_tree.set("store/compare", "{0},{0}".format(run_id))
+            calibrator.thread_executor.submit(lambda: None).result()
+        assert plt.figure().add_subplot().plot.call_count == 2
+        assert calibrator.comparison["reference"] == run_id
+        assert calibrator.comparison["runs"][run_id]["max_gain_difference"] == 0
+
+    def test_sweep_aborted_by_live_analysis(self, test_calibrator):
+        """Test that a failing live analysis stops the sweep, and the backplane with it"""
+        calibrator = test_calibrator.calibrator
+        calibrator.proxy_adapter = Mock()
+        calibrator.proxy_adapter.get = BackplaneSweep(test_calibrator.fems[0], 4096).get
+        calibrator.live_analyser = Mock(voltages=range(4096), frames_expected=4096)
+        calibrator.live_analyser.check = Mock(side_effect=[None, "no frames received"])
+        calibrator.calibration_dwell = 0.0001
+        test_calibrator.start_acquisition()
+        with patch.object(calibrator, "save_plot"), \
+                patch.object(calibrator, "save_analysis") as save_analysis:
+            calibrator.calibration_sweep("AUXSAMPLE_FINE", time.time())
+            calibrator.thread_executor.submit(lambda: None).result()
+        assert test_calibrator.fems[0].frame_gate_trigger.call_count == 128
+        assert calibrator.failure_reason == "no frames received"
+        # the run is stored as incomplete, with why it failed
+        assert save_analysis.call_args[0][4] == "no frames received"
+        abort = calibrator.proxy_adapter.put.call_args[0][1].body
+        assert abort == {"sweep": {"abort": True}}
+        calibrator.live_analyser.stop.assert_called_once_with()
+
+    def test_adaptive_sweep(self, test_calibrator):
+        """Test that later passes only sample where the codes change, within the point budget"""
+        calibrator = test_calibrator.calibrator
+        backplane = BackplaneSweep(test_calibrator.fems[0])
+        calibrator.proxy_adapter = Mock()
+        calibrator.proxy_adapter.put = Mock(side_effect=backplane.put)
+        calibrator.proxy_adapter.get = Mock(side_effect=backplane.get)
+        # one column, with a single code transition between 1000 and 1001
+        live = LiveCalibrationAnalyser("fine", np.arange(4096))
+        live.wait_for_frames = Mock(return_value=True)
+
+        def take_frames(steps):
+            LiveCalibrationAnalyser.add_steps(live, steps)
+            codes = (np.array(steps) > 1000).astype(np.uint16).reshape(-1, 1, 1)
+            live.add_frames(codes, live.frames_placed)
+        live.add_steps = take_frames
+        calibrator.live_analyser = live
+        test_calibrator.start_acquisition()
+        calibrator.acquisition["steps"] = []
+        # long enough that no trigger is late, which would fail the pass
+        calibrator.calibration_dwell = 0.02
+        with patch.object(calibrator, "finish_live_analysis"):
+            calibrator.adaptive_calibration_sweep("AUXSAMPLE_FINE")
+            calibrator.thread_executor.submit(lambda: None).result()
+        sweeps = [request[0][1].body["sweep"]["start"]["values"]
+                  for request in calibrator.proxy_adapter.put.call_args_list]
+        assert len(sweeps[0]) == 65
+        assert sweeps[1:] == [[976, 992, 1008], [996, 1000, 1004], [1001, 1002, 1003]]
+        assert calibrator.adaptive_points == 65 + 3 + 3 + 3
+        assert calibrator.failure_reason is None
+        # the order the steps were taken in, kept to plot the frames again
+        assert calibrator.acquisition["steps"] == sum(sweeps, [])
+        test_calibrator.daq.stop_acquisition.assert_called_with()
+
+    def test_plot_adaptive_run_in_scan_order(self, test_calibrator):
+        """Test that the frames of an adaptive run are plotted at the steps they were taken at, and
+        stored under the conditions when they were taken"""
+        calibrator = test_calibrator.calibrator
+        steps = [0, 48, 24, 12, 36, 60]
+        # two frames from before the calibration, then frames whose codes are their steps
+        frames = np.zeros((2 + len(steps), 4, 40), dtype=np.uint16)
+        frames[2:] = np.array(steps).reshape(-1, 1, 1)
+        calibrator.max_calibration = 64
+        key = calibrator.get_store_key("fine", adaptive=True)
+        calibrator.acquisition = {"type": "fine", "key": key, "first_frame": 2, "steps": steps,
+                                  "failure_reason": None}
+        # changed after the calibration, before its frames are plotted
+        test_calibrator.fems[0].vector_file.bias["iBiasPLL"] = 25
+        test_calibrator.daq.in_progress = False
+        plt = test_calibrator.plot(frames)
+        averages = plt.figure().add_subplot().plot.call_args[0][1]
+        assert list(averages) == sorted(steps)
+        entry = calibrator.get_results_store().list_runs()[-1]
+        assert entry["key"] == key
+        assert entry["key"]["adaptive"]
+        assert entry["key"]["biases"] == {"iBiasPLL": 20}
+        assert entry["source"]["first_frame"] == 2
+        assert entry["source"]["frames"] == len(steps)
@@ -4,7 +4,9 @@ Adam Neaves, STFC Detector Systems Software Group
 """
 
 import sys
+import threading
 import pytest
+import numpy as np
 
 if sys.version_info[0] == 3:  # pragma: no cover
     from unittest.mock import Mock, MagicMock, call, patch
@@ -13,7 +15,7 @@ else:                         # pragma: no cover
 
 # sys.modules["qemii.detector.VectorFile"] = Mock()
 
-from qemii.detector.QemFem import QemFem
+from qemii.detector.QemFem import QemFem, QemFemError, run_on_fems
 
 
 class FemTestFixture(object):
@@ -40,3 +42,237 @@ class TestFem():
 
     def test_init(self, test_fem):
         assert test_fem.fem.get_address() == test_fem.ip
+
+    def test_frame_gate_settings_batched(self, test_fem):
+        """Test that the frame gate settings are sent as a single batched write"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.frame_gate_settings(10, 2)
+        test_fem.fem.x10g_rdma.write_many.assert_called_once_with(
+            [(0xD0000001, 10), (0xD0000002, 2)], 'frame gate settings')
+
+    def test_register_shadow_skips_unchanged(self, test_fem):
+        """Test that rewriting a register with its current value sends nothing"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.invalidate_register_shadow()
+        test_fem.fem.set_scsr(7, 7, 7, 7)
+        test_fem.fem.set_scsr(7, 7, 7, 7)
+        assert test_fem.fem.x10g_rdma.write_many.call_count == 1
+
+        test_fem.fem.invalidate_register_shadow()
+        test_fem.fem.set_scsr(7, 7, 7, 7)
+        assert test_fem.fem.x10g_rdma.write_many.call_count == 2
+
+    def test_register_shadow_failed_write(self, test_fem):
+        """Test that a write that fails to send is not kept in the shadow, so it is resent"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.invalidate_register_shadow()
+        test_fem.fem.set_scsr(7, 7, 7, 7)
+        test_fem.fem.x10g_rdma.write_many.side_effect = IOError("send failed")
+        with pytest.raises(IOError):
+            test_fem.fem.set_scsr(6, 6, 6, 6)
+        assert 0xC0000005 not in test_fem.fem.register_shadow
+
+        test_fem.fem.x10g_rdma.write_many.side_effect = None
+        test_fem.fem.set_scsr(7, 7, 7, 7)
+        assert test_fem.fem.x10g_rdma.write_many.call_count == 3
+        assert test_fem.fem.register_shadow[0xC0000005] == 0x07070707
+
+    def test_set_idelay_always_loads(self, test_fem):
+        """Test that the idelay word and its load strobe are sent even when unchanged"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.invalidate_register_shadow()
+        test_fem.fem.set_idelay(1, 2, 3, 4)
+        test_fem.fem.set_idelay(1, 2, 3, 4)
+        receiver = 0xC0000000
+        test_fem.fem.x10g_rdma.write_many.assert_has_calls([
+            call([(receiver | 0x02, 0x01020304), (receiver, 0x00), (receiver, 0x10),
+                  (receiver, 0x00)], 'data_cdn_idelay word and load')] * 2)
+        assert test_fem.fem.x10g_rdma.read.call_count == 2
+
+    def test_delta_vector_upload(self, test_fem):
+        """Test that a second upload only writes the sequencer words that changed"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.delta_upload = True
+        # the FEM registers, reading back what was written and reporting the idelay locked
+        ram = {}
+        test_fem.fem.x10g_rdma.write_many = Mock(side_effect=lambda writes, comment: ram.update(writes))
+        test_fem.fem.x10g_rdma.read = Mock(side_effect=lambda address, comment: ram.get(address, 1))
+        test_fem.fem.vector_file = Mock(vector_words=np.array([0, 1, 2, 3], dtype=np.uint64),
+                                        vector_length=4, vector_loop_position=1)
+        ram_base = 0xB1000000
+        with patch("qemii.detector.QemFem.time"):
+            test_fem.fem.load_vectors_from_file()
+            ram_writes = test_fem.fem.x10g_rdma.write_many.call_args_list[1][0][0]
+            assert len(ram_writes) == 8
+            assert test_fem.fem.param_tree.get("delta_upload")["active"]
+
+            test_fem.fem.vector_file.vector_words[1:3] = 3
+            test_fem.fem.x10g_rdma.write_many.reset_mock()
+            test_fem.fem.load_vectors_from_file()
+            ram_writes = test_fem.fem.x10g_rdma.write_many.call_args_list[1][0][0]
+            assert ram_writes == [(ram_base + 2, 3), (ram_base + 3, 0),
+                                  (ram_base + 4, 3), (ram_base + 5, 0)]
+
+            test_fem.fem.x10g_rdma.write_many.reset_mock()
+            test_fem.fem.load_vectors_full()
+            ram_writes = test_fem.fem.x10g_rdma.write_many.call_args_list[1][0][0]
+            assert len(ram_writes) == 8
+
+    def test_delta_upload_needs_readback(self, test_fem):
+        """Test that delta uploads are turned off if the sequencer RAM does not read back"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.x10g_rdma.read = Mock(return_value=1)
+        test_fem.fem.delta_upload = True
+        test_fem.fem.uploaded_vectors = None
+        test_fem.fem.vector_file = Mock(vector_words=np.array([0, 1, 2, 3], dtype=np.uint64),
+                                        vector_length=4, vector_loop_position=1)
+        with patch("qemii.detector.QemFem.time"):
+            test_fem.fem.load_vectors_from_file()
+            assert test_fem.fem.uploaded_vectors is None
+            assert not test_fem.fem.param_tree.get("delta_upload")["enable"]
+            test_fem.fem.x10g_rdma.write_many.reset_mock()
+            test_fem.fem.x10g_rdma.read.reset_mock()
+            test_fem.fem.load_vectors_from_file()
+        ram_writes = test_fem.fem.x10g_rdma.write_many.call_args_list[1][0][0]
+        assert len(ram_writes) == 8
+        # only the lock status is read once delta uploads are off
+        assert test_fem.fem.x10g_rdma.read.call_count == 1
+
+    def test_reliable_writes_need_probe(self, test_fem):
+        """Test that reliable writes stay off if the FEM does not acknowledge the probe"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.x10g_rdma.reliable = False
+        test_fem.fem.x10g_rdma.probe_reliable_writes = Mock(return_value=False)
+        test_fem.fem.param_tree.set("reliable_writes", True)
+        assert not test_fem.fem.reliable_writes
+        assert not test_fem.fem.x10g_rdma.reliable
+
+        test_fem.fem.x10g_rdma.probe_reliable_writes = Mock(return_value=True)
+        test_fem.fem.param_tree.set("reliable_writes", True)
+        assert test_fem.fem.x10g_rdma.reliable
+        test_fem.fem.param_tree.set("reliable_writes", False)
+        assert not test_fem.fem.x10g_rdma.reliable
+
+    def test_diagnostics(self, test_fem):
+        """Test that telemetry is only attached to the RDMA connection while enabled"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.param_tree.set("diagnostics/enable", True)
+        assert test_fem.fem.x10g_rdma.telemetry is test_fem.fem.rdma_telemetry
+        test_fem.fem.rdma_telemetry.record_write(0xB0000000)
+        snapshot = test_fem.fem.get_diagnostics()
+        assert snapshot["regions"] == {"sequencer": {"reads": 0, "writes": 1}}
+
+        test_fem.fem.param_tree.set("diagnostics/reset", None)
+        assert test_fem.fem.rdma_telemetry.writes == 0
+        test_fem.fem.param_tree.set("diagnostics/enable", False)
+        assert test_fem.fem.x10g_rdma.telemetry is None
+
+    def test_prepare_for_acquisition_reloads_vectors(self, test_fem):
+        """Test that the vectors are only reloaded when the idelay has lost lock"""
+        fem = Mock()
+        fem.get_idelay_lock_status = Mock(return_value=1)
+        QemFem.prepare_for_acquisition(fem)
+        fem.load_vectors_from_file.assert_not_called()
+        fem.get_idelay_lock_status = Mock(return_value=0)
+        QemFem.prepare_for_acquisition(fem)
+        fem.load_vectors_from_file.assert_called_once_with(full=True)
+
+    def test_status(self, test_fem):
+        """Test that the status block is read in one burst and decoded"""
+        test_fem.fem.x10g_rdma = Mock()
+        registers = [0] * 16
+        registers[2] = 0x01020304
+        registers[3] = 0x1
+        registers[4] = 0xAAAA5555
+        test_fem.fem.x10g_rdma.read_burst = Mock(return_value=registers)
+
+        status = test_fem.fem.get_status()
+        test_fem.fem.x10g_rdma.read_burst.assert_called_once_with(
+            0xC0000010, 16, 'receiver status block')
+        test_fem.fem.x10g_rdma.read.assert_not_called()
+        assert status.idelay == [1, 2, 3, 4]
+        assert status.locked
+        assert status.aligner_status == [0xAAAA, 0x5555]
+        assert status.registers == registers
+
+    def test_status_refreshed_off_the_tree(self, test_fem):
+        """Test that fetching the status never reads the FEM, and a refresh updates it"""
+        test_fem.fem.x10g_rdma = Mock()
+        test_fem.fem.x10g_rdma.read_burst = Mock(return_value=[0x1] * 16)
+        assert test_fem.fem.param_tree.get("status")["values"] is None
+        test_fem.fem.x10g_rdma.read_burst.assert_not_called()
+
+        test_fem.fem.param_tree.set("status/refresh", None)
+        QemFem.thread_executor.submit(lambda: None).result()
+        assert test_fem.fem.param_tree.get("status")["values"]["locked"]
+        test_fem.fem.x10g_rdma.read_burst.assert_called_once_with(
+            0xC0000010, 16, 'receiver status block')
+
+    def test_record_and_replay_script(self, test_fem):
+        """Test that a recorded sequence is replayed in one send, and verified by readback"""
+        test_fem.fem.x10g_rdma = Mock(UDPMax=8000)
+        test_fem.fem.x10g_rdma.compile_writes = Mock(return_value=[b'datagram'])
+        test_fem.fem.frame_gate_settings(3, 4)
+        with test_fem.fem.recording_script("arm"):
+            # sent even though unchanged, so it is recorded
+            test_fem.fem.frame_gate_settings(3, 4)
+            test_fem.fem.frame_gate_trigger()
+            test_fem.fem.set_idelay(1, 2, 3, 4)
+        script = test_fem.fem.scripts["arm"]
+        assert script.writes[:4] == [(0xD0000001, 3), (0xD0000002, 4),
+                                     (0xD0000000, 0), (0xD0000000, 1)]
+        # the frame gate registers are write-only, and the idelay taps read back at 0x12
+        assert script.verify_addresses == [0xC0000012]
+        assert script.register_values == {0xD0000001: 3, 0xD0000002: 4}
+
+        test_fem.fem.x10g_rdma.reset_mock()
+        test_fem.fem.invalidate_register_shadow()
+        test_fem.fem.x10g_rdma.read_many = Mock(return_value=[0x01020305])
+        mismatches = test_fem.fem.run_script("arm", verify=True)
+        test_fem.fem.x10g_rdma.send_datagrams.assert_called_once_with(
+            [b'datagram'], script.writes, 'script arm')
+        test_fem.fem.x10g_rdma.write_many.assert_not_called()
+        test_fem.fem.x10g_rdma.read_many.assert_called_once_with([0xC0000012], 'verify script arm')
+        assert mismatches == [(0xC0000012, 0x01020304, 0x01020305)]
+        assert test_fem.fem.script_result["mismatches"] == ["C0000012"]
+        assert test_fem.fem.register_shadow[0xD0000002] == 4
+
+    def test_failed_recording_discarded(self, test_fem):
+        test_fem.fem.x10g_rdma = Mock()
+        with pytest.raises(ValueError):
+            with test_fem.fem.recording_script("broken"):
+                raise ValueError("failed")
+        assert test_fem.fem.recording is None
+        assert "broken" not in test_fem.fem.scripts
+        with pytest.raises(QemFemError):
+            test_fem.fem.run_script("broken")
+
+
+class TestRunOnFems():
+
+    def test_concurrent(self):
+        """Test that each FEM runs at the same time, rather than one after another"""
+        started = [threading.Event(), threading.Event()]
+        fems = [Mock(id=0), Mock(id=1)]
+
+        def wait_for_other(fem):
+            started[fem.id].set()
+            return started[1 - fem.id].wait(5)
+
+        assert run_on_fems(fems, wait_for_other) == [True, True]
+
+    def test_errors_aggregated(self):
+        """Test that every failing FEM is reported, after the others have finished"""
+        fems = [Mock(id=0), Mock(id=1), Mock(id=2)]
+        finished = []
+
+        def fail_odd(fem):
+            if fem.id % 2 == 0:
+                raise IOError("FEM {} unreachable".format(fem.id))
+            finished.append(fem.id)
+
+        with pytest.raises(QemFemError) as excinfo:
+            run_on_fems(fems, fail_odd, "connect")
+        assert "FEM 0: FEM 0 unreachable" in str(excinfo.value)
+        assert "FEM 2: FEM 2 unreachable" in str(excinfo.value)
+        assert finished == [1]
@@ -5,14 +5,16 @@ Adam Neaves, STFC Detector Systems Software Group
 
 import sys
 import pytest
+import socket
 import struct
+import threading
 
 if sys.version_info[0] == 3:  # pragma: no cover
     from unittest.mock import Mock, MagicMock, call, patch
 else:                         # pragma: no cover
     from mock import Mock, MagicMock, call, patch
 
-from qemii.detector.RdmaUDP import RdmaUDP
+from qemii.detector.RdmaUDP import RdmaUDP, RdmaTelemetry, RdmaUDPError
 
 
 class RdmaUDPTestFixture(object):
@@ -35,14 +37,18 @@ class RdmaUDPTestFixture(object):
         self.tx_socket = Mock()
         self.rx_socket = Mock()
         self.return_data = 256
-        return_struct = struct.pack('=IIIIQQQQQ', 5, 7, 5, self.return_data, 0, 0, 0, 0, 10)
-        self.rx_socket.recv = Mock(return_value=return_struct)
+        self.return_struct = struct.pack('=IIIIQQQQQ', 5, 7, 5, self.return_data, 0, 0, 0, 0, 10)
+        self.rx_socket.recv_into = Mock(side_effect=self.recv_into)
         self.rdma.txsocket = self.tx_socket
         self.rdma.rxsocket = self.rx_socket
 
         self.rdma.ack = True
         self.rdma.setDebug()
 
+    def recv_into(self, buffer):
+        buffer[:len(self.return_struct)] = self.return_struct
+        return len(self.return_struct)
+
 
 @pytest.fixture
 def test_rdma():
@@ -70,7 +76,7 @@ class TestRdmaUDP():
 
         data = test_rdma.rdma.read(test_address)
         test_rdma.tx_socket.sendto.assert_called_with(read_command, (test_rdma.target_ip, test_rdma.target_port))
-        test_rdma.rx_socket.recv.assert_called_with(test_rdma.UDPMTU)
+        test_rdma.rx_socket.recv_into.assert_called_with(test_rdma.rdma.rx_buffer)
         assert data == test_rdma.return_data
 
     def test_write(self, test_rdma):
@@ -82,3 +88,183 @@ class TestRdmaUDP():
         test_rdma.rdma.write(test_address, test_data)
         test_rdma.tx_socket.sendto.assert_called_with(write_command, (test_rdma.target_ip, test_rdma.target_port))
 
+    def test_write_many(self, test_rdma):
+        """Test that batched writes are packed into one datagram followed by a single nop."""
+        writes = [(256, 1024), (257, 2048), (258, 4096)]
+        expected = b''.join(
+            struct.pack('=BBBBIQ', 1, 0, 0, 2, address, data) for address, data in writes
+        ) + struct.pack('=BBBBIQQQQQ', 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+
+        datagrams = test_rdma.rdma.write_many(writes)
+        assert datagrams == 1
+        test_rdma.tx_socket.sendto.assert_called_once_with(
+            expected, (test_rdma.target_ip, test_rdma.target_port))
+
+    def test_write_many_single_matches_write(self, test_rdma):
+        """Test that a batch of one write is identical to a single write."""
+        test_rdma.rdma.write(256, 1024)
+        single = test_rdma.tx_socket.sendto.call_args
+        test_rdma.rdma.write_many([(256, 1024)])
+        assert test_rdma.tx_socket.sendto.call_args == single
+
+    def test_write_reuses_buffer(self, test_rdma):
+        """Test that repeated writes pack into the same preallocated datagram."""
+        test_rdma.rdma.write(256, 1)
+        test_rdma.rdma.write(512, 2)
+        first, second = [args[0][0] for args in test_rdma.tx_socket.sendto.call_args_list]
+        assert first is second
+        assert bytes(second) == struct.pack('=BBBBIQBBBBIQQQQQ',
+                                            1, 0, 0, 2, 512, 2, 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+
+    def test_write_many_split_by_mtu(self, test_rdma):
+        """Test that a batch larger than the MTU is split across several datagrams."""
+        test_rdma.rdma.UDPMax = 28 + 48 + (16 * 10)  # room for 10 writes per datagram
+        writes = [(address, address) for address in range(25)]
+
+        datagrams = test_rdma.rdma.write_many(writes)
+        assert datagrams == 3
+        sizes = [len(args[0][0]) for args in test_rdma.tx_socket.sendto.call_args_list]
+        assert sizes == [(16 * 10) + 48, (16 * 10) + 48, (16 * 5) + 48]
+
+    def test_transactions_serialised(self, test_rdma):
+        """Test that a write from another thread waits until a read has its response"""
+        sent = []
+        test_rdma.tx_socket.sendto = Mock(
+            side_effect=lambda data, address: sent.append(bytearray(data)[3]))
+        writer = threading.Thread(target=test_rdma.rdma.write, args=(512, 1))
+
+        def recv_into(buffer):
+            writer.start()
+            writer.join(0.1)
+            sent.append("response")
+            return test_rdma.recv_into(buffer)
+        test_rdma.rx_socket.recv_into = Mock(side_effect=recv_into)
+
+        assert test_rdma.rdma.read(256) == test_rdma.return_data
+        writer.join()
+        assert sent == [3, "response", 2]
+
+    def test_read_timeout(self, test_rdma):
+        """Test that a read with no response gives up and returns zero."""
+        test_rdma.rx_socket.recv_into = Mock(side_effect=socket.timeout)
+        assert test_rdma.rdma.read(256) == 0
+
+    def test_telemetry(self, test_rdma):
+        """Test that transactions are recorded while telemetry is attached."""
+        test_rdma.rdma.telemetry = RdmaTelemetry()
+        test_rdma.rdma.read(0xC0000013)
+        test_rdma.rdma.write_many([(0xD0000001, 1), (0xD0000002, 2)])
+        test_rdma.rx_socket.recv_into = Mock(side_effect=socket.timeout)
+        test_rdma.rdma.read(0xC0000014)
+
+        snapshot = test_rdma.rdma.telemetry.snapshot({0xC0000000: "receiver"})
+        assert snapshot["reads"] == 1
+        assert snapshot["writes"] == 2
+        assert snapshot["timeouts"] == 1
+        assert snapshot["datagrams_sent"] == 3
+        assert snapshot["bytes_received"] == 56
+        assert snapshot["regions"] == {"receiver": {"reads": 2, "writes": 0},
+                                       "D0000000": {"reads": 0, "writes": 2}}
+        assert sum(snapshot["read_latency"]["histogram"].values()) == 1
+
+        test_rdma.rdma.telemetry.reset()
+        assert test_rdma.rdma.telemetry.snapshot()["reads"] == 0
+
+    def test_read_burst(self, test_rdma):
+        """Test that a burst is sent as one datagram and its responses taken in order."""
+        # word 1 is not an echo of anything, so must not be used to reorder the responses
+        responses = [struct.pack('=IIIIQQQQQ', 1, word, 0, data, 0, 0, 0, 0, 0)
+                     for word, data in ((0x12, 0xAA), (0x11, 0xBB), (0, 0xCC))]
+        # two responses in one datagram, then the last on its own
+        datagrams = [responses[0] + responses[1], responses[2]]
+
+        def recv_into(buffer):
+            datagram = datagrams.pop(0)
+            buffer[:len(datagram)] = datagram
+            return len(datagram)
+        test_rdma.rx_socket.recv_into = Mock(side_effect=recv_into)
+
+        assert test_rdma.rdma.read_burst(0xC0000010, 3) == [0xAA, 0xBB, 0xCC]
+        expected = b''.join(
+            struct.pack('=BBBBIQ', 1, 0, 0, 3, address, 0)
+            for address in (0xC0000010, 0xC0000011, 0xC0000012)
+        ) + struct.pack('=BBBBIQQQQQ', 9, 0, 0, 255, 0, 0, 0, 0, 0, 0)
+        test_rdma.tx_socket.sendto.assert_called_once_with(
+            expected, (test_rdma.target_ip, test_rdma.target_port))
+
+    def test_read_burst_timeout(self, test_rdma):
+        """Test that reads missing from a burst are returned as zero."""
+        datagrams = [struct.pack('=IIIIQQQQQ', 1, 1, 0, 0xAA, 0, 0, 0, 0, 0)]
+
+        def recv_into(buffer):
+            if not datagrams:
+                raise socket.timeout
+            datagram = datagrams.pop(0)
+            buffer[:len(datagram)] = datagram
+            return len(datagram)
+        test_rdma.rx_socket.recv_into = Mock(side_effect=recv_into)
+        assert test_rdma.rdma.read_burst(0xC0000010, 2) == [0xAA, 0]
+
+    def test_compile_writes_matches_write_many(self, test_rdma):
+        """Test that compiled datagrams are the same as write_many sends, and can be resent."""
+        test_rdma.rdma.UDPMax = 28 + 48 + (16 * 10)
+        writes = [(address, address * 2) for address in range(15)]
+        # copy each datagram as it is sent, as write_many reuses its buffer
+        sent = []
+        test_rdma.tx_socket.sendto = Mock(
+            side_effect=lambda data, address: sent.append(bytes(data)))
+        test_rdma.rdma.write_many(writes)
+
+        datagrams = test_rdma.rdma.compile_writes(writes)
+        assert datagrams == sent
+        test_rdma.tx_socket.sendto = Mock()
+        assert test_rdma.rdma.send_datagrams(datagrams) == 2
+        assert [args[0][0] for args in test_rdma.tx_socket.sendto.call_args_list] == sent
+
+    def test_reliable_resends_only_missing(self, test_rdma):
+        """Test that reliable writes resend only the datagrams missing from the ack."""
+        test_rdma.rdma.reliable = True
+        test_rdma.rdma.UDPMax = 28 + 48 + (16 * 2)  # room for 2 writes per datagram
+        sent = []
+        test_rdma.tx_socket.sendto = Mock(
+            side_effect=lambda data, address: sent.append(bytes(data)))
+        # the first ack is missing the second of the three datagrams, the second is complete
+        acks = [struct.pack('=IIIIQQQQQ', 0xAC4B0000, 1, 3, 1, 0b101, 0, 0, 0, 0),
+                struct.pack('=IIIIQQQQQ', 0xAC4B0000, 1, 3, 2, 0b111, 0, 0, 0, 0)]
+
+        def recv_into(buffer):
+            ack = acks.pop(0)
+            buffer[:len(ack)] = ack
+            return len(ack)
+        test_rdma.rx_socket.recv_into = Mock(side_effect=recv_into)
+
+        assert test_rdma.rdma.write_many([(address, address) for address in range(6)]) == 3
+        sequences = [struct.unpack_from('=BBBBI', datagram, len(datagram) - 48)
+                     for datagram in sent]
+        # three numbered datagrams, an ack request, the missing datagram and another request
+        assert [(tag, address) for _, tag, _, _, address in sequences] == [
+            (1, 0), (2, 0), (3, 0), (0, 0xFFFFFFFF), (2, 0), (0, 0xFFFFFFFF)]
+        assert not acks
+
+    def test_probe_reliable_writes(self, test_rdma):
+        """Test that the probe only succeeds if the target answers an ack request."""
+        test_rdma.rx_socket.recv_into = Mock(side_effect=socket.timeout)
+        assert not test_rdma.rdma.probe_reliable_writes()
+        assert test_rdma.tx_socket.sendto.call_count == test_rdma.rdma.reliable_retries
+
+        ack = struct.pack('=IIIIQQQQQ', 0xAC4B0000, 1, 0, 1, 0, 0, 0, 0, 0)
+
+        def recv_into(buffer):
+            buffer[:len(ack)] = ack
+            return len(ack)
+        test_rdma.rx_socket.recv_into = Mock(side_effect=recv_into)
+        assert test_rdma.rdma.probe_reliable_writes()
+        assert test_rdma.rdma.write_sequence == 0
+
+    def test_reliable_gives_up(self, test_rdma):
+        """Test that reliable writes fail once no ack arrives within the timeout."""
+        test_rdma.rdma.reliable = True
+        test_rdma.rdma.UDPTimeout = 0
+        test_rdma.rx_socket.recv_into = Mock(side_effect=socket.timeout)
+        with pytest.raises(RdmaUDPError):
+            test_rdma.rdma.write(256, 1)
@@ -14,7 +14,10 @@ else:                         # pragma: no cover
 sys.modules['gpio'] = Mock()
 sys.modules['smbus'] = MagicMock()
 
-from qemii.fem.Backplane import Backplane
+import threading
+import time
+
+from qemii.fem.Backplane import Backplane, BackplaneSweepError
 
 
 class BackplaneTestFixture(object):
@@ -45,3 +48,59 @@ class TestBackplane():
     def test_init(self, test_backplane):
 
         assert test_backplane.backplane.backplane_power == 1
+
+    def test_sweep(self, test_backplane):
+        """Test that a sweep sets every step of the register, then reports itself complete"""
+        backplane = test_backplane.backplane
+        backplane.ad5694.reset_mock()
+        backplane.set("sweep/start", {"register": "AUXSAMPLE_FINE",
+                                      "start": 0, "stop": 5, "step": 2, "dwell": 0.001})
+        backplane.sweep_thread.join()
+        assert backplane.ad5694.set_from_value.call_args_list == [call(4, 0), call(4, 2),
+                                                                   call(4, 4)]
+        assert backplane.sweep_status["steps_done"] == 3
+        assert not backplane.sweep_status["in_progress"]
+        assert not backplane.sweep_status["aborted"]
+
+    def test_sweep_invalid_register(self, test_backplane):
+        with pytest.raises(BackplaneSweepError):
+            test_backplane.backplane.start_sweep({"register": "VCM", "stop": 10})
+        with pytest.raises(BackplaneSweepError):
+            test_backplane.backplane.start_sweep({"register": "AUXSAMPLE_FINE", "stop": "x"})
+
+    def test_setters_take_i2c_lock(self, test_backplane):
+        """Test that a register set directly waits for the I2C lock, rather than interleaving"""
+        backplane = test_backplane.backplane
+        backplane.ad5694.reset_mock()
+        setter = threading.Thread(target=backplane.set_fine_register, args=(5,))
+        with backplane.i2c_lock:
+            setter.start()
+            setter.join(0.1)
+            backplane.ad5694.set_from_value.assert_not_called()
+        setter.join()
+        backplane.ad5694.set_from_value.assert_called_once_with(4, 5)
+
+    def test_sweep_values(self, test_backplane):
+        """Test that a sweep can set a list of values, in the order given"""
+        backplane = test_backplane.backplane
+        backplane.ad5694.reset_mock()
+        backplane.start_sweep({"register": "AUXSAMPLE_COARSE", "values": [7, 3, 100],
+                               "dwell": 0.001})
+        backplane.sweep_thread.join()
+        assert backplane.ad5694.set_from_value.call_args_list == [call(1, 7), call(1, 3),
+                                                                   call(1, 100)]
+
+    def test_sweep_records_late_steps(self, test_backplane):
+        """Test that a step set after the middle of its dwell is recorded as late"""
+        backplane = test_backplane.backplane
+        backplane.ad5694.reset_mock()
+        backplane.ad5694.set_from_value = Mock(
+            side_effect=lambda channel, value: time.sleep(0.02) if value == 1 else None)
+        backplane.start_sweep({"register": "AUXSAMPLE_FINE", "values": [0, 1, 2, 3, 4, 5, 6],
+                               "dwell": 0.005})
+        backplane.sweep_thread.join()
+        backplane.ad5694.set_from_value = Mock()
+        assert backplane.sweep_status["late_step_indices"][0] == 1
+        assert backplane.sweep_status["late_steps"] == \
+            len(backplane.sweep_status["late_step_indices"])
+        assert backplane.sweep_status["steps_done"] == 7
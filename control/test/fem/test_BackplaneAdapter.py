@@ -15,6 +15,7 @@ sys.modules['gpio'] = Mock()
 sys.modules['smbus'] = MagicMock()
 
 from qemii.fem.BackplaneAdapter import BackplaneAdapter
+from qemii.fem.Backplane import BackplaneSweepError
 
 
 class BackplaneAdapterTestFixture(object):
@@ -40,4 +41,14 @@ class TestBackplaneAdapter():
         print("Backplane Module: " + test_backplane_adapter.adapter.backplane.__module__)
         response = test_backplane_adapter.adapter.get(test_backplane_adapter.path,
                                                       test_backplane_adapter.request)
-        assert response.status_code == 200
\ No newline at end of file
+        assert response.status_code == 200
+
+    def test_adapter_put_sweep_error(self, test_backplane_adapter):
+        """Test that a sweep that cannot start is reported as such, not as a bad request body"""
+        adapter = test_backplane_adapter.adapter
+        adapter.backplane.set = Mock(
+            side_effect=BackplaneSweepError("AUXSAMPLE sweep already in progress"))
+        test_backplane_adapter.request.body = '{"start": {"register": "AUXSAMPLE_FINE"}}'
+        response = adapter.put("sweep", test_backplane_adapter.request)
+        assert response.status_code == 400
+        assert response.data == {"error": "AUXSAMPLE sweep already in progress"}